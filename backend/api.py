@@ -2,20 +2,41 @@
 
 import argparse
 import logging
-import math
+import os
+import signal
+import socket
+import threading
+import time
+from array import array
 
-from gevent import monkey, spawn
+from gevent import monkey
 monkey.patch_all()
 
-from backend.emailtools import EmailManager
+from backend.docregistry import DocRegistry
+from backend.emailtools import EmailManager, gzip_attachment, gzip_text_attachment
+from backend.jobqueue import JobQueue, JobWorkerPool, JOB_DONE, JOB_QUEUED, JOB_RUNNING
+from backend.matcher import MentionMatcher
+from backend.metrics import REGISTRY, JOB_SECONDS, get_summary
 import falcon
 
-from wsgiref import simple_server
 from falcon import HTTPStatus
+from gevent import get_hub
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from backend.querycache import QueryCache, DEFAULT_TTL
+from backend.queryplanner import QueryPlanner, TokenBucket
+from backend.resultstore import ResultStore, ResultWriter
 from backend.tpcmanager import TPCManager
+from backend.varindex import VariationIndex, get_unique_variations
 
+logger = logging.getLogger(__name__)
 
-NUM_KEYWORDS_EACH_API_CALL = 500
+
+# maximum size of the body of a request, in bytes, and maximum number of entities of a job
+DEFAULT_MAX_REQUEST_SIZE = 16 * 1024 * 1024
+DEFAULT_MAX_ENTITIES = 500000
+# maximum number of requests served at the same time by each process
+DEFAULT_POOL_SIZE = 1000
 
 
 class HandleCORS(object):
@@ -29,104 +50,403 @@ class HandleCORS(object):
         resp.set_header('Access-Control-Allow-Headers', allow_headers)
         resp.set_header('Access-Control-Max-Age', 1728000)  # 20 days
         if req.method == 'OPTIONS':
-            raise HTTPStatus(falcon.HTTP_200, body='\n')
+            raise HTTPStatus(falcon.HTTP_200, text='\n')
+
+
+class LimitRequestSize(object):
+    """reject the requests with a body larger than max_size bytes before it is read"""
 
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+
+    def process_request(self, req, resp):
+        if req.method in ('POST', 'PUT', 'PATCH'):
+            if req.content_length is None:
+                raise falcon.HTTPLengthRequired(description="the Content-Length header is required")
+            if req.content_length > self.max_size:
+                raise falcon.HTTPPayloadTooLarge(description="the request body exceeds " + str(self.max_size) +
+                                                             " bytes")
 
-def send_error_mail(variations, reply_to_addr, error, email_manager: EmailManager):
+
+def send_error_mail(job: dict, error, email_manager: EmailManager, public_url: str):
+    """email the failure of a job with a link to its status, and the input entities attached if small enough"""
+    status_url = public_url.rstrip("/") + "/jobs/" + job["id"]
+    # compressed on a native thread, so that the other greenlets keep running
+    attachment = get_hub().threadpool.apply(gzip_text_attachment, (
+        "\n".join(job["variations"]) + "\n", "entities_" + job["id"] + ".txt", MAX_ATTACHMENT_SIZE))
     email_manager.send_email("Error from TPC entity counter",
-                             "An error occurred while calculating the statistics: " + str(error) +
-                             "<br/><br/>Please contact the admin at "
-                             "valearna@caltech.org<br/><br/>Input entities:<br/>" + "<br/>".join(variations),
-                             reply_to_addr)
+                             "An error occurred while calculating the statistics of job " + job["id"] + ": " +
+                             str(error) + "<br/><br/>Job status: <a href=\"" + status_url + "\">" + status_url +
+                             "</a><br/><br/>Number of input entities: " + str(len(job["variations"])) +
+                             ("<br/>The input entities are attached." if attachment is not None else "") +
+                             "<br/><br/>Please contact the admin at valearna@caltech.org",
+                             job["reply_to"],
+                             [attachment] if attachment is not None else None)
 
 
-def get_total_count(variations: list, reply_to_addr: str, tpc_manager: TPCManager, email_manager: EmailManager):
-    try:
-        doc_ids = set()
-        start = 0
-        end = NUM_KEYWORDS_EACH_API_CALL
-        while True:
-            var_subset = variations[start:min(end, len(variations)) + 1]
-            num_docs = tpc_manager.get_doc_count(var_subset)
-            for i in range(0, math.ceil(num_docs / 200)):
-                docs = tpc_manager.get_docid_matching(var_subset, start=i * 200)
-                doc_ids.update(set(docs))
-            if end > len(variations):
-                break
-            start = end + 1
-            end += NUM_KEYWORDS_EACH_API_CALL
-        email_manager.send_email("Results ready from TPC entity counter",
-                                 "Total number of mentions in C. elegans literature: " + str(len(doc_ids)) + "<br/><br/>" +
-                                 "Input entities:<br/>" + "<br/>".join(variations),
-                                 reply_to_addr)
-    except Exception as e:
-        send_error_mail(variations, reply_to_addr, e, email_manager)
+def get_total_count(variations: list, tpc_manager: TPCManager, result_writer: ResultWriter):
+    num_papers = len(VariationIndex.resolve_docs(tpc_manager, variations))
+    result_writer.write_row("total_papers", num_papers)
+    return "Total number of mentions in C. elegans literature: " + str(num_papers)
 
 
-def get_vars_in_paper(variations: list, reply_to_addr: str, tpc_manager: TPCManager, email_manager: EmailManager):
-    try:
-        doc_id_accession_fulltext = {}
-        start = 0
-        end = NUM_KEYWORDS_EACH_API_CALL
-        while True:
-            var_subset = variations[start:min(end, len(variations)) + 1]
-            num_docs = tpc_manager.get_doc_count(var_subset)
-            for i in range(0, math.ceil(num_docs / 200)):
-                docs = tpc_manager.get_doc_matching_with_fulltext(var_subset, start=i * 200)
-                doc_id_accession_fulltext.update({doc[0]: (doc[1], doc[2]) for doc in docs})
-            if end > len(variations):
-                break
-            start = end + 1
-            end += NUM_KEYWORDS_EACH_API_CALL
-        email_manager.send_email("Results ready from TPC entity counter",
-                                 "Number of entities mentioned in each paper: <br/><br/>" +
-                                 "<br/>".join([accession + "\t" + str(sum([fulltext.count(var) for var in variations])) for
-                                               paper_id, (accession, fulltext) in doc_id_accession_fulltext.items()]) +
-                                 "<br/><br/>" +
-                                 "Input entities:<br/>" + "<br/>".join(variations),
-                                 reply_to_addr)
-    except Exception as e:
-        send_error_mail(variations, reply_to_addr, e, email_manager)
+def get_vars_in_paper(variations: list, tpc_manager: TPCManager, result_writer: ResultWriter):
+    # documents are numbered in the order they are first returned, and their counts are stored at their number
+    docs = DocRegistry()
+    counts = array('I')
+    planner = QueryPlanner()
+    for var_subset in planner.iter_batches(get_unique_variations(variations)):
+        # a paper can be returned for several batches with the same title, so only the mentions of the variations of
+        # the batch are counted in its text
+        matcher = MentionMatcher(var_subset)
+        num_docs = 0
+        start_time = time.monotonic()
+        # pages are counted as they arrive while the next ones are fetched, and their text is discarded right away
+        for page in tpc_manager.iter_pages(tpc_manager.get_doc_matching_with_fulltext, var_subset):
+            for identifier, accession, fulltext in page:
+                doc_num = docs.intern(identifier, accession)
+                if doc_num == len(counts):
+                    counts.append(0)
+                counts[doc_num] += matcher.count_total(fulltext)
+            num_docs += len(page)
+        planner.record(var_subset, time.monotonic() - start_time, num_docs)
+    for accession, count in zip(docs.accessions, counts):
+        result_writer.write_row(accession, count)
+    return "Number of papers mentioning at least one entity: " + str(result_writer.num_rows)
+
+
+def get_papersby_var(variations: list, tpc_manager: TPCManager, result_writer: ResultWriter):
+    num_mentioned_vars = 0
+    for var_name, num_papers in VariationIndex.build(tpc_manager, variations).get_papers_per_variation(variations):
+        result_writer.write_row(var_name, num_papers)
+        if num_papers > 0:
+            num_mentioned_vars += 1
+    return "Number of entities mentioned in at least one paper: " + str(num_mentioned_vars) + " of " + \
+        str(result_writer.num_rows)
+
+
+JOB_FUNCTIONS = {
+    "total_count": get_total_count,
+    "vars_in_paper": get_vars_in_paper,
+    "papers_per_var": get_papersby_var
+}
 
+# results compressed to at most this size are attached to the emails, larger ones are only linked
+MAX_ATTACHMENT_SIZE = 10 * 1024 * 1024
 
-def get_papersby_var(variations: list, reply_to_addr: str, tpc_manager: TPCManager, email_manager: EmailManager):
+RESULT_COLUMNS = {
+    "total_count": ["statistic", "value"],
+    "vars_in_paper": ["paper", "num_mentions"],
+    "papers_per_var": ["entity", "num_papers"]
+}
+
+
+def run_job(job: dict, tpc_manager: TPCManager, email_manager: EmailManager, result_store: ResultStore,
+            public_url: str):
+    """calculate the statistics of a job, store the full result on disk and email a summary with a link to it and
+    the gzipped tsv attached, if small enough"""
+    # jobs running at the same time are included in the summary, which is exact only when the job runs alone
+    metrics_before = REGISTRY.snapshot()
+    start_time = time.monotonic()
     try:
+        with result_store.open_writer(job["id"], RESULT_COLUMNS[job["type"]]) as result_writer:
+            summary = JOB_FUNCTIONS[job["type"]](job["variations"], tpc_manager, result_writer)
+        result_url = public_url.rstrip("/") + "/jobs/" + job["id"] + "/result"
+        # compressed on a native thread, so that the other greenlets keep running
+        attachment = get_hub().threadpool.apply(gzip_attachment, (
+            result_store.get_path(job["id"]), job["type"] + "_" + job["id"] + ".tsv", MAX_ATTACHMENT_SIZE))
         email_manager.send_email("Results ready from TPC entity counter",
-                                 "Number of papers mentioning each entity: <br/><br/>" +
-                                 "<br/>".join([var_name + "\t" + str(tpc_manager.get_doc_count([var_name])) for
-                                               var_name in variations]) +
-                                 "<br/><br/>" +
-                                 "Input entities:<br/>" + "<br/>".join(variations),
-                                 reply_to_addr)
+                                 summary + "<br/><br/>" +
+                                 "Download the full results: <a href=\"" + result_url + "?format=tsv\">TSV</a> " +
+                                 "<a href=\"" + result_url + "?format=json\">JSON</a><br/><br/>" +
+                                 "Number of input entities: " + str(len(job["variations"])),
+                                 job["reply_to"],
+                                 [attachment] if attachment is not None else None)
+        JOB_SECONDS.observe(time.monotonic() - start_time, type=job["type"], status="done")
     except Exception as e:
-        send_error_mail(variations, reply_to_addr, e, email_manager)
+        JOB_SECONDS.observe(time.monotonic() - start_time, type=job["type"], status="failed")
+        send_error_mail(job, e, email_manager, public_url)
+        raise
+    finally:
+        logger.info("Summary of job " + job["id"] + ":\n" + get_summary(metrics_before))
+
+
+class LazyClients(object):
+    """Textpresso and email clients of the jobs, built from the configuration when the first job needs them
+
+    The API starts serving without waiting for them, and the processes forked by the server do not inherit their
+    connections.
+
+    Args:
+        config (dict): the configuration of the API
+    """
+
+    def __init__(self, config: dict):
+        self.config = config
+        self._lock = threading.Lock()
+        self._tpc_manager = None
+        self._email_manager = None
+
+    @property
+    def tpc_manager(self):
+        with self._lock:
+            if self._tpc_manager is None:
+                query_cache = QueryCache(self.config["cache_path"], ttl=self.config["cache_ttl"],
+                                         corpus_version=self.config["corpus_version"]) if \
+                    self.config["cache_path"] else None
+                self._tpc_manager = TPCManager(textpresso_api_token=self.config["tpc_token"],
+                                               max_concurrency=self.config["tpc_concurrency"], cache=query_cache,
+                                               rate_limiter=TokenBucket(self.config["tpc_rate"]) if
+                                               self.config["tpc_rate"] else None)
+            return self._tpc_manager
+
+    @property
+    def email_manager(self):
+        with self._lock:
+            if self._email_manager is None:
+                self._email_manager = EmailManager(self.config["email_host"], self.config["email_port"],
+                                                   self.config["email_user"], self.config["email_passwd"])
+            return self._email_manager
+
+
+def get_job_handlers(clients: LazyClients, result_store: ResultStore, public_url: str):
+    def handle_job(job):
+        run_job(job, clients.tpc_manager, clients.email_manager, result_store, public_url)
+    return {job_type: handle_job for job_type in JOB_FUNCTIONS}
 
 
 class TPCAPIReader:
 
-    def __init__(self, tpc_manager: TPCManager, email_manager: EmailManager):
-        self.tpc_manager = tpc_manager
-        self.email_manager = email_manager
+    def __init__(self, job_queue: JobQueue, max_entities: int = DEFAULT_MAX_ENTITIES):
+        self.job_queue = job_queue
+        self.max_entities = max_entities
         self.logger = logging.getLogger(__name__)
 
     def on_post(self, req, resp):
-        if "variations" in req.media and "replyto" in req.media:
-            variations = req.media.get("variations")
-            reply_to_addr = req.media.get("replyto")
-            if req.media["type"] == "total_count":
-                spawn(get_total_count, variations, reply_to_addr, self.tpc_manager, self.email_manager)
-                #get_total_count(variations, reply_to_addr, self.tpc_manager, self.email_manager)
-                resp.status = falcon.HTTP_OK
-            elif req.media["type"] == "vars_in_paper":
-                spawn(get_vars_in_paper, variations, reply_to_addr, self.tpc_manager, self.email_manager)
-                resp.status = falcon.HTTP_OK
-            elif req.media["type"] == "papers_per_var":
-                spawn(get_papersby_var, variations, reply_to_addr, self.tpc_manager, self.email_manager)
-                resp.status = falcon.HTTP_OK
+        if "variations" in req.media and "replyto" in req.media and req.media.get("type") in JOB_FUNCTIONS:
+            if len(req.media["variations"]) > self.max_entities:
+                raise falcon.HTTPPayloadTooLarge(description="a job can count at most " + str(self.max_entities) +
+                                                             " entities")
+            job_id, _ = self.job_queue.submit(req.media["type"], req.media.get("variations"),
+                                              req.media.get("replyto"))
+            resp.media = {"job_id": job_id}
+            resp.status = falcon.HTTP_ACCEPTED
         else:
             resp.status = falcon.HTTP_BAD_REQUEST
 
 
+class JobStatusReader:
+
+    def __init__(self, job_queue: JobQueue):
+        self.job_queue = job_queue
+
+    def on_get(self, req, resp, job_id):
+        job = self.job_queue.get(job_id)
+        if job is None:
+            raise falcon.HTTPNotFound()
+        resp.media = {"job_id": job["id"], "type": job["type"], "state": job["state"],
+                      "num_entities": len(job["variations"]), "created": job["created"], "started": job["started"],
+                      "finished": job["finished"], "error": job["error"]}
+        if job["state"] == JOB_DONE:
+            resp.media["result"] = "/jobs/" + job["id"] + "/result"
+        resp.status = falcon.HTTP_OK
+
+
+class JobResultReader:
+
+    def __init__(self, job_queue: JobQueue, result_store: ResultStore):
+        self.job_queue = job_queue
+        self.result_store = result_store
+
+    def on_get(self, req, resp, job_id):
+        job = self.job_queue.get(job_id)
+        if job is None or job["state"] != JOB_DONE or not self.result_store.exists(job_id):
+            raise falcon.HTTPNotFound()
+        result_format = req.get_param("format", default="tsv")
+        if result_format == "tsv":
+            resp.content_type = "text/tab-separated-values"
+            resp.content_length = self.result_store.get_size(job_id)
+            resp.stream = self.result_store.iter_tsv(job_id)
+        elif result_format == "json":
+            resp.content_type = falcon.MEDIA_JSON
+            resp.stream = self.result_store.iter_json(job_id)
+        else:
+            raise falcon.HTTPBadRequest(description="format must be tsv or json")
+        resp.set_header("Content-Disposition", "attachment; filename=\"" + job["type"] + "_" + job_id + "." +
+                        result_format + "\"")
+        resp.status = falcon.HTTP_OK
+
+
+class HealthReader:
+
+    def on_get(self, req, resp):
+        resp.media = {"status": "ok"}
+        resp.status = falcon.HTTP_OK
+
+
+class ReadinessReader:
+
+    def __init__(self, job_queue: JobQueue, worker_pool: JobWorkerPool):
+        self.job_queue = job_queue
+        self.worker_pool = worker_pool
+
+    def on_get(self, req, resp):
+        workers_running = self.worker_pool.is_running()
+        resp.media = {"ready": workers_running, "workers_running": workers_running,
+                      "queued_jobs": self.job_queue.get_num_jobs(JOB_QUEUED),
+                      "running_jobs": self.job_queue.get_num_jobs(JOB_RUNNING)}
+        resp.status = falcon.HTTP_OK if workers_running else falcon.HTTP_SERVICE_UNAVAILABLE
+
+
+class MetricsReader:
+    """metrics of the process answering the request. When several processes serve the API, each sample has a pid
+    label, and the metrics of the service are the sum over the processes"""
+
+    def __init__(self, pid_label: bool = False):
+        self.pid_label = pid_label
+
+    def on_get(self, req, resp):
+        resp.content_type = "text/plain; version=0.0.4; charset=utf-8"
+        resp.data = REGISTRY.render({"pid": os.getpid()} if self.pid_label else None).encode("utf-8")
+        resp.status = falcon.HTTP_OK
+
+
+def create_app(config: dict, resume_jobs: bool = False):
+    """create the falcon app and start the workers executing the queued jobs
+
+    Args:
+        config (dict): the configuration of the API
+        resume_jobs (bool): optional, queue again the jobs left running by a previous process. Only for a single
+            process serving the API: the jobs running in the other processes would be started twice
+    Returns:
+        falcon.App: the app
+    """
+    app = falcon.App(middleware=[HandleCORS(), LimitRequestSize(config["max_request_size"])])
+    job_queue = JobQueue(config["jobs_db"])
+    result_store = ResultStore(config["results_dir"])
+    worker_pool = JobWorkerPool(job_queue, get_job_handlers(LazyClients(config), result_store, config["public_url"]),
+                                num_workers=config["workers"])
+    worker_pool.start(resume=resume_jobs)
+    app.add_route('/get_stats', TPCAPIReader(job_queue=job_queue, max_entities=config["max_entities"]))
+    app.add_route('/jobs/{job_id}', JobStatusReader(job_queue=job_queue))
+    app.add_route('/jobs/{job_id}/result', JobResultReader(job_queue=job_queue, result_store=result_store))
+    app.add_route('/metrics', MetricsReader(pid_label=config["metrics_pid_label"]))
+    app.add_route('/health', HealthReader())
+    app.add_route('/ready', ReadinessReader(job_queue=job_queue, worker_pool=worker_pool))
+    return app
+
+
+def get_config_from_env():
+    """read the configuration of the API from the environment, as set up when served by an external wsgi server
+
+    The interrupted jobs are resumed at import only if RESUME_JOBS is set, which is safe with a single worker process.
+    With several worker processes, resume them once from the master process instead, without importing this module,
+    e.g. with JobQueue(path).resume() in the on_starting hook of gunicorn and JobQueue(path).resume(worker.pid) in its
+    child_exit hook.
+
+    TPC_RATE is the rate limit of each worker process, so the limit of the service is divided by the number of worker
+    processes. With several worker processes, set METRICS_PID_LABEL so that the metrics scraped from each process can
+    be told apart.
+    """
+    return {
+        "tpc_token": os.environ['TPC_TOKEN'],
+        "tpc_concurrency": int(os.environ.get('TPC_CONCURRENCY', 8)),
+        "tpc_rate": float(os.environ['TPC_RATE']) if os.environ.get('TPC_RATE') else None,
+        "cache_path": os.environ.get('TPC_CACHE_PATH'),
+        "cache_ttl": float(os.environ.get('TPC_CACHE_TTL', DEFAULT_TTL)),
+        "corpus_version": os.environ.get('TPC_CORPUS_VERSION'),
+        "email_host": os.environ['EMAIL_HOST'],
+        "email_port": os.environ['EMAIL_PORT'],
+        "email_user": os.environ['EMAIL_USER'],
+        "email_passwd": os.environ['EMAIL_PASSWD'],
+        "jobs_db": os.environ.get('JOBS_DB', 'jobs.sqlite'),
+        "results_dir": os.environ.get('RESULTS_DIR', 'results'),
+        "public_url": os.environ.get('PUBLIC_URL', 'http://localhost:' + os.environ.get('PORT', '8012')),
+        "workers": int(os.environ.get('JOB_WORKERS', 4)),
+        "max_request_size": int(os.environ.get('MAX_REQUEST_SIZE', DEFAULT_MAX_REQUEST_SIZE)),
+        "max_entities": int(os.environ.get('MAX_ENTITIES', DEFAULT_MAX_ENTITIES)),
+        "metrics_pid_label": bool(os.environ.get('METRICS_PID_LABEL'))
+    }
+
+
+def resume_jobs(config: dict, worker_pid: int = None):
+    """queue again the jobs left running by a previous run of the API, or by a server process that died
+
+    Args:
+        config (dict): the configuration of the API
+        worker_pid (int): optional, only resume the jobs claimed by the process with this pid
+    Returns:
+        int: the number of jobs queued again
+    """
+    job_queue = JobQueue(config["jobs_db"])
+    try:
+        return job_queue.resume(worker_pid)
+    finally:
+        job_queue.close()
+
+
+def _serve_process(listener, config: dict, pool_size: int, resume_jobs: bool):
+    server = WSGIServer(listener, create_app(config, resume_jobs=resume_jobs), spawn=Pool(pool_size), log=None,
+                        error_log=logger)
+    server.serve_forever()
+
+
+def serve(config: dict, port: int, num_processes: int = 1, pool_size: int = DEFAULT_POOL_SIZE):
+    """serve the API with the gevent wsgi server
+
+    With more than one process, the server processes are forked after binding the listening socket, which they share,
+    and a process that dies is replaced, after its running jobs are queued again. Each process serves up to
+    pool_size requests at the same time and runs its own job workers on the shared job queue. The Textpresso rate
+    limit is split evenly between the processes, and each process exposes its own metrics, labelled with its pid.
+
+    Args:
+        config (dict): the configuration of the API
+        port (int): the port to listen on
+        num_processes (int): optional, the number of server processes
+        pool_size (int): optional, the maximum number of requests served at the same time by each process
+    """
+    # the token bucket and the metrics registry are per process
+    config = dict(config, tpc_rate=config["tpc_rate"] / num_processes if config["tpc_rate"] else None,
+                  metrics_pid_label=num_processes > 1)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('0.0.0.0', port))
+    listener.listen(1024)
+    logger.info("Listening on port " + str(port) + " with " + str(num_processes) + " processes")
+    if num_processes <= 1:
+        _serve_process(listener, config, pool_size, resume_jobs=True)
+        return
+    # jobs interrupted by a previous run are resumed once, before the processes start claiming jobs
+    resume_jobs(config)
+    children = set()
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        while True:
+            while len(children) < num_processes:
+                pid = os.fork()
+                if pid == 0:
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    try:
+                        _serve_process(listener, config, pool_size, resume_jobs=False)
+                    finally:
+                        os._exit(1)
+                children.add(pid)
+            pid, status = os.waitpid(-1, 0)
+            if pid in children:
+                children.remove(pid)
+                logger.warning("Server process " + str(pid) + " exited with status " + str(status) + ", restarting it")
+                resume_jobs(config, worker_pid=pid)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
 def main():
     parser = argparse.ArgumentParser(description="Find new documents in WormBase collection and pre-populate data "
                                                  "structures for Author First Pass")
@@ -141,28 +461,63 @@ def main():
     parser.add_argument("-u", "--email-user", metavar="email_user", dest="email_user", type=str)
     parser.add_argument("-w", "--email-passwd", metavar="email_passwd", dest="email_passwd", type=str)
     parser.add_argument("-P", "--port", metavar="port", dest="port", type=int, help="API port")
+    parser.add_argument("-c", "--tpc-concurrency", metavar="tpc_concurrency", dest="tpc_concurrency", type=int,
+                        default=8, help="maximum number of parallel requests to Textpresso Central API")
+    parser.add_argument("-R", "--tpc-rate", metavar="tpc_rate", dest="tpc_rate", type=float, default=None,
+                        help="maximum number of requests per second to Textpresso Central API. Unlimited if not "
+                             "provided")
+    parser.add_argument("-C", "--cache-path", metavar="cache_path", dest="cache_path", type=str, default=None,
+                        help="path to the Textpresso query cache file. Results are not cached if not provided")
+    parser.add_argument("--cache-ttl", metavar="cache_ttl", dest="cache_ttl", type=float, default=DEFAULT_TTL,
+                        help="time to live of the cached query results, in seconds")
+    parser.add_argument("--corpus-version", metavar="corpus_version", dest="corpus_version", type=str,
+                        default=None, help="version of the Textpresso corpus. The query cache is invalidated when "
+                                           "it changes")
+    parser.add_argument("-j", "--jobs-db", metavar="jobs_db", dest="jobs_db", type=str, default="jobs.sqlite",
+                        help="path to the job queue database")
+    parser.add_argument("-r", "--results-dir", metavar="results_dir", dest="results_dir", type=str,
+                        default="results", help="directory where the results of the jobs are stored")
+    parser.add_argument("-U", "--public-url", metavar="public_url", dest="public_url", type=str, default=None,
+                        help="public url of the API, used for the links in the emails. Default "
+                             "http://localhost:<port>")
+    parser.add_argument("-W", "--workers", metavar="workers", dest="workers", type=int, default=4,
+                        help="maximum number of jobs running at the same time in each process")
+    parser.add_argument("-n", "--processes", metavar="processes", dest="processes", type=int, default=1,
+                        help="number of server processes. Each process runs its own job workers and exposes its own "
+                             "metrics, and the Textpresso rate limit is split between them")
+    parser.add_argument("--pool-size", metavar="pool_size", dest="pool_size", type=int, default=DEFAULT_POOL_SIZE,
+                        help="maximum number of requests served at the same time by each process")
+    parser.add_argument("--max-request-size", metavar="max_request_size", dest="max_request_size", type=int,
+                        default=DEFAULT_MAX_REQUEST_SIZE, help="maximum size of the body of a request, in bytes")
+    parser.add_argument("--max-entities", metavar="max_entities", dest="max_entities", type=int,
+                        default=DEFAULT_MAX_ENTITIES, help="maximum number of entities of a job")
     args = parser.parse_args()
 
     logging.basicConfig(filename=args.log_file, level=args.log_level,
                         format='%(asctime)s - %(name)s - %(levelname)s:%(message)s')
 
-    app = falcon.API(middleware=[HandleCORS()])
-    tpc_manager = TPCManager(textpresso_api_token=args.tpc_token)
-    email_manager = EmailManager(args.email_host, args.email_port, args.email_user, args.email_passwd)
-    tpc_api_reader = TPCAPIReader(tpc_manager=tpc_manager, email_manager=email_manager)
-    app.add_route('/get_stats', tpc_api_reader)
-
-    httpd = simple_server.make_server('0.0.0.0', args.port, app)
-    httpd.serve_forever()
+    config = {
+        "tpc_token": args.tpc_token,
+        "tpc_concurrency": args.tpc_concurrency,
+        "tpc_rate": args.tpc_rate,
+        "cache_path": args.cache_path,
+        "cache_ttl": args.cache_ttl,
+        "corpus_version": args.corpus_version,
+        "email_host": args.email_host,
+        "email_port": args.email_port,
+        "email_user": args.email_user,
+        "email_passwd": args.email_passwd,
+        "jobs_db": args.jobs_db,
+        "results_dir": args.results_dir,
+        "public_url": args.public_url or "http://localhost:" + str(args.port),
+        "workers": args.workers,
+        "max_request_size": args.max_request_size,
+        "max_entities": args.max_entities
+    }
+    serve(config, args.port, num_processes=args.processes, pool_size=args.pool_size)
 
 
 if __name__ == '__main__':
     main()
 else:
-    import os
-    app = falcon.API(middleware=[HandleCORS()])
-    tpc_manager = TPCManager(textpresso_api_token=os.environ['TPC_TOKEN'])
-    email_manager = EmailManager(os.environ['EMAIL_HOST'], os.environ['EMAIL_PORT'], os.environ['EMAIL_USER'],
-                                 os.environ['EMAIL_PASSWD'])
-    tpc_api_reader = TPCAPIReader(tpc_manager=tpc_manager, email_manager=email_manager)
-    app.add_route('/get_stats', tpc_api_reader)
+    app = create_app(get_config_from_env(), resume_jobs=bool(os.environ.get('RESUME_JOBS')))
@@ -0,0 +1,413 @@
+import asyncio
+import json
+import logging
+import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from backend.asynchttp import AsyncHTTPClient
+from backend.checkpoint import Checkpoint
+from backend.dbmanager import DBManager
+from backend.metrics import TPC_REQUEST_SECONDS, TPC_REQUEST_ERRORS, TPC_RESPONSE_BYTES, PDF_DOWNLOAD_SECONDS, \
+    PDF_DOWNLOAD_BYTES, PDF_DOWNLOAD_ERRORS, PDF_CACHE_REQUESTS, PDF_PARSE_SECONDS, PDF_PARSE_FAILED_PAGES
+from backend.nttxtraction import NttExtractor, ExtractionResult, ParsePool
+from backend.queryplanner import QueryPlanner
+from backend.tpcmanager import TPCManager, PAGE_SIZE, check_fulltext_error
+from backend.varindex import VariationIndex
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_IN_FLIGHT = 32
+DEFAULT_BATCHES_IN_FLIGHT = 4
+DEFAULT_PDF_QUEUE_SIZE = 16
+
+
+async def imap_ordered(func, items, limit: int):
+    """lazily await func on each item with at most `limit` calls in flight, yielding the results in input order"""
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(asyncio.ensure_future(func(item)))
+            if len(pending) >= limit:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+class AsyncTPCManager(object):
+    """asyncio counterpart of the queries of a TPCManager used by the batch pipeline
+
+    The queries, the query cache and the rate limit are the ones of the wrapped TPCManager, the requests are sent on an
+    AsyncHTTPClient. The query cache is read and written on the default executor of the loop, so that its disk I/O
+    does not stall the requests in flight.
+
+    Args:
+        tpc_manager (TPCManager): the Textpresso manager providing the queries, the cache and the rate limit
+        max_in_flight (int): optional, the maximum number of requests in flight
+    """
+
+    def __init__(self, tpc_manager: TPCManager, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT):
+        self.tpc_manager = tpc_manager
+        self.max_in_flight = max_in_flight
+        self.http_client = AsyncHTTPClient(tpc_manager.api_base_url, max_connections=max_in_flight,
+                                           timeout=tpc_manager.timeout, max_retries=tpc_manager.max_retries,
+                                           verify_tls=tpc_manager.http_client.verify_tls)
+
+    async def _send_request(self, endpoint, query):
+        rate_limiter = self.tpc_manager.rate_limiter
+        if rate_limiter is not None:
+            wait_time = rate_limiter.try_acquire()
+            while wait_time > 0:
+                await asyncio.sleep(wait_time)
+                wait_time = rate_limiter.try_acquire()
+        data = json.dumps(query).encode('utf-8')
+        try:
+            with TPC_REQUEST_SECONDS.time(endpoint=endpoint):
+                response = await self.http_client.post_json(endpoint, data)
+        except Exception:
+            TPC_REQUEST_ERRORS.inc(endpoint=endpoint)
+            raise
+        TPC_RESPONSE_BYTES.inc(len(response), endpoint=endpoint)
+        return json.loads(response.decode('utf-8'))
+
+    async def get_doc_count(self, keywords: list):
+        loop = asyncio.get_event_loop()
+        cache = self.tpc_manager.cache
+        if cache is not None:
+            num_docs = await loop.run_in_executor(None, cache.get, keywords, "count")
+            if num_docs is not None:
+                return num_docs
+        num_docs = int(await self._send_request(self.tpc_manager.tpc_api_endpoint_count,
+                                                self.tpc_manager.count_query(keywords)))
+        if cache is not None:
+            await loop.run_in_executor(None, cache.set, keywords, "count", num_docs)
+        return num_docs
+
+    async def get_doc_matching(self, keywords: list, start: int = 0, count: int = PAGE_SIZE):
+        return self.tpc_manager.parse_doc_matching(await self._send_request(
+            self.tpc_manager.tpc_api_endpoint, self.tpc_manager.doc_matching_query(keywords, start, count)))
+
+    async def get_all_docs(self, keywords: list, num_docs: int = None):
+        """get the (identifier, accession) tuples of all the documents matching a query, fetching its pages
+        concurrently
+
+        The results are shared with the query cache of the synchronous get_all_pages(get_doc_matching, ...).
+        """
+        loop = asyncio.get_event_loop()
+        cache = self.tpc_manager.cache
+        if cache is not None:
+            docs = await loop.run_in_executor(None, cache.get, keywords, "get_doc_matching")
+            if docs is not None:
+                return [tuple(doc) for doc in docs]
+        if num_docs is None:
+            num_docs = await self.get_doc_count(keywords)
+        pages = await asyncio.gather(*(self.get_doc_matching(keywords, start) for start in
+                                       range(0, num_docs, PAGE_SIZE)))
+        docs = [doc for page in pages for doc in page]
+        if cache is not None:
+            await loop.run_in_executor(None, cache.set, keywords, "get_doc_matching", docs)
+        return docs
+
+    async def get_all_doc_sentences(self, keywords: list, num_docs: int = None):
+        """get the (identifier, accession, matched sentences) tuples of all the documents matching a query, fetching
+        its pages concurrently"""
+        if num_docs is None:
+            num_docs = await self.get_doc_count(keywords)
+        pages = await asyncio.gather(*(self._send_request(self.tpc_manager.tpc_api_endpoint,
+                                                          self.tpc_manager.doc_sentences_query(keywords, start,
+                                                                                               PAGE_SIZE))
+                                       for start in range(0, num_docs, PAGE_SIZE)))
+        return [doc for page in pages for doc in self.tpc_manager.parse_doc_sentences(page)]
+
+    async def get_doc_fulltext(self, accession):
+        """get the indexed sentences of a document, None if it could not be fetched
+
+        Raises:
+            HTTPError: if the request fails with a client error other than 404, see check_fulltext_error
+        """
+        try:
+            return self.tpc_manager.parse_fulltext(await self._send_request(
+                self.tpc_manager.tpc_api_endpoint, self.tpc_manager.fulltext_query(accession)))
+        except Exception as e:
+            check_fulltext_error(accession, e)
+            return None
+
+    def close(self):
+        self.http_client.close()
+
+
+class AsyncPDFFetcher(object):
+    """asyncio pdf downloads, with the revalidation of the pdf cache of an NttExtractor
+
+    The pdf cache is read and written on the default executor of the loop, so that its disk I/O does not stall the
+    downloads in flight.
+
+    Args:
+        ntt_xtractor (NttExtractor): the extractor providing the credentials, the timeouts and the pdf cache
+    """
+
+    def __init__(self, ntt_xtractor: NttExtractor):
+        self.ntt_xtractor = ntt_xtractor
+        self._clients = {}
+
+    def _get_client(self, pdf_url):
+        parsed = urllib.parse.urlsplit(pdf_url)
+        origin = parsed.scheme + "://" + parsed.netloc
+        if origin not in self._clients:
+            self._clients[origin] = AsyncHTTPClient(origin, max_connections=self.ntt_xtractor.download_workers,
+                                                    timeout=self.ntt_xtractor.download_timeout, max_retries=0)
+        return self._clients[origin], parsed.path + ("?" + parsed.query if parsed.query else "")
+
+    async def _download(self, pdf_url, headers=None):
+        client, path = self._get_client(pdf_url)
+        request_headers = {"Authorization": self.ntt_xtractor.get_auth_header()}
+        request_headers.update(headers or {})
+        try:
+            with PDF_DOWNLOAD_SECONDS.time():
+                response = await client.request("GET", path, headers=request_headers)
+        except Exception:
+            PDF_DOWNLOAD_ERRORS.inc()
+            raise
+        PDF_DOWNLOAD_BYTES.inc(len(response.body))
+        return response
+
+    async def fetch_pdf(self, paper_id, pdf_url):
+        """get the content of a pdf, from the local cache if it is still valid or from the server otherwise
+
+        Returns:
+            tuple: the pdf content, its SHA-256 (None if no cache is configured) and the cached text extracted from
+                it (None if not available)
+        """
+        loop = asyncio.get_event_loop()
+        pdf_cache = self.ntt_xtractor.pdf_cache
+        if pdf_cache is None:
+            return (await self._download(pdf_url)).body, None, None
+        entry = await loop.run_in_executor(None, pdf_cache.get_entry, paper_id, pdf_url)
+        headers = {}
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        response = await self._download(pdf_url, headers)
+        if response.status == 304:
+            data = await loop.run_in_executor(None, pdf_cache.get_pdf, entry["sha256"])
+            if data is not None:
+                logger.debug("Cached pdf still valid: " + pdf_url)
+                PDF_CACHE_REQUESTS.inc(result="hit")
+                return data, entry["sha256"], await loop.run_in_executor(None, pdf_cache.get_text, entry["sha256"])
+            response = await self._download(pdf_url)
+        PDF_CACHE_REQUESTS.inc(result="miss")
+        content_hash = await loop.run_in_executor(None, pdf_cache.put_pdf, paper_id, pdf_url, response.body,
+                                                  response.headers.get("etag"), response.headers.get("last-modified"))
+        return response.body, content_hash, await loop.run_in_executor(None, pdf_cache.get_text, content_hash)
+
+    async def iter_fulltexts(self, paper_ids: list, db_manager: DBManager, queue_size: int = DEFAULT_PDF_QUEUE_SIZE):
+        """extract the fulltext of a list of papers, downloading their pdfs concurrently and feeding them to a pool of
+        parse processes through a bounded queue
+
+        Up to download_workers downloads are in flight, and downloads pause when queue_size pdfs are waiting for a
+        parse process, so that the memory used by the downloaded pdfs stays bounded. The pdfs are parsed on a
+        ParsePool, which terminates a process exceeding parse_timeout, and the pool is closed without waiting for the
+        parses in progress when the generator is closed.
+
+        Args:
+            paper_ids (list): the ids of the papers
+            db_manager (DBManager): the db manager used to resolve the pdf locations
+            queue_size (int): optional, the maximum number of downloaded pdfs waiting to be parsed
+        Returns:
+            async generator: an ExtractionResult for each paper, as soon as all its pdfs are processed
+        """
+        loop = asyncio.get_event_loop()
+        unique_ids = list(dict.fromkeys(paper_ids))
+        paper_pdf_urls = await loop.run_in_executor(None, db_manager.get_paper_pdf_paths, unique_ids)
+        pdf_texts = {}
+        pending_pdfs = {}
+        errors = {}
+        pdfs_to_fetch = []
+        for paper_id in unique_ids:
+            pdf_urls = paper_pdf_urls.get(paper_id, [])
+            if not pdf_urls:
+                yield ExtractionResult(paper_id, None, "no pdf available")
+                continue
+            pending_pdfs[paper_id] = len(pdf_urls)
+            pdf_texts[paper_id] = [None] * len(pdf_urls)
+            pdfs_to_fetch.extend((paper_id, pdf_idx, pdf_url) for pdf_idx, pdf_url in enumerate(pdf_urls))
+        if not pdfs_to_fetch:
+            return
+        download_slots = asyncio.Semaphore(self.ntt_xtractor.download_workers)
+        pdf_queue = asyncio.Queue(maxsize=queue_size)
+        # (paper_id, pdf_idx, text, error) of the pdfs processed
+        done_queue = asyncio.Queue()
+
+        async def download(paper_id, pdf_idx, pdf_url):
+            try:
+                try:
+                    pdf_data, content_hash, cached_text = await self.fetch_pdf(paper_id, pdf_url)
+                except Exception as e:
+                    await done_queue.put((paper_id, pdf_idx, None, "download of " + pdf_url + " failed: " + str(e)))
+                    return
+                if cached_text is not None:
+                    await done_queue.put((paper_id, pdf_idx, cached_text, None))
+                else:
+                    # the download slot is held until a parse process is available
+                    await pdf_queue.put((paper_id, pdf_idx, pdf_url, pdf_data, content_hash))
+            finally:
+                download_slots.release()
+
+        async def produce():
+            for paper_id, pdf_idx, pdf_url in pdfs_to_fetch:
+                await download_slots.acquire()
+                downloads.add(asyncio.ensure_future(download(paper_id, pdf_idx, pdf_url)))
+                downloads.difference_update([task for task in downloads if task.done()])
+
+        async def consume():
+            while True:
+                paper_id, pdf_idx, pdf_url, pdf_data, content_hash = await pdf_queue.get()
+                text = None
+                error = None
+                try:
+                    text, num_failed_pages, parse_time = await loop.run_in_executor(parse_threads, parse_pool.parse,
+                                                                                    pdf_data)
+                    PDF_PARSE_SECONDS.observe(parse_time)
+                    if content_hash is not None:
+                        await loop.run_in_executor(None, self.ntt_xtractor.pdf_cache.put_text, content_hash, text)
+                    if num_failed_pages:
+                        PDF_PARSE_FAILED_PAGES.inc(num_failed_pages)
+                        error = str(num_failed_pages) + " pages of " + pdf_url + " could not be parsed"
+                except TimeoutError:
+                    error = "parsing of " + pdf_url + " timed out"
+                except Exception as e:
+                    error = "parsing of " + pdf_url + " failed: " + str(e)
+                await done_queue.put((paper_id, pdf_idx, text, error))
+
+        downloads = set()
+        parse_pool = ParsePool(self.ntt_xtractor.parse_workers, self.ntt_xtractor.parse_timeout)
+        # one thread per parse process, each blocked in parse() while its pdf is parsed
+        parse_threads = ThreadPoolExecutor(max_workers=parse_pool.num_workers)
+        try:
+            # one consumer per parse process, so that a pdf is submitted only when a process is available
+            workers = [asyncio.ensure_future(produce())] + [
+                asyncio.ensure_future(consume()) for _ in range(parse_pool.num_workers)]
+            done_task = None
+            try:
+                while pending_pdfs:
+                    if done_task is None:
+                        done_task = asyncio.ensure_future(done_queue.get())
+                    await asyncio.wait([done_task] + [worker for worker in workers if not worker.done()],
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    for worker in workers:
+                        if worker.done() and not worker.cancelled() and worker.exception() is not None:
+                            raise worker.exception()
+                    if not done_task.done():
+                        continue
+                    paper_id, pdf_idx, text, error = done_task.result()
+                    done_task = None
+                    pdf_texts[paper_id][pdf_idx] = text
+                    if error:
+                        errors.setdefault(paper_id, []).append(error)
+                    pending_pdfs[paper_id] -= 1
+                    if pending_pdfs[paper_id] == 0:
+                        del pending_pdfs[paper_id]
+                        texts = [text for text in pdf_texts.pop(paper_id) if text is not None]
+                        paper_errors = errors.pop(paper_id, [])
+                        result = ExtractionResult(paper_id, "\n".join(texts) if texts else None,
+                                                  "; ".join(paper_errors) if paper_errors else None)
+                        if result.error:
+                            logger.warning("Errors extracting text for paper " + paper_id + ": " + result.error)
+                        yield result
+            finally:
+                tasks = workers + list(downloads) + ([done_task] if done_task is not None else [])
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # the parses in progress fail as soon as their process is terminated, nothing waits for them. The parses
+            # waiting for a thread were cancelled with the consumers awaiting them
+            parse_pool.close()
+            parse_threads.shutdown(wait=False)
+
+    def close(self):
+        for client in self._clients.values():
+            client.close()
+
+
+class AsyncEngine(object):
+    """asyncio engine for the batch pipeline of the command line
+
+    The index is built with concurrent index batches, the sentences of the papers are fetched from Textpresso and
+    their pdfs downloaded with bounded numbers of requests in flight, and the downloaded pdfs are fed to a pool of
+    parse processes. The engine runs its own event loop and exposes the same synchronous interface as the threaded
+    implementation: the loop runs while the caller waits for the next result.
+
+    Args:
+        tpc_manager (TPCManager): the Textpresso manager providing the queries, the cache and the rate limit
+        max_in_flight (int): optional, the maximum number of requests to Textpresso in flight
+        batches_in_flight (int): optional, the maximum number of index batches resolved at the same time
+        pdf_queue_size (int): optional, the maximum number of downloaded pdfs waiting to be parsed
+    """
+
+    def __init__(self, tpc_manager: TPCManager, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                 batches_in_flight: int = DEFAULT_BATCHES_IN_FLIGHT, pdf_queue_size: int = DEFAULT_PDF_QUEUE_SIZE):
+        self.loop = asyncio.new_event_loop()
+        self.tpc_manager = AsyncTPCManager(tpc_manager, max_in_flight)
+        self.batches_in_flight = batches_in_flight
+        self.pdf_queue_size = pdf_queue_size
+        self._pdf_fetchers = {}
+
+    def _iter_async(self, async_gen):
+        try:
+            while True:
+                try:
+                    result = self.loop.run_until_complete(async_gen.__anext__())
+                except StopAsyncIteration:
+                    return
+                yield result
+        finally:
+            self.loop.run_until_complete(async_gen.aclose())
+
+    def build_index(self, variations: list, planner: QueryPlanner = None, checkpoint: Checkpoint = None,
+                    previous_postings: dict = None):
+        """resolve each variation to the documents mentioning it, see VariationIndex.build_async"""
+        return self.loop.run_until_complete(VariationIndex.build_async(
+            self.tpc_manager, variations, planner, checkpoint, previous_postings, self.batches_in_flight))
+
+    def resolve_docs(self, variations: list, planner: QueryPlanner = None, checkpoint: Checkpoint = None):
+        """get the documents mentioning any of the variations, see VariationIndex.resolve_docs_async"""
+        return self.loop.run_until_complete(VariationIndex.resolve_docs_async(
+            self.tpc_manager, variations, planner, checkpoint, self.batches_in_flight))
+
+    def iter_doc_fulltexts(self, accessions: list):
+        """fetch the indexed sentences of a list of documents, with the interface of TPCManager.iter_doc_fulltexts
+
+        Returns:
+            generator: (accession, fulltext) tuples, in input order. fulltext is None if the document could not be
+                fetched
+        """
+        async def fetch(accession):
+            return accession, await self.tpc_manager.get_doc_fulltext(accession)
+        return self._iter_async(imap_ordered(fetch, accessions, self.tpc_manager.max_in_flight))
+
+    def get_fulltexts_from_paper_ids(self, ntt_xtractor: NttExtractor, paper_ids: list, db_manager: DBManager):
+        """extract the fulltext of a list of papers from their pdfs, with the interface of
+        NttExtractor.get_fulltexts_from_paper_ids
+
+        Returns:
+            generator: an ExtractionResult for each paper, not in input order
+        """
+        if id(ntt_xtractor) not in self._pdf_fetchers:
+            self._pdf_fetchers[id(ntt_xtractor)] = AsyncPDFFetcher(ntt_xtractor)
+        return self._iter_async(self._pdf_fetchers[id(ntt_xtractor)].iter_fulltexts(paper_ids, db_manager,
+                                                                                     self.pdf_queue_size))
+
+    def close(self):
+        self.tpc_manager.close()
+        for pdf_fetcher in self._pdf_fetchers.values():
+            pdf_fetcher.close()
+        # let the transports of the closed connections shut down
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
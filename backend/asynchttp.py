@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import ssl
+import urllib.parse
+from collections import namedtuple
+
+from backend.httpclient import HTTPError, RETRY_STATUSES
+from backend.metrics import HTTP_RETRIES
+
+logger = logging.getLogger(__name__)
+
+
+Response = namedtuple("Response", ["status", "reason", "headers", "body"])
+
+MAX_REDIRECTS = 5
+
+
+class _Connection(object):
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    def is_usable(self):
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncHTTPClient(object):
+    """asyncio keep-alive HTTP/1.1 client that reuses a bounded set of connections to a single host
+
+    The number of connections bounds the number of requests in flight: a request waits for a free connection before
+    being sent. Idle connections are reused in LIFO order. Only the features of HTTP/1.1 used by Textpresso and by the
+    pdf server are supported: Content-Length and chunked bodies, and bodies delimited by the end of the connection.
+    Redirects are followed up to MAX_REDIRECTS times as long as they stay on the host of the client.
+
+    Args:
+        base_url (str): the scheme, host, port and base path of the requests
+        max_connections (int): optional, the maximum number of connections, i.e. of requests in flight
+        timeout (float): optional, the timeout of each attempt of a request, in seconds
+        max_retries (int): optional, the number of times a request is retried on connection errors, timeouts and 5xx
+            responses
+        backoff_factor (float): optional, the delay before the first retry, in seconds. It doubles at each retry
+        verify_tls (bool): optional, whether to verify the certificate of https servers
+    """
+
+    def __init__(self, base_url, max_connections: int = 8, timeout: float = 60, max_retries: int = 3,
+                 backoff_factor: float = 0.5, verify_tls: bool = True):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        self.base_path = parsed.path.rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_connections = max_connections
+        self.verify_tls = verify_tls
+        self._idle = []
+        # created on first use, so that it is bound to the loop running the requests
+        self._slots = None
+
+    async def _open_connection(self):
+        ssl_context = None
+        if self.scheme == "https":
+            ssl_context = ssl.create_default_context() if self.verify_tls else ssl._create_unverified_context()
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=ssl_context)
+        return _Connection(reader, writer)
+
+    async def _read_body(self, reader: asyncio.StreamReader, headers: dict):
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0].strip(), 16)
+                if size == 0:
+                    # trailers, up to the empty line
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    return b"".join(chunks), True
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+        if "content-length" in headers:
+            return await reader.readexactly(int(headers["content-length"])), True
+        return await reader.read(), False
+
+    async def _exchange(self, conn: _Connection, method, url, body, headers):
+        request_headers = {"Host": self.host if self.port in (80, 443) else self.host + ":" + str(self.port),
+                           "Connection": "keep-alive", "Content-Length": str(len(body or b""))}
+        request_headers.update(headers or {})
+        head = method + " " + url + " HTTP/1.1\r\n" + "".join(name + ": " + str(value) + "\r\n" for name, value in
+                                                             request_headers.items()) + "\r\n"
+        conn.writer.write(head.encode('latin-1') + (body or b""))
+        await conn.writer.drain()
+        status_line = await conn.reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed by the server")
+        version, status, reason = (status_line.decode('latin-1').rstrip("\r\n").split(" ", 2) + [""])[:3]
+        response_headers = {}
+        while True:
+            line = await conn.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+        status = int(status)
+        if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+            data, keep_alive = b"", True
+        else:
+            data, keep_alive = await self._read_body(conn.reader, response_headers)
+        connection = response_headers.get("connection", "").lower()
+        keep_alive = keep_alive and connection != "close" and (version != "HTTP/1.0" or connection == "keep-alive")
+        return Response(status, reason, response_headers, data), keep_alive
+
+    async def request(self, method, path, body=None, headers=None):
+        """send a request on a pooled connection, retrying on connection errors, timeouts and 5xx responses
+
+        Args:
+            method (str): the HTTP method
+            path (str): the path relative to the base url of the client, with its query string
+            body (bytes): optional, the request body
+            headers (dict): optional, the request headers
+        Returns:
+            Response: the status, reason, lowercase headers and body of the response
+        Raises:
+            HTTPError: if the server answers with an error status, with a redirect that cannot be followed or if the
+                retries are exhausted
+        """
+        url = self.base_path + path
+        for _ in range(MAX_REDIRECTS + 1):
+            response = await self._send(method, url, body, headers)
+            if not 300 <= response.status < 400 or response.status == 304:
+                return response
+            location = response.headers.get("location")
+            target = urllib.parse.urlsplit(urllib.parse.urljoin(url, location)) if location else None
+            # the connections of the client are bound to its host
+            if target is None or target.netloc and (target.scheme, target.hostname, target.port or (
+                    443 if target.scheme == "https" else 80)) != (self.scheme, self.host, self.port):
+                raise HTTPError(response.status, response.reason, response.body)
+            url = (target.path or "/") + ("?" + target.query if target.query else "")
+            if (response.status == 303 and method != "HEAD") or (response.status in (301, 302) and method == "POST"):
+                method, body = "GET", None
+        raise HTTPError(response.status, "too many redirects", response.body)
+
+    async def _send(self, method, url, body, headers):
+        """send a request with the url of its request line, retrying on connection errors, timeouts and 5xx
+        responses"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        attempt = 0
+        while True:
+            async with self._slots:
+                conn = None
+                while self._idle and conn is None:
+                    conn = self._idle.pop()
+                    if not conn.is_usable():
+                        conn.close()
+                        conn = None
+                try:
+                    if conn is None:
+                        conn = await asyncio.wait_for(self._open_connection(), self.timeout)
+                    response, keep_alive = await asyncio.wait_for(self._exchange(conn, method, url, body, headers),
+                                                                  self.timeout)
+                    if keep_alive:
+                        self._idle.append(conn)
+                    else:
+                        conn.close()
+                    if response.status >= 400:
+                        raise HTTPError(response.status, response.reason, response.body)
+                    return response
+                except asyncio.CancelledError:
+                    if conn is not None:
+                        conn.close()
+                    raise
+                except (HTTPError, ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, OSError,
+                        ValueError) as e:
+                    if conn is not None and not isinstance(e, HTTPError):
+                        conn.close()
+                    retriable = not isinstance(e, HTTPError) or e.status in RETRY_STATUSES
+                    if not retriable or attempt >= self.max_retries:
+                        raise
+                    error = e
+            delay = self.backoff_factor * (2 ** attempt)
+            attempt += 1
+            HTTP_RETRIES.inc(host=self.host)
+            logger.warning("Request to " + self.host + url + " failed (" + (str(error) or type(error).__name__) +
+                           "), retrying in " + str(delay) + "s")
+            await asyncio.sleep(delay)
+
+    async def post_json(self, path, payload):
+        return (await self.request("POST", path, body=payload, headers={'Content-type': 'application/json',
+                                                                        'Accept': 'application/json'})).body
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().close()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import inspect
+import io
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from backend.benchmarks.stubs import FakeCorpus, TextpressoStubServer, SMTPSinkServer, PDFStubServer, \
+    StaticPDFLocator, make_pdf
+from backend.koalleles import iter_variation_ids
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_ALLELES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir,
+                                    "ko_allelex.xml.gz")
+API_SCENARIOS = ["api:total_count", "api:vars_in_paper", "api:papers_per_var"]
+CLI_SCENARIOS = ["main:TOTAL_COUNT", "main:VAR_COUNT_IN_PAPERS", "main:PAPER_COUNT_FOR_VAR"]
+
+
+class StageTimer(object):
+    """accumulate the number of calls and the time spent in the instrumented functions
+
+    Calls running concurrently are all counted, so the time of a stage can exceed the wall time of the run.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, elapsed):
+        with self._lock:
+            calls, total = self.stages.get(stage, (0, 0.0))
+            self.stages[stage] = (calls + 1, total + elapsed)
+
+    def instrument(self, owner, attr_name, stage):
+        func = getattr(owner, attr_name)
+        is_static = isinstance(owner.__dict__.get(attr_name), staticmethod)
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed(*args, **kwargs):
+                start_time = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - start_time)
+        else:
+            @functools.wraps(func)
+            def timed(*args, **kwargs):
+                start_time = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - start_time)
+        setattr(owner, attr_name, staticmethod(timed) if is_static else timed)
+
+
+def run_api_scenario(job_type, variations, config, stage_timer: StageTimer):
+    # the api module monkey patches the standard library with gevent and sets up the app from the environment when
+    # imported, as under a wsgi server. No job worker is started, the job is run directly below
+    os.environ.update({"TPC_TOKEN": "", "EMAIL_HOST": "127.0.0.1", "EMAIL_PORT": str(config["smtp_port"]),
+                       "EMAIL_USER": "bench@localhost", "EMAIL_PASSWD": "", "JOB_WORKERS": "0",
+                       "JOBS_DB": os.path.join(config["results_dir"], "jobs.sqlite"),
+                       "RESULTS_DIR": config["results_dir"]})
+    os.makedirs(config["results_dir"], exist_ok=True)
+    from backend import api
+    from backend.emailtools import EmailManager
+    from backend.matcher import MentionMatcher
+    from backend.resultstore import ResultStore
+    from backend.tpcmanager import TPCManager
+    from backend.varindex import VariationIndex
+
+    stage_timer.instrument(VariationIndex, "build", "index_build")
+    stage_timer.instrument(VariationIndex, "resolve_docs", "index_build")
+    stage_timer.instrument(TPCManager, "_send_request", "tpc_request")
+    stage_timer.instrument(MentionMatcher, "count_total", "mention_matching")
+    stage_timer.instrument(EmailManager, "_deliver", "email")
+    tpc_manager = TPCManager("", api_base_url=config["tpc_url"], max_concurrency=config["concurrency"])
+    email_manager = EmailManager("127.0.0.1", config["smtp_port"], "bench@localhost", "", use_ssl=False)
+    result_store = ResultStore(config["results_dir"])
+    job = {"id": uuid.uuid4().hex, "type": job_type, "variations": variations, "reply_to": "user@localhost"}
+    api.run_job(job, tpc_manager, email_manager, result_store, "http://localhost")
+    # emails are sent in the background, wait for them to be delivered
+    email_manager.close()
+    with open(result_store.get_path(job["id"])) as result_file:
+        return sum(1 for _ in result_file) - 1
+
+
+def run_cli_scenario(output_type, variations, config, stage_timer: StageTimer):
+    from backend import main
+    from backend.asyncengine import AsyncEngine, AsyncTPCManager, AsyncPDFFetcher
+    from backend.fulltext import FulltextResolver
+    from backend.matcher import MentionMatcher
+    from backend.nttxtraction import NttExtractor
+    from backend.tpcmanager import TPCManager
+    from backend.varindex import VariationIndex
+
+    stage_timer.instrument(VariationIndex, "build", "index_build")
+    stage_timer.instrument(VariationIndex, "resolve_docs", "index_build")
+    stage_timer.instrument(TPCManager, "_send_request", "tpc_request")
+    stage_timer.instrument(MentionMatcher, "count_total", "mention_matching")
+    stage_timer.instrument(NttExtractor, "fetch_pdf", "pdf_download")
+    stage_timer.instrument(VariationIndex, "build_async", "index_build")
+    stage_timer.instrument(VariationIndex, "resolve_docs_async", "index_build")
+    stage_timer.instrument(AsyncTPCManager, "_send_request", "tpc_request")
+    stage_timer.instrument(AsyncPDFFetcher, "fetch_pdf", "pdf_download")
+    tpc_manager = TPCManager("", api_base_url=config["tpc_url"], max_concurrency=config["concurrency"])
+    ntt_xtractor = NttExtractor("bench", "bench", download_workers=config["concurrency"],
+                                parse_workers=config["parse_workers"])
+    engine = AsyncEngine(tpc_manager, max_in_flight=config["max_in_flight"]) if config["engine"] == "asyncio" \
+        else None
+    fulltext_resolver = FulltextResolver(tpc_manager, ntt_xtractor, StaticPDFLocator(config["pdf_dir"],
+                                                                                      config["pdf_url"]),
+                                         sources=config["fulltext_sources"], engine=engine)
+    output = io.StringIO()
+    try:
+        main.calculate_counts(output_type, variations, tpc_manager, fulltext_resolver, output, engine=engine)
+    finally:
+        if engine is not None:
+            engine.close()
+    return output.getvalue().count("\n")
+
+
+def run_scenario(scenario, config):
+    """run a single scenario in the current process and return its measurements"""
+    with open(config["variations_path"]) as variations_file:
+        variations = variations_file.read().split("\n")
+    stage_timer = StageTimer()
+    kind, name = scenario.split(":")
+    start_time = time.perf_counter()
+    if kind == "api":
+        num_rows = run_api_scenario(name, variations, config, stage_timer)
+    else:
+        num_rows = run_cli_scenario(name, variations, config, stage_timer)
+    wall_time = time.perf_counter() - start_time
+    # ru_maxrss is in kilobytes on linux
+    return {"wall_time": wall_time, "num_rows": num_rows, "stages": stage_timer.stages,
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "children_peak_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+
+
+def seed_pdfs(corpus: FakeCorpus, variations: list, pdf_dir: str):
+    """write a pdf for each document of the corpus mentioning at least one of the variations
+
+    Returns:
+        int: the number of pdfs written
+    """
+    doc_mentions = {}
+    for variation in variations:
+        for doc_num in corpus.docs_for_keyword(variation):
+            doc_mentions.setdefault(doc_num, []).append(variation)
+    for doc_num, mentions in doc_mentions.items():
+        with open(os.path.join(pdf_dir, corpus.accession(doc_num)[-8:] + ".pdf"), "wb") as pdf_file:
+            pdf_file.write(make_pdf("\n".join(corpus.sentences(doc_num, mentions))))
+    return len(doc_mentions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the api jobs and the command line output modes end to end "
+                                                 "against local stand-ins of Textpresso, tazendra and the mail server")
+    parser.add_argument("-s", "--scenarios", dest="scenarios", nargs="+", choices=API_SCENARIOS + CLI_SCENARIOS,
+                        default=API_SCENARIOS + CLI_SCENARIOS)
+    parser.add_argument("-a", "--alleles-file", dest="alleles_file", type=str, default=DEFAULT_ALLELES_FILE,
+                        help="knockout alleles report providing the variation ids used as entities")
+    parser.add_argument("-n", "--num-variations", dest="num_variations", type=int, default=2000)
+    parser.add_argument("-d", "--num-docs", dest="num_docs", type=int, default=20000)
+    parser.add_argument("--hit-ratio", dest="hit_ratio", type=float, default=0.05,
+                        help="fraction of the variations mentioned in at least one document")
+    parser.add_argument("-l", "--latency", dest="latency", type=float, default=0.02,
+                        help="artificial latency of each request to the Textpresso stub, in seconds")
+    parser.add_argument("--pdf-latency", dest="pdf_latency", type=float, default=0.02,
+                        help="artificial latency of each pdf download, in seconds")
+    parser.add_argument("--missing-fulltext-ratio", dest="missing_fulltext_ratio", type=float, default=0.1,
+                        help="fraction of the documents whose sentences are not available from Textpresso")
+    parser.add_argument("-f", "--fulltext-sources", dest="fulltext_sources", nargs="+",
+                        choices=["textpresso", "pdf"], default=["textpresso", "pdf"],
+                        help="sources of the fulltext of the papers for the VAR_COUNT_IN_PAPERS mode")
+    parser.add_argument("-c", "--concurrency", dest="concurrency", type=int, default=8)
+    parser.add_argument("-e", "--engine", dest="engine", choices=["threads", "asyncio"], default="threads",
+                        help="engine of the command line scenarios")
+    parser.add_argument("--max-in-flight", dest="max_in_flight", type=int, default=32,
+                        help="maximum number of requests to Textpresso in flight with the asyncio engine")
+    parser.add_argument("--parse-workers", dest="parse_workers", type=int, default=None)
+    parser.add_argument("--run-scenario", dest="run_scenario", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--config", dest="config", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("-L", "--log-level", dest="log_level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR',
+                                                                        'CRITICAL'], default="WARNING")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(name)s - %(levelname)s:%(message)s')
+
+    if args.run_scenario:
+        print(json.dumps(run_scenario(args.run_scenario, json.loads(args.config))))
+        return
+
+    variations = []
+    for variation in iter_variation_ids(args.alleles_file):
+        if len(variations) >= args.num_variations:
+            break
+        variations.append(variation)
+    corpus = FakeCorpus(num_docs=args.num_docs, hit_ratio=args.hit_ratio,
+                        missing_fulltext_ratio=args.missing_fulltext_ratio)
+    with tempfile.TemporaryDirectory() as work_dir:
+        pdf_dir = os.path.join(work_dir, "pdfs")
+        os.makedirs(pdf_dir)
+        num_pdfs = seed_pdfs(corpus, variations, pdf_dir)
+        variations_path = os.path.join(work_dir, "variations.txt")
+        with open(variations_path, "w") as variations_file:
+            variations_file.write("\n".join(variations))
+        print("variations=" + str(len(variations)), "pdfs=" + str(num_pdfs), sep="\t")
+        with TextpressoStubServer(corpus, latency=args.latency) as tpc_server, SMTPSinkServer() as smtp_server, \
+                PDFStubServer(pdf_dir, latency=args.pdf_latency) as pdf_server:
+            config = {"tpc_url": tpc_server.base_url, "smtp_port": smtp_server.port, "pdf_dir": pdf_dir,
+                      "pdf_url": pdf_server.base_url, "results_dir": os.path.join(work_dir, "results"),
+                      "variations_path": variations_path, "concurrency": args.concurrency,
+                      "parse_workers": args.parse_workers, "fulltext_sources": args.fulltext_sources,
+                      "engine": args.engine, "max_in_flight": args.max_in_flight}
+            for scenario in args.scenarios:
+                tpc_requests_before = tpc_server.num_requests
+                pdf_requests_before = pdf_server.num_requests
+                emails_before = len(smtp_server.messages)
+                # each scenario runs in a fresh interpreter, so that gevent patching and peak memory are not shared
+                process = subprocess.run([sys.executable, "-m", "backend.benchmarks.e2e", "--run-scenario", scenario,
+                                          "--config", json.dumps(config), "-L", args.log_level],
+                                         stdout=subprocess.PIPE, universal_newlines=True)
+                if process.returncode != 0:
+                    print(scenario, "failed", sep="\t")
+                    continue
+                result = json.loads(process.stdout.strip().split("\n")[-1])
+                print(scenario, "time=" + "{:.2f}s".format(result["wall_time"]), "rows=" + str(result["num_rows"]),
+                      "tpc_requests=" + str(tpc_server.num_requests - tpc_requests_before),
+                      "pdf_requests=" + str(pdf_server.num_requests - pdf_requests_before),
+                      "emails=" + str(len(smtp_server.messages) - emails_before),
+                      "peak_rss=" + "{:.1f}MB".format(result["peak_rss_kb"] / 1024),
+                      "children_peak_rss=" + "{:.1f}MB".format(result["children_peak_rss_kb"] / 1024), sep="\t")
+                for stage, (calls, total) in sorted(result["stages"].items()):
+                    print("", stage, "calls=" + str(calls), "time=" + "{:.2f}s".format(total), sep="\t")
+
+
+if __name__ == '__main__':
+    main()
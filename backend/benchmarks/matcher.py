@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import argparse
+import random
+import time
+
+from backend.matcher import MentionMatcher
+
+
+def generate_texts(variations: list, num_texts: int, text_len: int, mentions_per_text: int, seed: int = 0):
+    rnd = random.Random(seed)
+    words = ["the", "mutant", "allele", "worms", "were", "analyzed", "and", "showed", "a", "defect", "in", "(", ")"]
+    texts = []
+    for _ in range(num_texts):
+        tokens = []
+        length = 0
+        while length < text_len:
+            token = rnd.choice(variations) if rnd.random() < mentions_per_text * 5 / text_len else rnd.choice(words)
+            tokens.append(token)
+            length += len(token) + 1
+        texts.append(" ".join(tokens))
+    return texts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the mention matcher with per-variation str.count")
+    parser.add_argument("-v", "--num-variations", dest="num_variations", type=int, default=10000)
+    parser.add_argument("-n", "--num-texts", dest="num_texts", type=int, default=20)
+    parser.add_argument("-s", "--text-length", dest="text_length", type=int, default=50000)
+    parser.add_argument("-m", "--mentions-per-text", dest="mentions_per_text", type=int, default=50)
+    args = parser.parse_args()
+
+    variations = ["ok" + str(i) for i in range(args.num_variations)]
+    texts = generate_texts(variations, args.num_texts, args.text_length, args.mentions_per_text)
+
+    start_time = time.perf_counter()
+    naive_counts = [sum([fulltext.count(var) for var in variations]) for fulltext in texts]
+    naive_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    matcher = MentionMatcher(variations)
+    compile_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    matcher_counts = [matcher.count_total(fulltext) for fulltext in texts]
+    matcher_time = time.perf_counter() - start_time
+
+    print("str.count", "{:.3f}s".format(naive_time), "mentions=" + str(sum(naive_counts)), sep="\t")
+    print("matcher", "{:.3f}s".format(matcher_time), "mentions=" + str(sum(matcher_counts)),
+          "compile={:.3f}s".format(compile_time), sep="\t")
+    print("speedup", "{:.1f}x".format(naive_time / (matcher_time + compile_time)), sep="\t")
+
+
+if __name__ == '__main__':
+    main()
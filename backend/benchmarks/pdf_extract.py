@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+import argparse
+import io
+import os
+import random
+import re
+import time
+
+import PyPDF2 as PyPDF2
+from PyPDF2.generic import TextStringObject
+from PyPDF2.pdf import ContentStream, b_, FloatObject, NumberObject
+from PyPDF2.utils import u_
+
+from backend.benchmarks.stubs import make_pdf
+from backend.matcher import MentionMatcher
+from backend.nttxtraction import custom_extract_text, extract_text_from_pdf, iter_text_from_pdf
+
+
+def legacy_custom_extract_text(page):
+    # the previous implementation, kept as baseline
+    text = u_("")
+    content = page["/Contents"].getObject()
+    if not isinstance(content, ContentStream):
+        content = ContentStream(content, page.pdf)
+    for operands, operator in content.operations:
+        if operator == b_("Tj"):
+            _text = operands[0]
+            if isinstance(_text, TextStringObject):
+                text += _text
+        elif operator == b_("T*"):
+            text += "\n"
+        elif operator == b_("'"):
+            text += "\n"
+            _text = operands[0]
+            if isinstance(_text, TextStringObject):
+                text += operands[0]
+        elif operator == b_('"'):
+            _text = operands[2]
+            if isinstance(_text, TextStringObject):
+                text += "\n"
+                text += _text
+        elif operator == b_("TJ"):
+            for i in operands[0]:
+                if isinstance(i, TextStringObject):
+                    text += i
+                elif isinstance(i, FloatObject) or isinstance(i, NumberObject):
+                    if i < -100:
+                        text += " "
+        elif operator == b_("TD") or operator == b_("Tm"):
+            if len(text) > 0 and text[-1] != " " and text[-1] != "\n":
+                text += " "
+    text = text.replace(" - ", "-")
+    text = re.sub("\\s+", " ", text)
+    return text
+
+
+def legacy_extract_text_from_pdf(pdf_data: bytes):
+    pdf_reader = PyPDF2.PdfFileReader(io.BytesIO(pdf_data))
+    pages_text = []
+    num_failed_pages = 0
+    for i in range(pdf_reader.numPages):
+        try:
+            pages_text.append(legacy_custom_extract_text(pdf_reader.getPage(i)))
+        except Exception:
+            num_failed_pages += 1
+    return "".join(pages_text), num_failed_pages
+
+
+def count_mentions_in_pdf(pdf_data: bytes, matcher: MentionMatcher, max_count: int = None):
+    """count the mentions in a pdf file page by page, stopping as soon as max_count mentions are found, e.g. 1 to only
+    check whether the pdf mentions any of the patterns"""
+    num_mentions = 0
+    for page_text in iter_text_from_pdf(pdf_data):
+        if page_text:
+            num_mentions += matcher.count_total(page_text)
+            if max_count is not None and num_mentions >= max_count:
+                return max_count
+    return num_mentions
+
+
+class _ParsedPage(object):
+    """page whose content stream is already parsed, to time the extraction of the text alone"""
+
+    def __init__(self, page):
+        self.content = ContentStream(page["/Contents"].getObject(), page.pdf)
+        self.pdf = page.pdf
+
+    def __getitem__(self, key):
+        return self
+
+    def getObject(self):
+        return self.content
+
+
+def generate_pdfs(variations: list, num_pdfs: int, num_pages: int, lines_per_page: int, mention_page: int,
+                  seed: int = 0):
+    """generate pdfs mentioning one variation on the given page, so that early exit stops there"""
+    rnd = random.Random(seed)
+    words = ["the", "mutant", "allele", "worms", "were", "analyzed", "and", "showed", "a", "defect", "in", "-"]
+    pdfs = []
+    for _ in range(num_pdfs):
+        pages = []
+        for page_num in range(num_pages):
+            lines = [" ".join(rnd.choice(words) for _ in range(12)) for _ in range(lines_per_page)]
+            if page_num == mention_page:
+                lines[0] += " " + rnd.choice(variations)
+            pages.append("\n".join(lines))
+        pdfs.append(make_pdf(pages))
+    return pdfs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the pdf text extractor with the previous implementation")
+    parser.add_argument("-p", "--pdf-dir", dest="pdf_dir", type=str, default=None,
+                        help="directory of real pdfs to use instead of generated ones")
+    parser.add_argument("-n", "--num-pdfs", dest="num_pdfs", type=int, default=20)
+    parser.add_argument("-g", "--num-pages", dest="num_pages", type=int, default=15)
+    parser.add_argument("-l", "--lines-per-page", dest="lines_per_page", type=int, default=60)
+    parser.add_argument("-m", "--mention-page", dest="mention_page", type=int, default=2,
+                        help="page of the generated pdfs mentioning a variation")
+    parser.add_argument("-v", "--num-variations", dest="num_variations", type=int, default=10000)
+    args = parser.parse_args()
+
+    variations = ["ok" + str(i) for i in range(args.num_variations)]
+    if args.pdf_dir:
+        pdfs = []
+        for filename in sorted(os.listdir(args.pdf_dir)):
+            if filename.lower().endswith(".pdf"):
+                with open(os.path.join(args.pdf_dir, filename), "rb") as pdf_file:
+                    pdfs.append(pdf_file.read())
+    else:
+        pdfs = generate_pdfs(variations, args.num_pdfs, args.num_pages, args.lines_per_page, args.mention_page)
+
+    start_time = time.perf_counter()
+    legacy_texts = [legacy_extract_text_from_pdf(pdf_data) for pdf_data in pdfs]
+    legacy_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    texts = [extract_text_from_pdf(pdf_data) for pdf_data in pdfs]
+    new_time = time.perf_counter() - start_time
+    if texts != legacy_texts:
+        print("WARNING: the extracted texts differ from the previous implementation")
+
+    pdf_readers = [PyPDF2.PdfFileReader(io.BytesIO(pdf_data)) for pdf_data in pdfs]
+    pages = [_ParsedPage(pdf_reader.getPage(i)) for pdf_reader in pdf_readers for i in range(pdf_reader.numPages)]
+    start_time = time.perf_counter()
+    for page in pages:
+        legacy_custom_extract_text(page)
+    legacy_operators_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    for page in pages:
+        custom_extract_text(page)
+    operators_time = time.perf_counter() - start_time
+
+    matcher = MentionMatcher(variations)
+    start_time = time.perf_counter()
+    full_hits = sum(1 for text, _ in texts if matcher.count_total(text) > 0)
+    full_time = new_time + time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    early_hits = sum(1 for pdf_data in pdfs if count_mentions_in_pdf(pdf_data, matcher, max_count=1) > 0)
+    early_exit_time = time.perf_counter() - start_time
+
+    print("pdfs=" + str(len(pdfs)), "pages=" + str(len(pages)), sep="\t")
+    print("extraction", "legacy={:.3f}s".format(legacy_time), "new={:.3f}s".format(new_time),
+          "speedup={:.2f}x".format(legacy_time / new_time), sep="\t")
+    print("operators", "legacy={:.3f}s".format(legacy_operators_time), "new={:.3f}s".format(operators_time),
+          "speedup={:.2f}x".format(legacy_operators_time / operators_time), sep="\t")
+    print("presence", "full={:.3f}s".format(full_time), "early_exit={:.3f}s".format(early_exit_time),
+          "hits=" + str(full_hits) + "/" + str(early_hits), "speedup={:.2f}x".format(full_time / early_exit_time),
+          sep="\t")
+
+
+if __name__ == '__main__':
+    main()
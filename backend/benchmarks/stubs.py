@@ -0,0 +1,331 @@
+import hashlib
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+
+class FakeCorpus(object):
+    """deterministic synthetic corpus: each keyword is mentioned by a pseudo-random subset of the documents
+
+    The fulltext of a document is made of one sentence for each of the keywords queried so far that mention it. A
+    fraction `missing_fulltext_ratio` of the documents has no fulltext available.
+    """
+
+    def __init__(self, num_docs: int = 5000, max_docs_per_keyword: int = 50, hit_ratio: float = 0.3,
+                 missing_fulltext_ratio: float = 0.0):
+        self.num_docs = num_docs
+        self.max_docs_per_keyword = max_docs_per_keyword
+        self.hit_ratio = hit_ratio
+        self.missing_fulltext_ratio = missing_fulltext_ratio
+        self._cache = {}
+        self._query_cache = {}
+        self._doc_keywords = {}
+
+    def identifier(self, doc_num):
+        return "C. elegans/doc" + str(doc_num)
+
+    def accession(self, doc_num):
+        return "Other:WBPaper" + str(doc_num).zfill(8)
+
+    def docs_for_keyword(self, keyword):
+        if keyword not in self._cache:
+            digest = int(hashlib.md5(keyword.encode('utf-8')).hexdigest(), 16)
+            if (digest % 1000) / 1000 >= self.hit_ratio:
+                docs = []
+            else:
+                num_docs = 1 + (digest >> 10) % self.max_docs_per_keyword
+                docs = sorted({(digest >> (16 + i)) * (i + 1) % self.num_docs for i in range(num_docs)})
+            self._cache[keyword] = docs
+            for doc_num in docs:
+                self._doc_keywords.setdefault(doc_num, []).append(keyword)
+        return self._cache[keyword]
+
+    def docs_for_query(self, keywords):
+        if keywords not in self._query_cache:
+            matches = {}
+            for keyword in keywords.split(" "):
+                if keyword:
+                    for doc_num in self.docs_for_keyword(keyword):
+                        matches.setdefault(doc_num, []).append(keyword)
+            self._query_cache[keywords] = sorted(matches.items())
+        return self._query_cache[keywords]
+
+    def sentences(self, doc_num, keywords):
+        return ["The " + keyword + " allele was analyzed in paper " + str(doc_num) + "." for keyword in keywords]
+
+    def fulltext_sentences(self, doc_num):
+        """get all the sentences of a document, or None if its fulltext is not available"""
+        if int(hashlib.md5(str(doc_num).encode('utf-8')).hexdigest(), 16) % 1000 < self.missing_fulltext_ratio * 1000:
+            return None
+        return self.sentences(doc_num, self._doc_keywords.get(doc_num, []))
+
+
+class _StubServer(object):
+    """common lifecycle of the stub servers, served on a background thread"""
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class _TextpressoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, without this delayed acks add tens of ms to each request
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_POST(self):
+        server = self.server
+        with server.stats_lock:
+            server.num_requests += 1
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+        if server.latency:
+            time.sleep(server.latency)
+        query = body.get("query", {})
+        if self.path.endswith("/get_documents_count"):
+            result = len(server.corpus.docs_for_query(query.get("keywords", "")))
+        elif self.path.endswith("/search_documents"):
+            if "accession" in query:
+                doc_num = int(query["accession"][-8:])
+                sentences = server.corpus.fulltext_sentences(doc_num)
+                result = [] if sentences is None else [{
+                    "identifier": server.corpus.identifier(doc_num), "accession": server.corpus.accession(doc_num),
+                    "title": "Paper " + str(doc_num), "all_sentences": sentences}]
+            else:
+                start = int(query.get("since_num", body.get("since_num", 0)))
+                count = int(query.get("count", body.get("count", 200)))
+                result = []
+                for doc_num, keywords in server.corpus.docs_for_query(query.get("keywords", ""))[start:start + count]:
+                    doc = {"identifier": server.corpus.identifier(doc_num),
+                           "accession": server.corpus.accession(doc_num), "title": "Paper " + str(doc_num)}
+                    if body.get("include_match_sentences"):
+                        doc["matched_sentences"] = server.corpus.sentences(doc_num, keywords)
+                    result.append(doc)
+        else:
+            self.send_error(404)
+            return
+        data = json.dumps(result).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class TextpressoStubServer(_StubServer):
+    """local stand-in for the Textpresso Central search and count endpoints
+
+    Args:
+        corpus (FakeCorpus): the synthetic corpus to serve
+        latency (float): optional, seconds of artificial delay added to each request
+        port (int): optional, port to bind. A free port is chosen if not provided
+    """
+
+    def __init__(self, corpus: FakeCorpus = None, latency: float = 0.0, port: int = 0):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), _TextpressoHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.corpus = corpus or FakeCorpus()
+        self.httpd.latency = latency
+        self.httpd.num_requests = 0
+        self.httpd.stats_lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:" + str(self.httpd.server_address[1])
+
+    @property
+    def num_requests(self):
+        return self.httpd.num_requests
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+
+    def _reply(self, line):
+        self.wfile.write((line + "\r\n").encode('ascii'))
+
+    def handle(self):
+        self._reply("220 localhost SMTP sink")
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self.wfile.write(b"250-localhost\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n")
+            elif verb == "HELO":
+                self._reply("250 localhost")
+            elif verb == "AUTH":
+                self._reply("235 Authentication successful")
+            elif verb == "MAIL":
+                recipients = []
+                self._reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command.split(":", 1)[1].strip(" <>"))
+                self._reply("250 OK")
+            elif verb == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line == b".\r\n":
+                        break
+                    size += len(data_line)
+                with self.server.stats_lock:
+                    self.server.messages.append({"recipients": recipients, "size": size})
+                self._reply("250 OK")
+            elif verb == "QUIT":
+                self._reply("221 Bye")
+                break
+            else:
+                self._reply("250 OK")
+
+
+class SMTPSinkServer(_StubServer):
+    """local SMTP server accepting any login and recording the size and recipients of the messages it receives
+
+    Args:
+        port (int): optional, port to bind. A free port is chosen if not provided
+    """
+
+    def __init__(self, port: int = 0):
+        self.httpd = socketserver.ThreadingTCPServer(("127.0.0.1", port), _SMTPHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.messages = []
+        self.httpd.stats_lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    @property
+    def messages(self):
+        return self.httpd.messages
+
+
+def _escape_pdf_string(text: str):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_pdf(pages):
+    """build a minimal pdf showing the given text, laid out as in typical generated pdfs: one TJ operation per line
+    with kerned words and a TD operation moving to the next line
+
+    Args:
+        pages: the text of the pdf as a string for a single page or as a list with the text of each page
+    Returns:
+        bytes: the content of the pdf file
+    """
+    if isinstance(pages, str):
+        pages = [pages]
+    num_pages = len(pages)
+    # objects 1 and 2 are the catalog and the page tree, 3 the font, then a page and its content stream for each page
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>",
+               b"<< /Type /Pages /Kids [" + " ".join(str(4 + 2 * i) + " 0 R" for i in range(num_pages)).encode(
+                   'ascii') + b"] /Count " + str(num_pages).encode('ascii') + b" >>",
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    for page_num, page_text in enumerate(pages):
+        content = ("BT /F1 10 Tf 50 750 Td " + " ".join(
+            "[" + " -250 ".join("(" + _escape_pdf_string(word) + ")" for word in line.split(" ")) + "] TJ 0 -12 TD"
+            for line in page_text.split("\n")) + " ET").encode('latin-1')
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents " +
+                       str(5 + 2 * page_num).encode('ascii') + b" 0 R /Resources << /Font << /F1 3 0 R >> >> >>")
+        objects.append(b"<< /Length " + str(len(content)).encode('ascii') + b" >>\nstream\n" + content +
+                       b"\nendstream")
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for num, obj in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += str(num).encode('ascii') + b" 0 obj\n" + obj + b"\nendobj\n"
+    xref_offset = len(pdf)
+    pdf += b"xref\n0 " + str(len(objects) + 1).encode('ascii') + b"\n0000000000 65535 f \n"
+    for offset in offsets:
+        pdf += ("%010d 00000 n \n" % offset).encode('ascii')
+    pdf += b"trailer\n<< /Size " + str(len(objects) + 1).encode('ascii') + b" /Root 1 0 R >>\nstartxref\n" + \
+        str(xref_offset).encode('ascii') + b"\n%%EOF\n"
+    return pdf
+
+
+class _PDFHandler(SimpleHTTPRequestHandler):
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        with self.server.stats_lock:
+            self.server.num_requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        super().do_GET()
+
+
+class PDFStubServer(_StubServer):
+    """static server standing in for tazendra, serving the pdfs of a directory
+
+    Args:
+        pdf_dir (str): the directory containing the pdfs
+        latency (float): optional, seconds of artificial delay added to each request
+        port (int): optional, port to bind. A free port is chosen if not provided
+    """
+
+    def __init__(self, pdf_dir: str, latency: float = 0.0, port: int = 0):
+        self.pdf_dir = pdf_dir
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port),
+                                         lambda *args: _PDFHandler(*args, directory=pdf_dir))
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency
+        self.httpd.num_requests = 0
+        self.httpd.stats_lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:" + str(self.httpd.server_address[1]) + "/"
+
+    @property
+    def num_requests(self):
+        return self.httpd.num_requests
+
+    def get_locator(self):
+        return StaticPDFLocator(self.pdf_dir, self.base_url)
+
+
+class StaticPDFLocator(object):
+    """stand-in for the pdf lookups of DBManager, mapping each paper to the pdf named after it in a directory
+
+    Args:
+        pdf_dir (str): the directory containing the pdfs
+        base_url (str): the url the directory is served at
+    """
+
+    def __init__(self, pdf_dir: str, base_url: str):
+        self.pdf_dir = pdf_dir
+        self.base_url = base_url
+
+    def get_paper_pdf_paths(self, paper_ids: list):
+        return {paper_id: [self.base_url + paper_id + ".pdf"] for paper_id in paper_ids if
+                os.path.exists(os.path.join(self.pdf_dir, paper_id + ".pdf"))}
+
+    def get_paper_pdf_path(self, paper_id):
+        return self.get_paper_pdf_paths([paper_id]).get(paper_id, [])
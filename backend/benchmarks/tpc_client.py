@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import time
+
+from backend.benchmarks.stubs import FakeCorpus, TextpressoStubServer
+from backend.tpcmanager import TPCManager
+
+
+def fetch_all_docids(tpc_manager: TPCManager, keywords: list):
+    return tpc_manager.get_all_pages(tpc_manager.get_docid_matching, keywords)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Textpresso client against a local stub server")
+    parser.add_argument("-n", "--num-keywords", dest="num_keywords", type=int, default=2000)
+    parser.add_argument("-d", "--num-docs", dest="num_docs", type=int, default=20000)
+    parser.add_argument("-l", "--latency", dest="latency", type=float, default=0.05,
+                        help="artificial latency of each request to the stub server, in seconds")
+    parser.add_argument("-c", "--concurrency", dest="concurrency", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("-L", "--log-level", dest="log_level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR',
+                                                                        'CRITICAL'], default="WARNING")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(name)s - %(levelname)s:%(message)s')
+
+    keywords = ["ok" + str(i) for i in range(args.num_keywords)]
+    with TextpressoStubServer(FakeCorpus(num_docs=args.num_docs), latency=args.latency) as server:
+        for concurrency in args.concurrency:
+            tpc_manager = TPCManager("", api_base_url=server.base_url, max_concurrency=concurrency)
+            requests_before = server.num_requests
+            start_time = time.perf_counter()
+            doc_ids = fetch_all_docids(tpc_manager, keywords)
+            elapsed = time.perf_counter() - start_time
+            tpc_manager.http_client.close()
+            print("concurrency=" + str(concurrency), "docs=" + str(len(set(doc_ids))),
+                  "requests=" + str(server.num_requests - requests_before), "time=" + "{:.2f}s".format(elapsed),
+                  sep="\t")
+
+
+if __name__ == '__main__':
+    main()
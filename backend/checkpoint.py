@@ -0,0 +1,171 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+
+RunState = namedtuple("RunState", ["postings", "paper_counts", "variations", "docs"])
+
+
+def load_completed_run(path):
+    """load the results recorded in the checkpoint of a completed run, to be updated by a delta run
+
+    Args:
+        path (str): the path of the checkpoint file
+    Returns:
+        RunState: the postings of the variations resolved one by one, the recorded paper counts (dict), the variations
+            of the run (list) and the accession of each document found by the run (dict)
+    Raises:
+        ValueError: if the run did not complete
+    """
+    conn = sqlite3.connect("file:" + path + "?mode=ro", uri=True)
+    try:
+        row = conn.execute("SELECT value FROM checkpoint_meta WHERE name = 'completed'").fetchone()
+        if row is None or not row[0]:
+            raise ValueError("The run recorded in " + path + " did not complete")
+        postings = {variation: [tuple(doc) for doc in json.loads(docs)] for variation, docs in
+                    conn.execute("SELECT variation, docs FROM postings")}
+        paper_counts = dict(conn.execute("SELECT paper_id, count FROM paper_counts"))
+        row = conn.execute("SELECT value FROM checkpoint_meta WHERE name = 'variation_list'").fetchone()
+        variations = json.loads(row[0]) if row is not None else list(postings)
+        docs = {identifier: accession for batch_docs in conn.execute("SELECT docs FROM batch_docs") for
+                identifier, accession in json.loads(batch_docs[0])}
+        docs.update((identifier, accession) for posting in postings.values() for identifier, accession in posting)
+    except sqlite3.Error as e:
+        raise ValueError("Cannot read the checkpoint " + path + ": " + str(e))
+    finally:
+        conn.close()
+    logger.info("Loaded previous run from " + path + ": " + str(len(postings)) + " variations, " +
+                str(len(paper_counts)) + " paper counts")
+    return RunState(postings, paper_counts, variations, docs)
+
+
+class Checkpoint(object):
+    """persistent SQLite record of the progress of a command line run, so that an interrupted run can be resumed
+
+    The checkpoint stores the documents found for each completed index batch, for each of its variations when they
+    are resolved one by one or for the whole batch otherwise, and the number of mentions counted in each paper. It is
+    bound to the list of variations of the run that created it. Once the run is marked as complete, the checkpoint is
+    the record of its results used by the next delta run.
+
+    Args:
+        path (str): the path of the SQLite database file
+        variations (list): the variations of the run
+        restart (bool): optional, discard the progress recorded by previous runs
+    Raises:
+        ValueError: if the checkpoint was created for a different list of variations and restart is False
+    """
+
+    def __init__(self, path, variations: list, restart: bool = False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS checkpoint_meta (name TEXT PRIMARY KEY, value TEXT)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS postings (variation TEXT PRIMARY KEY, docs TEXT NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS batch_docs (variations TEXT NOT NULL, docs TEXT NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS paper_counts (paper_id TEXT PRIMARY KEY, "
+                           "count INTEGER NOT NULL)")
+        self.variations = sorted(set(variations))
+        fingerprint = hashlib.sha256(json.dumps(self.variations).encode('utf-8')).hexdigest()
+        row = self._conn.execute("SELECT value FROM checkpoint_meta WHERE name = 'variations'").fetchone()
+        if row is not None and row[0] != fingerprint and not restart:
+            raise ValueError("Checkpoint " + path + " was created for a different list of variations")
+        if row is None or restart:
+            self.reset(fingerprint)
+        else:
+            logger.info("Resuming from checkpoint " + path + ": " + str(self.get_num_postings()) +
+                        " variations and " + str(self.get_num_batch_docs()) + " batches resolved, " +
+                        str(self.get_num_paper_counts()) + " papers counted")
+
+    def reset(self, fingerprint: str):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM postings")
+            self._conn.execute("DELETE FROM batch_docs")
+            self._conn.execute("DELETE FROM paper_counts")
+            self._conn.execute("INSERT OR REPLACE INTO checkpoint_meta (name, value) VALUES ('variations', ?)",
+                               (fingerprint,))
+            self._conn.execute("INSERT OR REPLACE INTO checkpoint_meta (name, value) VALUES ('variation_list', ?)",
+                               (json.dumps(self.variations),))
+            self._conn.execute("DELETE FROM checkpoint_meta WHERE name = 'completed'")
+            self._conn.execute("COMMIT")
+
+    def mark_complete(self):
+        """record that the run completed, so that its results can be used by later delta runs"""
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO checkpoint_meta (name, value) VALUES ('completed', ?)",
+                               (time.strftime("%Y-%m-%dT%H:%M:%S"),))
+
+    def get_postings(self):
+        """get the recorded postings
+
+        Returns:
+            dict: the (identifier, accession) tuples of the documents mentioning each resolved variation
+        """
+        with self._lock:
+            return {variation: [tuple(doc) for doc in json.loads(docs)] for variation, docs in
+                    self._conn.execute("SELECT variation, docs FROM postings")}
+
+    def save_postings(self, postings: list):
+        """record the postings of a completed batch in a single transaction
+
+        Args:
+            postings (list): (variation, list of (identifier, accession) tuples) tuples
+        """
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR REPLACE INTO postings (variation, docs) VALUES (?, ?)",
+                                   ((variation, json.dumps(docs)) for variation, docs in postings))
+            self._conn.execute("COMMIT")
+
+    def get_batch_docs(self):
+        """get the recorded documents of the batches resolved as a whole
+
+        Returns:
+            list: (variations of the batch, list of (identifier, accession) tuples) tuples
+        """
+        with self._lock:
+            return [(json.loads(variations), [tuple(doc) for doc in json.loads(docs)]) for variations, docs in
+                    self._conn.execute("SELECT variations, docs FROM batch_docs ORDER BY rowid")]
+
+    def save_batch_docs(self, batch: list, docs: list):
+        """record the documents matching any of the variations of a completed batch
+
+        Args:
+            batch (list): the variations of the batch
+            docs (list): the (identifier, accession) tuples of the documents
+        """
+        with self._lock:
+            self._conn.execute("INSERT INTO batch_docs (variations, docs) VALUES (?, ?)",
+                               (json.dumps(batch), json.dumps(docs)))
+
+    def get_num_batch_docs(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM batch_docs").fetchone()[0]
+
+    def get_num_postings(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM postings").fetchone()[0]
+
+    def get_paper_counts(self):
+        """get the recorded number of mentions of each paper, in the order they were recorded"""
+        with self._lock:
+            return self._conn.execute("SELECT paper_id, count FROM paper_counts ORDER BY rowid").fetchall()
+
+    def save_paper_count(self, paper_id: str, count: int):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO paper_counts (paper_id, count) VALUES (?, ?)",
+                               (paper_id, count))
+
+    def get_num_paper_counts(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM paper_counts").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
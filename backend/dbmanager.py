@@ -1,63 +1,144 @@
 import logging
-import re
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
 
 import psycopg2 as psycopg2
-import urllib.request
-import html
-import base64
+from psycopg2 import extensions
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 from urllib.parse import quote
 
+from backend.metrics import DB_QUERY_SECONDS
+
 
 TAZENDRA_PDFS_LOCATION = "http://tazendra.caltech.edu/~acedb/daniel/"
+MAX_ARRAY_PARAM_SIZE = 10000
 
 
 logger = logging.getLogger(__name__)
 
 
+def _gevent_wait_callback(conn, timeout=None):
+    """psycopg2 wait callback yielding to the gevent hub while waiting for the server"""
+    from gevent.socket import wait_read, wait_write
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError("Bad result from poll: %r" % state)
+
+
+def _make_green_if_gevent():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return
+    if monkey.is_module_patched("socket") and extensions.get_wait_callback() is None:
+        extensions.set_wait_callback(_gevent_wait_callback)
+
+
+def get_tazendra_pdf_url(path):
+    pdf_addr = path.replace('/home/acedb/daniel/Reference/wb/pdf/', TAZENDRA_PDFS_LOCATION).replace(
+        '/home/acedb/daniel/Reference/pubmed/pdf/', TAZENDRA_PDFS_LOCATION).replace(
+        '/home/acedb/daniel/Reference/pubmed/libpdf/', TAZENDRA_PDFS_LOCATION)
+    if 'Reference/cgc/' in pdf_addr:
+        pdf_addr = TAZENDRA_PDFS_LOCATION + '/' + pdf_addr.split('/')[-1]
+    return pdf_addr
+
+
 class DBManager(object):
 
-    def __init__(self, dbname, user, password, host):
-        connection_str = "dbname='" + dbname
+    def __init__(self, dbname, user, password, host, min_connections: int = 1, max_connections: int = 10):
+        _make_green_if_gevent()
+        connection_params = {"dbname": dbname, "host": host}
         if user:
-            connection_str += "' user='" + user
+            connection_params["user"] = user
         if password:
-            connection_str += "' password='" + password
-        connection_str += "' host='" + host + "'"
-        self.conn = psycopg2.connect(connection_str)
-        self.cur = self.conn.cursor()
+            connection_params["password"] = password
+        self.pool = ThreadedConnectionPool(min_connections, max_connections, **connection_params)
+        # the pool raises an error when exhausted, the semaphore makes callers wait for a free connection instead
+        self._available_connections = threading.BoundedSemaphore(max_connections)
 
     def close(self):
-        self.conn.commit()
-        self.cur.close()
-        self.conn.close()
+        self.pool.closeall()
+
+    @contextmanager
+    def _cursor(self):
+        with self._available_connections:
+            conn = self.pool.getconn()
+            try:
+                with conn.cursor() as cur:
+                    yield cur
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self.pool.putconn(conn)
+
+    def _select_by_keys(self, query_name, query, key_column, keys: list):
+        """run a query restricted to the rows whose key column is in a list of keys
+
+        Short lists are passed as an array parameter. Long ones are inserted into an analyzed temporary table joined
+        with the query, which gives the planner the size of the list and avoids huge query strings. The keys are
+        inserted with INSERT rather than COPY, which psycopg2 rejects when a wait callback is set, e.g. under gevent.
+        The time of the query, including the wait for a free connection, is recorded under query_name.
+
+        Args:
+            query_name (str): the name of the query in the metrics
+            query (str): the SELECT and FROM clauses of the query
+            key_column (str): the column matched against the keys
+            keys (list): the keys to select
+        Returns:
+            list: the rows
+        """
+        with DB_QUERY_SECONDS.time(query=query_name), self._cursor() as cur:
+            if len(keys) <= MAX_ARRAY_PARAM_SIZE:
+                cur.execute(query + " WHERE " + key_column + " = ANY(%s)", (list(keys),))
+            else:
+                cur.execute("CREATE TEMP TABLE tmp_keys (key TEXT PRIMARY KEY) ON COMMIT DROP")
+                execute_values(cur, "INSERT INTO tmp_keys (key) VALUES %s", [(key,) for key in dict.fromkeys(keys)],
+                               page_size=MAX_ARRAY_PARAM_SIZE)
+                cur.execute("ANALYZE tmp_keys")
+                cur.execute(query + " JOIN tmp_keys ON " + key_column + " = tmp_keys.key")
+            return cur.fetchall()
 
     def get_variation_names_from_ids(self, ids: list):
-        self.cur.execute("SELECT obo_name_variation FROM obo_name_variation WHERE joinkey IN ('{}')"
-            .format("','".join(ids)))
-        rows = self.cur.fetchall()
-        var_names = [row[0] for row in rows]
-        return set(var_names)
+        rows = self._select_by_keys("variation_names", "SELECT obo_name_variation FROM obo_name_variation", "joinkey",
+                                    ids)
+        return set(row[0] for row in rows)
 
-    def get_paper_pdf_path(self, paper_id):
-        def get_tazendra_pdf_url(path):
-            pdf_addr = path.replace('/home/acedb/daniel/Reference/wb/pdf/', TAZENDRA_PDFS_LOCATION).replace(
-                '/home/acedb/daniel/Reference/pubmed/pdf/', TAZENDRA_PDFS_LOCATION).replace(
-                '/home/acedb/daniel/Reference/pubmed/libpdf/', TAZENDRA_PDFS_LOCATION)
-            if 'Reference/cgc/' in pdf_addr:
-                pdf_addr = TAZENDRA_PDFS_LOCATION + '/' + pdf_addr.split('/')[-1]
-            return pdf_addr
-        self.cur.execute("SELECT pap_electronic_path FROM pap_electronic_path WHERE joinkey = '{}'".format(paper_id))
-        rows = self.cur.fetchall()
-        main_pdfs = []
-        additional_pdfs = []
-        for row in rows:
-            if row[0].endswith(".pdf") and "supplemental" not in row[0]:
-                if "_temp" in row[0] or "_ocr" in row[0] or "_lib" in row[0]:
-                    additional_pdfs.append(get_tazendra_pdf_url(quote(row[0])))
+    def get_variation_names_by_id(self, ids: list):
+        rows = self._select_by_keys("variation_names", "SELECT joinkey, obo_name_variation FROM obo_name_variation",
+                                    "joinkey", ids)
+        return {row[0]: row[1] for row in rows}
+
+    def get_paper_pdf_paths(self, paper_ids: list):
+        """get the urls of the pdfs of a list of papers with a single query
+
+        Args:
+            paper_ids (list): the ids of the papers
+        Returns:
+            dict: the list of pdf urls of each paper. Main pdfs are returned if available, additional ones (temp,
+                ocr, lib) otherwise. Papers without pdfs are not included
+        """
+        main_pdfs = defaultdict(list)
+        additional_pdfs = defaultdict(list)
+        for paper_id, path in self._select_by_keys("paper_pdf_paths", "SELECT joinkey, pap_electronic_path "
+                                                   "FROM pap_electronic_path", "joinkey", paper_ids):
+            if path.endswith(".pdf") and "supplemental" not in path:
+                if "_temp" in path or "_ocr" in path or "_lib" in path:
+                    additional_pdfs[paper_id].append(get_tazendra_pdf_url(quote(path)))
                 else:
-                    main_pdfs.append(get_tazendra_pdf_url(quote(row[0])))
-        if main_pdfs:
-            return main_pdfs
-        else:
-            return additional_pdfs
+                    main_pdfs[paper_id].append(get_tazendra_pdf_url(quote(path)))
+        return {paper_id: main_pdfs.get(paper_id) or additional_pdfs[paper_id] for paper_id in
+                set(main_pdfs) | set(additional_pdfs)}
 
+    def get_paper_pdf_path(self, paper_id):
+        return self.get_paper_pdf_paths([paper_id]).get(paper_id, [])
@@ -0,0 +1,85 @@
+import logging
+from array import array
+
+logger = logging.getLogger(__name__)
+
+
+PAPER_ID_LENGTH = 8
+
+
+def format_paper_accession(accession: str):
+    return accession.strip(" ").replace("Other:", "").replace("\\", "")
+
+
+def get_paper_id(accession: str):
+    """get the WBPaper id of a Textpresso accession, i.e. its last 8 characters"""
+    return accession[-PAPER_ID_LENGTH:]
+
+
+class DocRegistry(object):
+    """interning registry of the Textpresso documents and of the papers they belong to
+
+    Each document identifier is mapped once to a dense integer, its document number, and each WBPaper id to a paper
+    number, so that result sets can be stored as arrays of unsigned ints instead of sets of strings. The accession and
+    the paper of a document are stored once, at the position of its number, and the paper id is parsed only once per
+    document. Documents sharing the same paper id belong to the same paper, which is represented by the last of them
+    to be registered, as the paper id -> accession dicts this registry replaces did.
+    """
+
+    def __init__(self):
+        self.identifiers = []
+        self.accessions = []
+        self.doc_papers = array('I')
+        self.paper_ids = []
+        self.paper_last_docs = array('I')
+        self._doc_nums = {}
+        self._paper_nums = {}
+
+    def __len__(self):
+        return len(self.identifiers)
+
+    def intern(self, identifier, accession: str):
+        """get the number of a document, registering it if needed
+
+        Args:
+            identifier: the Textpresso identifier of the document
+            accession (str): the Textpresso accession of the document
+        Returns:
+            int: the document number
+        """
+        doc_num = self._doc_nums.get(identifier)
+        if doc_num is None:
+            doc_num = len(self.identifiers)
+            self._doc_nums[identifier] = doc_num
+            self.identifiers.append(identifier)
+            self.accessions.append(accession)
+            paper_id = get_paper_id(accession)
+            paper_num = self._paper_nums.get(paper_id)
+            if paper_num is None:
+                paper_num = len(self.paper_ids)
+                self._paper_nums[paper_id] = paper_num
+                self.paper_ids.append(paper_id)
+                self.paper_last_docs.append(doc_num)
+            else:
+                self.paper_last_docs[paper_num] = doc_num
+            self.doc_papers.append(paper_num)
+        return doc_num
+
+    def get_doc_num(self, identifier):
+        """get the number of a registered document, None if it is not registered"""
+        return self._doc_nums.get(identifier)
+
+    def get_doc(self, doc_num: int):
+        """get the (identifier, accession) tuple of a document"""
+        return self.identifiers[doc_num], self.accessions[doc_num]
+
+    def get_num_papers(self):
+        return len(self.paper_ids)
+
+    def get_paper_num(self, paper_id: str):
+        """get the number of a paper from its WBPaper id, None if no registered document belongs to it"""
+        return self._paper_nums.get(paper_id)
+
+    def get_paper_accession(self, paper_num: int):
+        """get the formatted accession of a paper, from the last document registered for it"""
+        return format_paper_accession(self.accessions[self.paper_last_docs[paper_num]])
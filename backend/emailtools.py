@@ -1,39 +1,207 @@
+import gzip
+import io
 import logging
+import os
+import queue
 import smtplib
+import threading
+import time
 import urllib.parse
 
+from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from typing import List
 from urllib.request import urlopen
 
+from backend.metrics import EMAIL_SEND_SECONDS, EMAIL_ERRORS, EMAIL_RETRIES
+
 
 logger = logging.getLogger(__name__)
 
 
+# files whose size exceeds this ratio times the maximum size of an attachment are not compressed at all
+MAX_COMPRESSION_RATIO = 20
+
+
+def gzip_attachment(path, filename: str = None, max_size: int = None, chunk_size: int = 1024 * 1024):
+    """compress a file to be sent as an email attachment
+
+    The file is read and compressed by chunks, and the compression stops as soon as the compressed content exceeds
+    max_size, so that at most max_size bytes are held in memory.
+
+    Args:
+        path (str): the path of the file
+        filename (str): optional, the name of the attachment, without the .gz extension. The name of the file if not
+            provided
+        max_size (int): optional, the maximum size of the compressed content, in bytes
+        chunk_size (int): optional, the size of the chunks read from the file, in bytes
+    Returns:
+        tuple: the name of the attachment and its gzipped content, None if it would be larger than max_size
+    """
+    if max_size is not None and os.path.getsize(path) > max_size * MAX_COMPRESSION_RATIO:
+        return None
+    compressed = io.BytesIO()
+    with open(path, "rb") as attached_file, gzip.GzipFile(fileobj=compressed, mode="wb") as gzip_file:
+        for chunk in iter(lambda: attached_file.read(chunk_size), b""):
+            gzip_file.write(chunk)
+            if max_size is not None and compressed.tell() > max_size:
+                return None
+    if max_size is not None and compressed.tell() > max_size:
+        return None
+    return (filename or os.path.basename(path)) + ".gz", compressed.getvalue()
+
+
+def gzip_text_attachment(text: str, filename: str, max_size: int = None):
+    """compress a text to be sent as an email attachment
+
+    Args:
+        text (str): the text, encoded as utf-8
+        filename (str): the name of the attachment, without the .gz extension
+        max_size (int): optional, the maximum size of the compressed content, in bytes
+    Returns:
+        tuple: the name of the attachment and its gzipped content, None if it would be larger than max_size
+    """
+    content = gzip.compress(text.encode('utf-8'))
+    if max_size is not None and len(content) > max_size:
+        return None
+    return filename + ".gz", content
+
+
 class EmailManager(object):
+    """send emails from a background worker, reusing an authenticated SMTP session across messages
+
+    Messages are queued by `send_email`, which returns immediately. The worker sends them on a single session, which
+    is opened on demand, re-opened when the server drops it and closed after `idle_timeout` seconds without messages.
+    Failed messages are retried with exponential backoff and dropped with an error after `max_retries` retries.
 
-    def __init__(self, email_host, email_port, email_user, email_passwd):
+    Args:
+        email_host (str): the SMTP server host
+        email_port (int): the SMTP server port
+        email_user (str): the login, also used as sender address
+        email_passwd (str): the password
+        use_ssl (bool): optional, whether to connect with SMTP over SSL
+        max_retries (int): optional, the maximum number of times a message is retried
+        backoff_factor (float): optional, the delay before the first retry, in seconds. It doubles at each retry
+        idle_timeout (float): optional, the time after which an unused session is closed, in seconds
+    """
+
+    def __init__(self, email_host, email_port, email_user, email_passwd, use_ssl: bool = True, max_retries: int = 5,
+                 backoff_factor: float = 2.0, idle_timeout: float = 60):
+        self.use_ssl = use_ssl
         self.email_user = email_user
         self.server_host = email_host
         self.server_port = email_port
         self.email_passwd = email_passwd
         self.from_addr = email_user
         self.reply_to_addr = email_user
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.idle_timeout = idle_timeout
+        self._queue = queue.Queue()
+        self._session = None
+        self._worker = None
+        self._worker_lock = threading.Lock()
 
-    def send_email(self, subject, content, recipient):
+    def _build_message(self, subject, content, recipient, attachments: List[tuple] = None):
         body = MIMEText(content, "html")
-        msg = MIMEMultipart('alternative')
-        msg.attach(body)
+        if attachments:
+            msg = MIMEMultipart('mixed')
+            msg.attach(body)
+            for filename, data in attachments:
+                attachment = MIMEApplication(data, "gzip" if filename.endswith(".gz") else "octet-stream")
+                attachment.add_header("Content-Disposition", "attachment", filename=filename)
+                msg.attach(attachment)
+        else:
+            msg = MIMEMultipart('alternative')
+            msg.attach(body)
         msg['Subject'] = subject
         msg['From'] = self.from_addr
         msg['reply-to'] = self.reply_to_addr
         msg['To'] = recipient
-        try:
-            server_ssl = smtplib.SMTP_SSL(self.server_host, self.server_port)
-            server_ssl.login(self.email_user, self.email_passwd)
-            server_ssl.send_message(msg)
-            logger.info("Email sent to: " + recipient)
-            server_ssl.quit()
-        except:
-            logger.fatal("Can't connect to smtp server. Email not sent.")
+        return msg
+
+    def send_email(self, subject, content, recipient, attachments: List[tuple] = None):
+        """queue an email to be sent by the background worker
+
+        Args:
+            subject (str): the subject
+            content (str): the html body
+            recipient (str): the address of the recipient
+            attachments (List[tuple]): optional, the (filename, content) tuples of the files to attach
+        """
+        self._queue.put(self._build_message(subject, content, recipient, attachments))
+        self._ensure_worker()
+
+    def _ensure_worker(self):
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run_worker, daemon=True)
+                self._worker.start()
+
+    def _open_session(self):
+        if self.use_ssl:
+            session = smtplib.SMTP_SSL(self.server_host, self.server_port)
+        else:
+            session = smtplib.SMTP(self.server_host, self.server_port)
+        session.login(self.email_user, self.email_passwd)
+        return session
+
+    def _close_session(self):
+        if self._session is not None:
+            try:
+                self._session.quit()
+            except (smtplib.SMTPException, OSError):
+                self._session.close()
+            self._session = None
+
+    def _deliver(self, msg):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with EMAIL_SEND_SECONDS.time():
+                    if self._session is None:
+                        self._session = self._open_session()
+                    self._session.send_message(msg)
+                logger.info("Email sent to: " + msg['To'])
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                # the session may be unusable after an error, the next attempt starts a new one
+                self._close_session()
+                if isinstance(e, smtplib.SMTPRecipientsRefused) or attempt == self.max_retries:
+                    EMAIL_ERRORS.inc()
+                    logger.error("Email to " + msg['To'] + " not sent: " + str(e))
+                    return
+                delay = self.backoff_factor * (2 ** attempt)
+                EMAIL_RETRIES.inc()
+                logger.warning("Sending email to " + msg['To'] + " failed (" + str(e) + "), retrying in " +
+                               str(delay) + "s")
+                time.sleep(delay)
+
+    def _run_worker(self):
+        while True:
+            try:
+                msg = self._queue.get(timeout=self.idle_timeout if self._session is not None else None)
+            except queue.Empty:
+                self._close_session()
+                continue
+            if msg is None:
+                self._close_session()
+                self._queue.task_done()
+                return
+            try:
+                self._deliver(msg)
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """wait until all the queued emails have been sent or dropped"""
+        self._queue.join()
+
+    def close(self):
+        """send the queued emails, then stop the worker and close the session"""
+        with self._worker_lock:
+            worker = self._worker
+            self._worker = None
+        if worker is not None and worker.is_alive():
+            self._queue.put(None)
+            worker.join()
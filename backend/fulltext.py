@@ -0,0 +1,128 @@
+import gzip
+import logging
+import os
+import threading
+from collections import namedtuple
+
+from backend.dbmanager import DBManager
+from backend.metrics import FULLTEXT_SOURCE
+from backend.nttxtraction import NttExtractor
+from backend.tpcmanager import TPCManager
+
+logger = logging.getLogger(__name__)
+
+
+SOURCE_CACHE = "cache"
+SOURCE_TEXTPRESSO = "textpresso"
+SOURCE_PDF = "pdf"
+FULLTEXT_SOURCES = [SOURCE_CACHE, SOURCE_TEXTPRESSO, SOURCE_PDF]
+
+
+FulltextResult = namedtuple("FulltextResult", ["paper_id", "text", "source", "error"])
+
+
+class TextCache(object):
+    """local cache of the fulltext of the papers, stored as one gzipped file per paper
+
+    Args:
+        cache_dir (str): the directory where the texts are stored
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, paper_id):
+        return os.path.join(self.cache_dir, os.path.basename(str(paper_id)) + ".txt.gz")
+
+    def get(self, paper_id):
+        try:
+            with gzip.open(self._path(paper_id), "rt", encoding="utf-8") as text_file:
+                return text_file.read()
+        except (OSError, EOFError):
+            return None
+
+    def put(self, paper_id, text: str):
+        path = self._path(paper_id)
+        tmp_path = path + ".tmp" + str(threading.get_ident())
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as text_file:
+            text_file.write(text)
+        os.replace(tmp_path, path)
+
+
+class FulltextResolver(object):
+    """get the fulltext of papers from the cheapest source available
+
+    The sources are tried in the given order for the papers still missing a text: the local text cache, the
+    sentences indexed by Textpresso, fetched concurrently, and the pdfs, downloaded and parsed. Texts obtained from
+    Textpresso or from the pdfs are stored in the text cache.
+
+    Args:
+        tpc_manager (TPCManager): the Textpresso manager used to fetch the indexed sentences
+        ntt_xtractor (NttExtractor): the extractor used to get the text of the pdfs
+        db_manager (DBManager): the db manager used to resolve the pdf locations
+        text_cache (TextCache): optional, the local text cache
+        sources (list): optional, the sources to use, in order of preference
+        engine (AsyncEngine): optional, the asyncio engine fetching the sentences and the pdfs instead of the thread
+            pools of the Textpresso manager and of the extractor
+    """
+
+    def __init__(self, tpc_manager: TPCManager, ntt_xtractor: NttExtractor, db_manager: DBManager,
+                 text_cache: TextCache = None, sources: list = None, engine=None):
+        self.tpc_manager = tpc_manager
+        self.ntt_xtractor = ntt_xtractor
+        self.db_manager = db_manager
+        self.text_cache = text_cache
+        self.sources = sources if sources is not None else FULLTEXT_SOURCES
+        self.engine = engine
+
+    def _found(self, paper_id, text, source, error=None):
+        FULLTEXT_SOURCE.inc(source=source)
+        if self.text_cache is not None and source != SOURCE_CACHE:
+            self.text_cache.put(paper_id, text)
+        return FulltextResult(paper_id, text, source, error)
+
+    def iter_fulltexts(self, paper_accessions: dict):
+        """get the fulltext of a list of papers
+
+        Args:
+            paper_accessions (dict): the Textpresso accession of each paper id
+        Returns:
+            generator: a FulltextResult for each paper, not in input order. text is None if no source could provide
+                it and error describes the failures, if any
+        """
+        missing = dict(paper_accessions)
+        for source in self.sources:
+            if not missing:
+                break
+            if source == SOURCE_CACHE and self.text_cache is not None:
+                for paper_id in list(missing):
+                    text = self.text_cache.get(paper_id)
+                    if text:
+                        del missing[paper_id]
+                        yield self._found(paper_id, text, source)
+            elif source == SOURCE_TEXTPRESSO:
+                paper_ids = list(missing)
+                iter_doc_fulltexts = self.engine.iter_doc_fulltexts if self.engine is not None else \
+                    self.tpc_manager.iter_doc_fulltexts
+                for paper_id, (accession, text) in zip(paper_ids, iter_doc_fulltexts(
+                        [missing[paper_id] for paper_id in paper_ids])):
+                    if text:
+                        del missing[paper_id]
+                        yield self._found(paper_id, text, source)
+            elif source == SOURCE_PDF:
+                if self.engine is not None:
+                    results = self.engine.get_fulltexts_from_paper_ids(self.ntt_xtractor, list(missing),
+                                                                       self.db_manager)
+                else:
+                    results = self.ntt_xtractor.get_fulltexts_from_paper_ids(list(missing), self.db_manager)
+                for result in results:
+                    del missing[result.paper_id]
+                    if result.text:
+                        yield self._found(result.paper_id, result.text, source, result.error)
+                    else:
+                        FULLTEXT_SOURCE.inc(source="none")
+                        yield FulltextResult(result.paper_id, None, None, result.error)
+        for paper_id in missing:
+            FULLTEXT_SOURCE.inc(source="none")
+            yield FulltextResult(paper_id, None, None, "no text found in " + ", ".join(self.sources))
@@ -0,0 +1,158 @@
+import http.client
+import logging
+import queue
+import socket
+import ssl
+import time
+import urllib.parse
+from collections import deque
+
+from backend.metrics import HTTP_RETRIES
+
+logger = logging.getLogger(__name__)
+
+
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class HTTPError(Exception):
+    def __init__(self, status, reason, body=b""):
+        super().__init__("HTTP " + str(status) + " " + str(reason))
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+class PooledHTTPClient(object):
+    """keep-alive HTTP(S) client that reuses a bounded set of connections to a single host
+
+    Connections are checked out from a LIFO queue, so under gevent monkey patching waiting for a free connection
+    yields to other greenlets instead of blocking the process.
+    """
+
+    def __init__(self, base_url, max_connections: int = 8, timeout: float = 60, max_retries: int = 3,
+                 backoff_factor: float = 0.5, verify_tls: bool = True):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.base_path = parsed.path.rstrip("/")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_connections = max_connections
+        self.verify_tls = verify_tls
+        self._pool = queue.LifoQueue(maxsize=max_connections)
+        for _ in range(max_connections):
+            self._pool.put(None)
+
+    def _new_connection(self):
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout,
+                                               context=ssl.create_default_context() if self.verify_tls else
+                                               ssl._create_unverified_context())
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers=None):
+        """send a request on a pooled connection, retrying on connection errors, timeouts and 5xx responses
+
+        Args:
+            method (str): the HTTP method
+            path (str): the path relative to the base url of the client
+            body (bytes): optional, the request body
+            headers (dict): optional, the request headers
+        Returns:
+            bytes: the response body
+        Raises:
+            HTTPError: if the server answers with an error status or the retries are exhausted
+        """
+        url = self.base_path + path
+        attempt = 0
+        while True:
+            conn = self._pool.get()
+            try:
+                if conn is None:
+                    conn = self._new_connection()
+                conn.request(method, url, body=body, headers=headers or {})
+                res = conn.getresponse()
+                data = res.read()
+                if res.will_close:
+                    conn.close()
+                    conn = None
+                if res.status >= 400:
+                    raise HTTPError(res.status, res.reason, data)
+                return data
+            except (HTTPError, http.client.HTTPException, ConnectionError, socket.timeout, OSError) as e:
+                if conn is not None and not isinstance(e, HTTPError):
+                    conn.close()
+                    conn = None
+                retriable = not isinstance(e, HTTPError) or e.status in RETRY_STATUSES
+                if not retriable or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff_factor * (2 ** attempt)
+                attempt += 1
+                HTTP_RETRIES.inc(host=self.host)
+                logger.warning("Request to " + self.host + url + " failed (" + str(e) + "), retrying in " +
+                               str(delay) + "s")
+                time.sleep(delay)
+            finally:
+                self._pool.put(conn)
+
+    def post_json(self, path, payload):
+        return self.request("POST", path, body=payload, headers={'Content-type': 'application/json',
+                                                                  'Accept': 'application/json'})
+
+    def close(self):
+        for _ in range(self.max_connections):
+            conn = self._pool.get()
+            if conn is not None:
+                conn.close()
+        for _ in range(self.max_connections):
+            self._pool.put(None)
+
+
+def _is_gevent_patched():
+    try:
+        from gevent import monkey
+        return monkey.is_module_patched("threading")
+    except ImportError:
+        return False
+
+
+def imap_concurrently(func, items, concurrency: int):
+    """lazily apply func to each item with at most `concurrency` calls in flight, yielding the results in input order
+
+    Only `concurrency` results are computed ahead of the consumer, so memory stays bounded when the results are
+    consumed as a stream. Uses a gevent pool when the thread module has been monkey patched (as in the API server)
+    and a thread pool otherwise.
+    """
+    if _is_gevent_patched():
+        from gevent.pool import Pool
+        pool = Pool(concurrency)
+        submit = pool.spawn
+        get_result = lambda task: task.get()
+        shutdown = pool.kill
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        submit = executor.submit
+        get_result = lambda task: task.result()
+        shutdown = executor.shutdown
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(submit(func, item))
+            if len(pending) >= concurrency:
+                yield get_result(pending.popleft())
+        while pending:
+            yield get_result(pending.popleft())
+    finally:
+        shutdown()
+
+
+def map_concurrently(func, items, concurrency: int):
+    """apply func to each item with at most `concurrency` calls in flight and return the results in input order"""
+    items = list(items)
+    if len(items) <= 1 or concurrency <= 1:
+        return [func(item) for item in items]
+    return list(imap_concurrently(func, items, min(concurrency, len(items))))
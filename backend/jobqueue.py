@@ -0,0 +1,223 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+class JobQueue(object):
+    """persistent SQLite-backed queue of statistics jobs
+
+    Identical submissions (same type, entities and recipient) that are still queued or running are merged into a
+    single job. Jobs that were running when the process stopped are queued again by `resume`, up to
+    `max_attempts` times. Each running job records the pid of the process that claimed it, so that the jobs of a
+    process that died can be resumed while the other processes keep running theirs.
+
+    Args:
+        path (str): the path of the SQLite database file
+        max_attempts (int): optional, the maximum number of times a job is started
+    """
+
+    def __init__(self, path, max_attempts: int = 3):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.job_available = threading.Event()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, type TEXT NOT NULL, "
+                           "variations TEXT NOT NULL, reply_to TEXT NOT NULL, dedup_key TEXT NOT NULL, "
+                           "state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT, "
+                           "created REAL NOT NULL, started REAL, finished REAL)")
+        # the pid of the process that claimed the job, added to the databases created without it
+        if "worker_pid" not in {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN worker_pid INTEGER")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_dedup_key ON jobs (dedup_key)")
+
+    @staticmethod
+    def _row_to_job(row):
+        if row is None:
+            return None
+        job = dict(row)
+        job["variations"] = json.loads(job["variations"])
+        return job
+
+    def submit(self, job_type: str, variations: list, reply_to: str):
+        """add a job to the queue, unless an identical one is already queued or running
+
+        Args:
+            job_type (str): the type of statistics to calculate
+            variations (list): the entities to count
+            reply_to (str): the address to send the results to
+        Returns:
+            tuple: the id of the job and whether a new job was created
+        """
+        dedup_key = hashlib.sha256(json.dumps([job_type, variations, reply_to]).encode('utf-8')).hexdigest()
+        with self._lock:
+            # as in claim, the write lock is taken before reading, so that processes sharing the queue cannot both
+            # insert the same job
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT id FROM jobs WHERE dedup_key = ? AND state IN (?, ?)",
+                                         (dedup_key, JOB_QUEUED, JOB_RUNNING)).fetchone()
+                if row is None:
+                    job_id = uuid.uuid4().hex
+                    self._conn.execute("INSERT INTO jobs (id, type, variations, reply_to, dedup_key, state, created) "
+                                       "VALUES (?, ?, ?, ?, ?, ?, ?)", (job_id, job_type, json.dumps(variations),
+                                                                        reply_to, dedup_key, JOB_QUEUED, time.time()))
+            finally:
+                self._conn.execute("COMMIT")
+        if row is not None:
+            logger.info("Duplicate submission of job " + row["id"])
+            return row["id"], False
+        self.job_available.set()
+        logger.info("Queued job " + job_id + " of type " + job_type + " with " + str(len(variations)) + " entities")
+        return job_id, True
+
+    def claim(self):
+        """mark the oldest queued job as running by the current process and return it
+
+        Returns:
+            dict: the job, or None if the queue is empty
+        """
+        with self._lock:
+            # the write lock of the database is taken before reading, so that processes sharing the queue cannot
+            # claim the same job
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT * FROM jobs WHERE state = ? ORDER BY created LIMIT 1",
+                                         (JOB_QUEUED,)).fetchone()
+                if row is not None:
+                    self._conn.execute("UPDATE jobs SET state = ?, started = ?, attempts = attempts + 1, "
+                                       "worker_pid = ? WHERE id = ?", (JOB_RUNNING, time.time(), os.getpid(),
+                                                                       row["id"]))
+            finally:
+                self._conn.execute("COMMIT")
+        if row is None:
+            return None
+        job = self._row_to_job(row)
+        job["state"] = JOB_RUNNING
+        job["attempts"] += 1
+        job["worker_pid"] = os.getpid()
+        return job
+
+    def complete(self, job_id: str):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET state = ?, finished = ? WHERE id = ?", (JOB_DONE, time.time(), job_id))
+
+    def fail(self, job_id: str, error: str):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET state = ?, finished = ?, error = ? WHERE id = ?",
+                               (JOB_FAILED, time.time(), error, job_id))
+
+    def get(self, job_id: str):
+        with self._lock:
+            return self._row_to_job(self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def get_num_jobs(self, state: str):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (state,)).fetchone()[0]
+
+    def resume(self, worker_pid: int = None):
+        """queue again the jobs left running by a previous process, failing the ones that exceeded max_attempts
+
+        Args:
+            worker_pid (int): optional, only resume the jobs claimed by the process with this pid, e.g. a server
+                process that died. All the running jobs if not provided
+        Returns:
+            int: the number of jobs queued again
+        """
+        condition = "state = ?" if worker_pid is None else "state = ? AND worker_pid = ?"
+        params = (JOB_RUNNING,) if worker_pid is None else (JOB_RUNNING, worker_pid)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("UPDATE jobs SET state = ?, finished = ?, error = ? WHERE " + condition +
+                                   " AND attempts >= ?", (JOB_FAILED, time.time(), "interrupted too many times") +
+                                   params + (self.max_attempts,))
+                num_resumed = self._conn.execute("UPDATE jobs SET state = ?, worker_pid = NULL WHERE " + condition,
+                                                 (JOB_QUEUED,) + params).rowcount
+            finally:
+                self._conn.execute("COMMIT")
+        if num_resumed:
+            logger.info("Resumed " + str(num_resumed) + " interrupted jobs")
+            self.job_available.set()
+        return num_resumed
+
+    def close(self):
+        self._conn.close()
+
+
+class JobWorkerPool(object):
+    """fixed pool of workers executing the jobs in a JobQueue
+
+    Workers are threads, which become greenlets when the thread module is monkey patched by gevent. The number of
+    workers bounds the number of jobs running at the same time.
+
+    Args:
+        job_queue (JobQueue): the queue to consume
+        handlers (dict): the function to call for each job type. It receives the job dict and raises on failure
+        num_workers (int): optional, the number of workers
+        poll_interval (float): optional, maximum time an idle worker waits before checking the queue again
+    """
+
+    def __init__(self, job_queue: JobQueue, handlers: dict, num_workers: int = 4, poll_interval: float = 5):
+        self.job_queue = job_queue
+        self.handlers = handlers
+        self.num_workers = num_workers
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._workers = []
+
+    def _run_worker(self):
+        while not self._stop.is_set():
+            job = self.job_queue.claim()
+            if job is None:
+                self.job_queue.job_available.wait(self.poll_interval)
+                self.job_queue.job_available.clear()
+                continue
+            logger.info("Starting job " + job["id"])
+            try:
+                self.handlers[job["type"]](job)
+                self.job_queue.complete(job["id"])
+                logger.info("Completed job " + job["id"])
+            except Exception as e:
+                logger.error("Job " + job["id"] + " failed: " + str(e))
+                self.job_queue.fail(job["id"], str(e))
+
+    def start(self, resume: bool = True):
+        """start the workers
+
+        Args:
+            resume (bool): optional, queue again the jobs left running by a previous process first. Must be False when
+                other processes are consuming the same queue, as their running jobs would be started twice
+        """
+        if resume:
+            self.job_queue.resume()
+        for _ in range(self.num_workers):
+            worker = threading.Thread(target=self._run_worker, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def is_running(self):
+        return len(self._workers) == self.num_workers and all(worker.is_alive() for worker in self._workers)
+
+    def stop(self):
+        self._stop.set()
+        self.job_queue.job_available.set()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
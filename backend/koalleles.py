@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import logging
+import time
+import urllib.request
+import xml.etree.ElementTree as ElementTree
+
+from backend.dbmanager import DBManager
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_RELEASE = "WS277"
+KO_ALLELES_URL = "ftp://ftp.ebi.ac.uk/pub/databases/wormbase/releases/{release}/species/c_elegans/PRJNA13758/" \
+                 "annotation/c_elegans.PRJNA13758.{release}.knockout_consortium_alleles.xml.gz"
+SNAPSHOT_FORMAT_VERSION = "1"
+
+
+def iter_variation_ids(source: str):
+    """stream the WBVar ids of the variations in a knockout consortium alleles report, in constant memory
+
+    Args:
+        source (str): path or url of the gzipped xml report
+    Returns:
+        generator: the variation ids
+    """
+    if "://" in source:
+        stream = gzip.GzipFile(fileobj=urllib.request.urlopen(source))
+    else:
+        stream = gzip.open(source, 'rb')
+    with stream:
+        depth = 0
+        root = None
+        for event, elem in ElementTree.iterparse(stream, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+            # the variation id is the name element directly under variation, strains have names too
+            if elem.tag == "name" and depth == 2 and elem.text and elem.text.startswith("WBVar"):
+                yield elem.text.strip()
+            elif elem.tag == "variation" and depth == 1:
+                root.clear()
+
+
+def write_snapshot(path: str, id_name: dict, release: str):
+    """write a versioned snapshot of the variation id to variation name mapping
+
+    Args:
+        path (str): the path of the gzipped tsv snapshot to write
+        id_name (dict): the variation name for each WBVar id
+        release (str): the WormBase release the mapping was built from
+    """
+    with gzip.open(path, 'wt', encoding='utf-8') as f_out:
+        f_out.write("#format=" + SNAPSHOT_FORMAT_VERSION + "\trelease=" + release + "\tcreated=" +
+                    time.strftime("%Y-%m-%dT%H:%M:%S") + "\tcount=" + str(len(id_name)) + "\n")
+        for var_id, var_name in sorted(id_name.items()):
+            f_out.write(var_id + "\t" + var_name + "\n")
+
+
+def load_snapshot(path: str):
+    """load a snapshot written by write_snapshot
+
+    Args:
+        path (str): the path of the snapshot
+    Returns:
+        tuple: the metadata of the snapshot (dict) and the variation name for each WBVar id (dict)
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as f_in:
+        header = f_in.readline().lstrip("#").rstrip("\n")
+        metadata = dict(field.split("=", 1) for field in header.split("\t"))
+        if metadata.get("format") != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError("Unsupported allele snapshot format: " + str(metadata.get("format")))
+        id_name = dict(line.rstrip("\n").split("\t", 1) for line in f_in)
+    logger.info("Loaded " + str(len(id_name)) + " variation names from " + metadata.get("release", "") +
+                " snapshot")
+    return metadata, id_name
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a snapshot of the names of the knockout consortium alleles")
+    parser.add_argument("-N", "--db-name", metavar="db_name", dest="db_name", type=str)
+    parser.add_argument("-U", "--db-user", metavar="db_user", dest="db_user", type=str)
+    parser.add_argument("-P", "--db-password", metavar="db_password", dest="db_password", type=str)
+    parser.add_argument("-H", "--db-host", metavar="db_host", dest="db_host", type=str)
+    parser.add_argument("-r", "--release", metavar="release", dest="release", type=str, default=DEFAULT_RELEASE,
+                        help="WormBase release of the alleles report")
+    parser.add_argument("-s", "--source", metavar="source", dest="source", type=str, default=None,
+                        help="path or url of the alleles report. Downloaded from the WormBase ftp for the release "
+                             "if not provided")
+    parser.add_argument("-o", "--output", metavar="output", dest="output", type=str, required=True,
+                        help="path of the snapshot file to write")
+    parser.add_argument("-L", "--log-level", dest="log_level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR',
+                                                                        'CRITICAL'], default="INFO",
+                        help="set the logging level")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(name)s - %(levelname)s:%(message)s')
+
+    db_manager = DBManager(dbname=args.db_name, user=args.db_user, password=args.db_password, host=args.db_host)
+    var_ids = list(iter_variation_ids(args.source or KO_ALLELES_URL.format(release=args.release)))
+    id_name = db_manager.get_variation_names_by_id(var_ids)
+    db_manager.close()
+    write_snapshot(args.output, id_name, args.release)
+    logger.info("Snapshot written to " + args.output + ": " + str(len(id_name)) + " of " + str(len(var_ids)) +
+                " variations have a name")
+
+
+if __name__ == '__main__':
+    main()
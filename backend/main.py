@@ -2,15 +2,128 @@
 
 import logging
 import argparse
-import math
+import os
+import sys
+import time
 
+from backend.asyncengine import AsyncEngine, DEFAULT_MAX_IN_FLIGHT, DEFAULT_BATCHES_IN_FLIGHT, DEFAULT_PDF_QUEUE_SIZE
+from backend.checkpoint import Checkpoint, RunState, load_completed_run
+from backend.querycache import QueryCache, DEFAULT_TTL
+from backend.queryplanner import TokenBucket
 from backend.tpcmanager import TPCManager
 from backend.dbmanager import DBManager
+from backend.docregistry import get_paper_id
+from backend.fulltext import FulltextResolver, TextCache, FULLTEXT_SOURCES
+from backend.koalleles import load_snapshot
+from backend.matcher import MentionMatcher
+from backend.metrics import REGISTRY, get_summary
 from backend.nttxtraction import NttExtractor
+from backend.pdfcache import PDFCache, DEFAULT_MAX_SIZE
+from backend.varindex import VariationIndex, get_unique_variations
 
 logger = logging.getLogger(__name__)
 
-NUM_KEYWORDS_EACH_API_CALL = 500
+
+def calculate_counts(output_type: str, var_names: list, api_manager: TPCManager,
+                     fulltext_resolver: FulltextResolver, output=sys.stdout, checkpoint: Checkpoint = None,
+                     previous_run: RunState = None, engine: AsyncEngine = None):
+    """calculate the requested type of counts for a list of variations and print them to the output
+
+    The total count and the papers whose text is counted only need the documents mentioning any of the variations,
+    which are resolved batch by batch. Only the per-variation report resolves each variation to its documents.
+
+    With a checkpoint, the batches and the paper counts completed by previous runs are not calculated again.
+    The counts of the papers recorded in the checkpoint are printed first, followed by the new ones as they are
+    calculated. Papers whose text could not be extracted are printed with NA and are not recorded, so that they are
+    retried by the next run.
+
+    With the results of a previous run, the per-variation report only resolves again the variations added to the list
+    or whose documents changed, and only the papers whose documents changed or that Textpresso maps to a variation
+    added to or removed from the list are counted again. All the variations of the list are counted in the text of
+    each paper, so the count of a paper depends only on its text and on the list.
+
+    Args:
+        output_type (str): TOTAL_COUNT, VAR_COUNT_IN_PAPERS or PAPER_COUNT_FOR_VAR
+        var_names (list): the variation names
+        api_manager (TPCManager): the Textpresso manager
+        fulltext_resolver (FulltextResolver): the resolver used to get the fulltext of the papers
+        output: optional, the file to write the counts to
+        checkpoint (Checkpoint): optional, the checkpoint recording the progress of the run
+        previous_run (RunState): optional, the results of a previous run to update
+        engine (AsyncEngine): optional, the asyncio engine used to send the Textpresso requests instead of the
+            Textpresso manager
+    """
+    def resolve_docs(variations, checkpoint=None):
+        if engine is not None:
+            return engine.resolve_docs(variations, checkpoint=checkpoint)
+        return VariationIndex.resolve_docs(api_manager, variations, checkpoint=checkpoint)
+
+    if output_type == "TOTAL_COUNT":
+        print("Total number of mentions:" + str(len(resolve_docs(var_names, checkpoint))), file=output)
+    elif output_type == "VAR_COUNT_IN_PAPERS":
+        # all the requested variations are counted in the text, including the ones Textpresso maps to no paper
+        matcher = MentionMatcher(var_names)
+        docs = resolve_docs(var_names, checkpoint)
+        num_papers = docs.get_num_papers()
+        # one flag per paper number
+        counted_papers = bytearray(num_papers)
+        if checkpoint is not None:
+            for paper_id, counter in checkpoint.get_paper_counts():
+                paper_num = docs.get_paper_num(paper_id)
+                if paper_num is not None:
+                    print(docs.get_paper_accession(paper_num), str(counter), sep="\t", file=output)
+                    counted_papers[paper_num] = 1
+        if previous_run is not None:
+            # the count of a paper changes only if its documents changed or if it mentions a variation added to or
+            # removed from the list
+            changed_papers = bytearray(num_papers)
+            previous_paper_docs = {}
+            for identifier, accession in previous_run.docs.items():
+                previous_paper_docs.setdefault(get_paper_id(accession), set()).add(identifier)
+            paper_docs = [set() for _ in range(num_papers)]
+            for doc_num, identifier in enumerate(docs.identifiers):
+                paper_docs[docs.doc_papers[doc_num]].add(identifier)
+            for paper_num in range(num_papers):
+                if paper_docs[paper_num] != previous_paper_docs.get(docs.paper_ids[paper_num]):
+                    changed_papers[paper_num] = 1
+            toggled_vars = set(get_unique_variations(var_names)) ^ set(get_unique_variations(previous_run.variations))
+            if toggled_vars:
+                for accession in resolve_docs(sorted(toggled_vars)).accessions:
+                    paper_num = docs.get_paper_num(get_paper_id(accession))
+                    if paper_num is not None:
+                        changed_papers[paper_num] = 1
+            for paper_num in range(num_papers):
+                paper_id = docs.paper_ids[paper_num]
+                if not counted_papers[paper_num] and not changed_papers[paper_num] and \
+                        paper_id in previous_run.paper_counts:
+                    counter = previous_run.paper_counts[paper_id]
+                    if checkpoint is not None:
+                        checkpoint.save_paper_count(paper_id, counter)
+                    print(docs.get_paper_accession(paper_num), str(counter), sep="\t", file=output)
+                    counted_papers[paper_num] = 1
+            logger.info("Reusing the counts of " + str(counted_papers.count(1)) + " papers, " +
+                        str(num_papers - counted_papers.count(1)) + " papers to count")
+        output.flush()
+        for result in fulltext_resolver.iter_fulltexts({docs.paper_ids[paper_num]: docs.accessions[
+                docs.paper_last_docs[paper_num]] for paper_num in range(num_papers) if not counted_papers[paper_num]}):
+            if result.text:
+                counter = matcher.count_total(result.text)
+                if checkpoint is not None:
+                    checkpoint.save_paper_count(result.paper_id, counter)
+            else:
+                counter = "NA"
+            print(docs.get_paper_accession(docs.get_paper_num(result.paper_id)), str(counter), sep="\t",
+                  file=output)
+            output.flush()
+    elif output_type == "PAPER_COUNT_FOR_VAR":
+        previous_postings = previous_run.postings if previous_run is not None else None
+        if engine is not None:
+            var_index = engine.build_index(var_names, checkpoint=checkpoint, previous_postings=previous_postings)
+        else:
+            var_index = VariationIndex.build(api_manager, var_names, checkpoint=checkpoint,
+                                             previous_postings=previous_postings)
+        for var_name, num_papers in var_index.get_papers_per_variation(var_names):
+            print(var_name, str(num_papers), sep="\t", file=output)
 
 
 def main():
@@ -21,13 +134,70 @@ def main():
     parser.add_argument("-P", "--db-password", metavar="db_password", dest="db_password", type=str)
     parser.add_argument("-H", "--db-host", metavar="db_host", dest="db_host", type=str)
     parser.add_argument("-t", "--textpresso-apitoken", metavar="tpc_token", dest="tpc_token", type=str)
+    parser.add_argument("-c", "--tpc-concurrency", metavar="tpc_concurrency", dest="tpc_concurrency", type=int,
+                        default=8, help="maximum number of parallel requests to Textpresso Central API")
+    parser.add_argument("-R", "--tpc-rate", metavar="tpc_rate", dest="tpc_rate", type=float, default=None,
+                        help="maximum number of requests per second to Textpresso Central API. Unlimited if not "
+                             "provided")
+    parser.add_argument("-C", "--cache-path", metavar="cache_path", dest="cache_path", type=str, default=None,
+                        help="path to the Textpresso query cache file. Results are not cached if not provided")
+    parser.add_argument("--cache-ttl", metavar="cache_ttl", dest="cache_ttl", type=float, default=DEFAULT_TTL,
+                        help="time to live of the cached query results, in seconds")
+    parser.add_argument("--corpus-version", metavar="corpus_version", dest="corpus_version", type=str,
+                        default=None, help="version of the Textpresso corpus. The query cache is invalidated when "
+                                           "it changes")
     parser.add_argument("-w", "--tazendra-username", metavar="tazendra_user", dest="tazendra_user", type=str)
     parser.add_argument("-z", "--tazendra-password", metavar="tazendra_password", dest="tazendra_password", type=str)
+    parser.add_argument("--download-workers", metavar="download_workers", dest="download_workers", type=int,
+                        default=8, help="number of parallel pdf downloads")
+    parser.add_argument("-e", "--engine", dest="engine", choices=["threads", "asyncio"], default="threads",
+                        help="run the requests and the pdf downloads on thread pools or on an asyncio event loop")
+    parser.add_argument("--max-in-flight", metavar="max_in_flight", dest="max_in_flight", type=int,
+                        default=DEFAULT_MAX_IN_FLIGHT, help="maximum number of requests to Textpresso Central API "
+                                                            "in flight with the asyncio engine")
+    parser.add_argument("--batches-in-flight", metavar="batches_in_flight", dest="batches_in_flight", type=int,
+                        default=DEFAULT_BATCHES_IN_FLIGHT, help="maximum number of index batches resolved at the "
+                                                                "same time with the asyncio engine")
+    parser.add_argument("--pdf-queue-size", metavar="pdf_queue_size", dest="pdf_queue_size", type=int,
+                        default=DEFAULT_PDF_QUEUE_SIZE, help="maximum number of downloaded pdfs waiting to be parsed "
+                                                             "with the asyncio engine")
+    parser.add_argument("--parse-workers", metavar="parse_workers", dest="parse_workers", type=int, default=None,
+                        help="number of processes used to parse pdfs. Default is the number of cores")
+    parser.add_argument("--download-timeout", metavar="download_timeout", dest="download_timeout", type=float,
+                        default=120, help="timeout of each pdf download, in seconds")
+    parser.add_argument("--parse-timeout", metavar="parse_timeout", dest="parse_timeout", type=float, default=300,
+                        help="timeout of the text extraction of each pdf, in seconds")
+    parser.add_argument("--pdf-cache-dir", metavar="pdf_cache_dir", dest="pdf_cache_dir", type=str, default=None,
+                        help="directory where downloaded pdfs and their text are cached. No cache if not provided")
+    parser.add_argument("--pdf-cache-size", metavar="pdf_cache_size", dest="pdf_cache_size", type=int,
+                        default=DEFAULT_MAX_SIZE, help="maximum size of the pdf cache, in bytes")
+    parser.add_argument("--text-cache-dir", metavar="text_cache_dir", dest="text_cache_dir", type=str, default=None,
+                        help="directory where the fulltext of the papers is cached. No cache if not provided")
+    parser.add_argument("-f", "--fulltext-sources", metavar="fulltext_sources", dest="fulltext_sources", nargs="+",
+                        choices=FULLTEXT_SOURCES, default=FULLTEXT_SOURCES,
+                        help="sources of the fulltext of the papers, in order of preference: the local text cache, "
+                             "the sentences indexed by Textpresso and the pdfs")
+    parser.add_argument("-a", "--allele-snapshot", metavar="allele_snapshot", dest="allele_snapshot", type=str,
+                        default=None, help="snapshot of the knockout allele names built with backend.koalleles. If "
+                                           "not provided, the names are resolved from the alleles report and the db")
+    parser.add_argument("--alleles-source", metavar="alleles_source", dest="alleles_source", type=str, default=None,
+                        help="path or url of the knockout consortium alleles report, e.g. ko_allelex.xml.gz")
     parser.add_argument("-l", "--log-file", metavar="log_file", dest="log_file", type=str, default=None,
                         help="path to the log file to generate. Default ./afp_pipeline.log")
     parser.add_argument("-o", "--output-type", dest="output_type",
                         choices=['TOTAL_COUNT', 'VAR_COUNT_IN_PAPERS', 'PAPER_COUNT_FOR_VAR'], default="TOTAL_COUNT",
                         help="type of count to calculate")
+    parser.add_argument("-O", "--output-file", metavar="output_file", dest="output_file", type=str, default=None,
+                        help="file to write the counts to, rewritten at each run. Default is the standard output")
+    parser.add_argument("-k", "--checkpoint", metavar="checkpoint", dest="checkpoint", type=str, default=None,
+                        help="path to the checkpoint file recording the progress of the run. An interrupted run "
+                             "started again with the same checkpoint only does the missing work")
+    parser.add_argument("--restart", dest="restart", action="store_true",
+                        help="discard the progress recorded in the checkpoint file")
+    parser.add_argument("-d", "--previous-run", metavar="previous_run", dest="previous_run", type=str, default=None,
+                        help="checkpoint file of a completed run. Only the variations and papers that changed since "
+                             "that run are processed again. Requires a new checkpoint file (-k) to record the results "
+                             "of this run")
     parser.add_argument("-L", "--log-level", dest="log_level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR',
                                                                         'CRITICAL'], default="INFO",
                         help="set the logging level")
@@ -37,35 +207,54 @@ def main():
                         format='%(asctime)s - %(name)s - %(levelname)s:%(message)s')
 
     db_manager = DBManager(dbname=args.db_name, user=args.db_user, password=args.db_password, host=args.db_host)
-    ntt_xtractor = NttExtractor(args.tazendra_user, args.tazendra_password)
-    api_manager = TPCManager(args.tpc_token)
-    var_names = list(db_manager.get_variation_names_from_ids(api_manager.get_ids_from_wb_ftp()))
-    if args.output_type == "TOTAL_COUNT" or args.output_type == "VAR_COUNT_IN_PAPERS":
-        doc_id_accession = {}
-        start = 1
-        end = NUM_KEYWORDS_EACH_API_CALL
-        while True:
-            num_docs = api_manager.get_doc_count(var_names[start:min(end, len(var_names)) + 1])
-            for i in range(0, math.ceil(num_docs / 200)):
-                docs = api_manager.get_doc_matching(var_names[start:min(end, len(var_names)) + 1], start=i * 200)
-                doc_id_accession.update({doc[0]: doc[1] for doc in docs})
-            if end > len(var_names):
-                break
-            start = end + 1
-            end += NUM_KEYWORDS_EACH_API_CALL
-        if args.output_type == "TOTAL_COUNT":
-            print("Total number of mentions:" + str(len(doc_id_accession)))
-        elif args.output_type == "VAR_COUNT_IN_PAPERS":
-            for paper_id, accession in doc_id_accession.items():
-                fulltext = ntt_xtractor.get_fulltext_from_paper_id(accession[-8:], db_manager)
-                if fulltext:
-                    counter = sum([fulltext.count(var) for var in var_names])
-                else:
-                    counter = "NA"
-                print(accession.strip(" ").replace("Other:", "").replace("\\", ""), str(counter), sep="\t")
-    elif args.output_type == "PAPER_COUNT_FOR_VAR":
-        for var_name in var_names:
-            print(var_name, str(api_manager.get_doc_count([var_name])), sep="\t")
+    ntt_xtractor = NttExtractor(args.tazendra_user, args.tazendra_password, download_workers=args.download_workers,
+                                parse_workers=args.parse_workers, download_timeout=args.download_timeout,
+                                parse_timeout=args.parse_timeout,
+                                pdf_cache=PDFCache(args.pdf_cache_dir, args.pdf_cache_size) if args.pdf_cache_dir
+                                else None)
+    query_cache = QueryCache(args.cache_path, ttl=args.cache_ttl, corpus_version=args.corpus_version) if \
+        args.cache_path else None
+    api_manager = TPCManager(args.tpc_token, max_concurrency=args.tpc_concurrency, cache=query_cache,
+                             rate_limiter=TokenBucket(args.tpc_rate) if args.tpc_rate else None)
+    engine = AsyncEngine(api_manager, max_in_flight=args.max_in_flight, batches_in_flight=args.batches_in_flight,
+                         pdf_queue_size=args.pdf_queue_size) if args.engine == "asyncio" else None
+    fulltext_resolver = FulltextResolver(api_manager, ntt_xtractor, db_manager,
+                                         TextCache(args.text_cache_dir) if args.text_cache_dir else None,
+                                         args.fulltext_sources, engine)
+    if args.allele_snapshot:
+        var_names = sorted(set(load_snapshot(args.allele_snapshot)[1].values()))
+    else:
+        var_names = list(db_manager.get_variation_names_from_ids(api_manager.get_ids_from_wb_ftp(
+            args.alleles_source)))
+    if args.previous_run and (not args.checkpoint or os.path.abspath(args.checkpoint) ==
+                              os.path.abspath(args.previous_run)):
+        parser.error("a delta run requires a checkpoint file different from the one of the previous run")
+    try:
+        previous_run = load_completed_run(args.previous_run) if args.previous_run else None
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        checkpoint = Checkpoint(args.checkpoint, var_names, args.restart) if args.checkpoint else None
+    except ValueError as e:
+        parser.error(str(e) + ". Use --restart to discard it")
+    output = open(args.output_file, "w") if args.output_file else sys.stdout
+    metrics_before = REGISTRY.snapshot()
+    start_time = time.monotonic()
+    try:
+        calculate_counts(args.output_type, var_names, api_manager, fulltext_resolver, output, checkpoint,
+                         previous_run, engine)
+        if checkpoint is not None:
+            checkpoint.mark_complete()
+    finally:
+        if engine is not None:
+            engine.close()
+        if args.output_file:
+            output.close()
+        if checkpoint is not None:
+            checkpoint.close()
+    # the summary goes to stderr to keep the counts on stdout machine readable
+    print("Completed in " + "{:.1f}".format(time.monotonic() - start_time) + "s\n" + get_summary(metrics_before),
+          file=sys.stderr)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,86 @@
+import logging
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+
+class MentionMatcher(object):
+    """multi-pattern matcher that counts the mentions of a list of entities in a text with a single pass
+
+    The patterns are compiled once into an Aho-Corasick automaton. Matches are word-boundary aware: a pattern is
+    not counted when it is preceded or followed by an alphanumeric character, so that `ok100` is not counted inside
+    `ok1001`. Matching is case sensitive, as are the queries to Textpresso.
+
+    Args:
+        patterns (list): the entity names to search
+    """
+
+    def __init__(self, patterns: list):
+        self.patterns = list(dict.fromkeys(pattern for pattern in patterns if pattern))
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for pattern_idx, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                state = next_state
+            self._out[state].append(pattern_idx)
+        # breadth-first construction of the failure links, merging the outputs of the fallback states
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                self._out[next_state] = self._out[next_state] + self._out[self._fail[next_state]]
+        self._lengths = [len(pattern) for pattern in self.patterns]
+        self._check_start = [pattern[0].isalnum() for pattern in self.patterns]
+        self._check_end = [pattern[-1].isalnum() for pattern in self.patterns]
+        logger.debug("Compiled " + str(len(self.patterns)) + " patterns into " + str(len(self._goto)) + " states")
+
+    def iter_matches(self, text: str):
+        """iterate over the indices of the patterns matching in the text, one for each valid mention"""
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        lengths = self._lengths
+        check_start = self._check_start
+        check_end = self._check_end
+        text_len = len(text)
+        state = 0
+        for pos, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                for pattern_idx in out[state]:
+                    start = pos + 1 - lengths[pattern_idx]
+                    if check_start[pattern_idx] and start > 0 and text[start - 1].isalnum():
+                        continue
+                    if check_end[pattern_idx] and pos + 1 < text_len and text[pos + 1].isalnum():
+                        continue
+                    yield pattern_idx
+
+    def count(self, text: str):
+        """count the mentions of each pattern in the text
+
+        Args:
+            text (str): the text to scan
+        Returns:
+            Counter: the number of mentions of each pattern found at least once
+        """
+        counts = Counter(self.iter_matches(text))
+        return Counter({self.patterns[pattern_idx]: count for pattern_idx, count in counts.items()})
+
+    def count_total(self, text: str):
+        """count the total number of mentions of all the patterns in the text"""
+        return sum(1 for _ in self.iter_matches(text))
@@ -0,0 +1,230 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(name + "=\"" + str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") +
+                          "\"" for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric(object):
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _label_key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("Metric " + self.name + " expects labels " + str(self.labelnames))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self, const_labels: dict = None):
+        lines = ["# HELP " + self.name + " " + self.documentation, "# TYPE " + self.name + " " + self.metric_type]
+        const_labels = const_labels or {}
+        labelnames = self.labelnames + tuple(const_labels)
+        with self._lock:
+            items = sorted(self._values.items())
+        for labelvalues, value in items:
+            lines.extend(self._render_sample(labelnames, labelvalues + tuple(const_labels.values()), value))
+        return lines
+
+
+class Counter(_Metric):
+    """monotonically increasing value, e.g. a number of requests or of bytes transferred"""
+    metric_type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_sample(self, labelnames, labelvalues, value):
+        return [self.name + _format_labels(labelnames, labelvalues) + " " + _format_value(value)]
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class Histogram(_Metric):
+    """distribution of observed values, e.g. latencies, counted in cumulative buckets"""
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._label_key(labels)
+        with self._lock:
+            bucket_counts, total = self._values.get(key, (None, 0.0))
+            if bucket_counts is None:
+                bucket_counts = [0] * (len(self.buckets) + 1)
+            bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (bucket_counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """observe the time spent in the body of a with statement, whether it raises or not"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def _render_sample(self, labelnames, labelvalues, value):
+        bucket_counts, total = value
+        lines = []
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets + (float("inf"),), bucket_counts):
+            cumulative += count
+            lines.append(self.name + "_bucket" + _format_labels(labelnames, labelvalues,
+                                                                ("le", _format_value(float(upper_bound)))) + " " +
+                         str(cumulative))
+        lines.append(self.name + "_sum" + _format_labels(labelnames, labelvalues) + " " + _format_value(total))
+        lines.append(self.name + "_count" + _format_labels(labelnames, labelvalues) + " " + str(cumulative))
+        return lines
+
+    def snapshot(self):
+        """get the number of observations and their sum for each set of labels"""
+        with self._lock:
+            return {key: (sum(bucket_counts), total) for key, (bucket_counts, total) in self._values.items()}
+
+
+class MetricsRegistry(object):
+    """collection of metrics rendered together in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        if any(registered.name == metric.name for registered in self._metrics):
+            raise ValueError("Metric " + metric.name + " already registered")
+        self._metrics.append(metric)
+        return metric
+
+    def render(self, const_labels: dict = None):
+        """render all the metrics
+
+        Args:
+            const_labels (dict): optional, labels added to all the samples, e.g. the pid of the process when each server
+                process exposes its own metrics
+        """
+        return "\n".join(line for metric in self._metrics for line in metric.render(const_labels)) + "\n"
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+
+REGISTRY = MetricsRegistry()
+
+TPC_REQUEST_SECONDS = REGISTRY.histogram("tpc_request_seconds", "Latency of the requests to Textpresso Central API",
+                                         ("endpoint",))
+TPC_REQUEST_ERRORS = REGISTRY.counter("tpc_request_errors_total", "Failed requests to Textpresso Central API",
+                                      ("endpoint",))
+TPC_RESPONSE_BYTES = REGISTRY.counter("tpc_response_bytes_total", "Bytes received from Textpresso Central API",
+                                      ("endpoint",))
+TPC_CACHE_REQUESTS = REGISTRY.counter("tpc_cache_requests_total", "Lookups in the Textpresso query cache",
+                                      ("result",))
+HTTP_RETRIES = REGISTRY.counter("http_retries_total", "Requests retried by the pooled http client", ("host",))
+DB_QUERY_SECONDS = REGISTRY.histogram("db_query_seconds", "Latency of the database queries", ("query",))
+PDF_DOWNLOAD_SECONDS = REGISTRY.histogram("pdf_download_seconds", "Latency of the pdf downloads")
+PDF_DOWNLOAD_BYTES = REGISTRY.counter("pdf_download_bytes_total", "Bytes of pdf downloaded")
+PDF_DOWNLOAD_ERRORS = REGISTRY.counter("pdf_download_errors_total", "Failed pdf downloads")
+PDF_CACHE_REQUESTS = REGISTRY.counter("pdf_cache_requests_total", "Lookups in the pdf cache", ("result",))
+PDF_PARSE_SECONDS = REGISTRY.histogram("pdf_parse_seconds", "Time spent extracting the text of a pdf")
+PDF_PARSE_FAILED_PAGES = REGISTRY.counter("pdf_parse_failed_pages_total", "Pdf pages whose text could not be "
+                                                                          "extracted")
+EMAIL_SEND_SECONDS = REGISTRY.histogram("email_send_seconds", "Latency of the emails sent")
+EMAIL_ERRORS = REGISTRY.counter("email_errors_total", "Emails that could not be sent")
+EMAIL_RETRIES = REGISTRY.counter("email_retries_total", "Attempts to send an email that were retried")
+FULLTEXT_SOURCE = REGISTRY.counter("fulltext_source_total", "Papers whose fulltext was obtained from each source",
+                                   ("source",))
+JOB_SECONDS = REGISTRY.histogram("job_seconds", "Duration of the statistics jobs", ("type", "status"),
+                                 buckets=(1.0, 10.0, 60.0, 300.0, 900.0, 1800.0, 3600.0, 7200.0, 14400.0))
+
+# stages reported in the job summaries, with the histogram of their latency and the counter of their failures
+SUMMARY_STAGES = [("Textpresso", TPC_REQUEST_SECONDS, TPC_REQUEST_ERRORS),
+                  ("DB", DB_QUERY_SECONDS, None),
+                  ("pdf download", PDF_DOWNLOAD_SECONDS, PDF_DOWNLOAD_ERRORS),
+                  ("pdf parse", PDF_PARSE_SECONDS, None),
+                  ("email", EMAIL_SEND_SECONDS, EMAIL_ERRORS)]
+
+
+def _total(snapshot, metric, value_index=None):
+    values = snapshot.get(metric.name, {}).values()
+    if value_index is not None:
+        return sum(value[value_index] for value in values)
+    return sum(values)
+
+
+def get_summary(before: dict, after: dict = None):
+    """summarize the activity recorded between two snapshots of the registry
+
+    The time of a stage is the sum of the latencies of its operations, which can exceed the elapsed time when they
+    run in parallel.
+
+    Args:
+        before (dict): the snapshot taken at the beginning of the job
+        after (dict): optional, the snapshot taken at the end of the job. The current values if not provided
+    Returns:
+        str: one line for each stage with the number of operations, their total time and their failures, followed by
+            the transferred bytes, the retries and the cache lookups
+    """
+    after = after if after is not None else REGISTRY.snapshot()
+    lines = []
+    for stage_name, histogram, error_counter in SUMMARY_STAGES:
+        count = _total(after, histogram, 0) - _total(before, histogram, 0)
+        seconds = _total(after, histogram, 1) - _total(before, histogram, 1)
+        line = stage_name + ": " + str(count) + " operations, " + "{:.2f}".format(seconds) + "s"
+        if error_counter is not None:
+            line += ", " + str(int(_total(after, error_counter) - _total(before, error_counter))) + " errors"
+        lines.append(line)
+    lines.append("transferred: " + "{:.1f}".format((_total(after, TPC_RESPONSE_BYTES) -
+                                                    _total(before, TPC_RESPONSE_BYTES)) / 1024 / 1024) +
+                 "MB from Textpresso, " + "{:.1f}".format((_total(after, PDF_DOWNLOAD_BYTES) -
+                                                          _total(before, PDF_DOWNLOAD_BYTES)) / 1024 / 1024) +
+                 "MB of pdfs")
+    lines.append("http retries: " + str(int(_total(after, HTTP_RETRIES) - _total(before, HTTP_RETRIES))))
+    fulltext_sources = {labels[0]: value - before.get(FULLTEXT_SOURCE.name, {}).get(labels, 0) for labels, value in
+                        after.get(FULLTEXT_SOURCE.name, {}).items()}
+    if any(fulltext_sources.values()):
+        lines.append("fulltext sources: " + ", ".join(source + " " + str(int(count)) for source, count in
+                                                      sorted(fulltext_sources.items()) if count))
+    for cache_name, counter in (("Textpresso cache", TPC_CACHE_REQUESTS), ("pdf cache", PDF_CACHE_REQUESTS)):
+        hits = after.get(counter.name, {}).get(("hit",), 0) - before.get(counter.name, {}).get(("hit",), 0)
+        misses = after.get(counter.name, {}).get(("miss",), 0) - before.get(counter.name, {}).get(("miss",), 0)
+        if hits or misses:
+            lines.append(cache_name + ": " + str(int(hits)) + " hits, " + str(int(misses)) + " misses")
+    return "\n".join(lines)
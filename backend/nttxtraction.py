@@ -1,82 +1,429 @@
 import base64
+import io
 import logging
+import multiprocessing
+import os
+import queue
 import re
-import shutil
+import threading
+import time
 
 import PyPDF2 as PyPDF2
 from PyPDF2.generic import TextStringObject
-from PyPDF2.pdf import ContentStream, b_, FloatObject, NumberObject
-from PyPDF2.utils import u_
+from PyPDF2.pdf import ContentStream, FloatObject, NumberObject
+import urllib.error
 import urllib.request
-import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from backend.dbmanager import DBManager
+from backend.metrics import PDF_DOWNLOAD_SECONDS, PDF_DOWNLOAD_BYTES, PDF_DOWNLOAD_ERRORS, PDF_CACHE_REQUESTS, \
+    PDF_PARSE_SECONDS, PDF_PARSE_FAILED_PAGES
+from backend.pdfcache import PDFCache
 
 logger = logging.getLogger(__name__)
 
 
+# text showing and positioning operators of the content streams, see section 9.4 of the PDF 1.7 specification. Empty
+# strings are never appended, so the last part is enough to know the last character of the text
+def _show_text(operands, parts):
+    text = operands[0]
+    if isinstance(text, TextStringObject) and text:
+        parts.append(text)
+
+
+def _next_line(operands, parts):
+    parts.append("\n")
+
+
+def _next_line_show_text(operands, parts):
+    parts.append("\n")
+    _show_text(operands, parts)
+
+
+def _next_line_show_text_with_spacing(operands, parts):
+    text = operands[2]
+    if isinstance(text, TextStringObject):
+        parts.append("\n")
+        if text:
+            parts.append(text)
+
+
+def _show_text_array(operands, parts):
+    for item in operands[0]:
+        if isinstance(item, TextStringObject):
+            if item:
+                parts.append(item)
+        elif isinstance(item, (FloatObject, NumberObject)) and item < -100:
+            parts.append(" ")
+
+
+def _move_text(operands, parts):
+    if parts and parts[-1][-1] != " " and parts[-1][-1] != "\n":
+        parts.append(" ")
+
+
+TEXT_OPERATORS = {
+    b"Tj": _show_text,
+    b"T*": _next_line,
+    b"'": _next_line_show_text,
+    b'"': _next_line_show_text_with_spacing,
+    b"TJ": _show_text_array,
+    b"TD": _move_text,
+    b"Tm": _move_text
+}
+
+WHITESPACE_RE = re.compile("\\s+")
+
+
+def custom_extract_text(page):
+    parts = []
+    content = page["/Contents"].getObject()
+    if not isinstance(content, ContentStream):
+        content = ContentStream(content, page.pdf)
+    # Note: we check all strings are TextStringObjects.  ByteStringObjects
+    # are strings where the byte->string encoding was unknown, so adding
+    # them to the text here would be gibberish.
+    get_operator_handler = TEXT_OPERATORS.get
+    for operands, operator in content.operations:
+        handler = get_operator_handler(operator)
+        if handler is not None:
+            handler(operands, parts)
+    return WHITESPACE_RE.sub(" ", "".join(parts).replace(" - ", "-"))
+
+
+def iter_text_from_pdf(pdf_data: bytes):
+    """extract the text of a pdf file page by page, so that the caller can process each page as it is parsed and
+    stop early
+
+    Args:
+        pdf_data (bytes): the content of the pdf file
+    Returns:
+        generator: the text of each page, None for the pages that could not be parsed
+    """
+    pdf_reader = PyPDF2.PdfFileReader(io.BytesIO(pdf_data))
+    for i in range(pdf_reader.numPages):
+        try:
+            yield custom_extract_text(pdf_reader.getPage(i))
+        except Exception:
+            yield None
+
+
+def extract_text_from_pdf(pdf_data: bytes):
+    """extract the text of a pdf file. Module level function so that it can be run in a worker process
+
+    Args:
+        pdf_data (bytes): the content of the pdf file
+    Returns:
+        tuple: the extracted text and the number of pages that could not be parsed
+    """
+    pages_text = []
+    num_failed_pages = 0
+    for page_text in iter_text_from_pdf(pdf_data):
+        if page_text is None:
+            num_failed_pages += 1
+        else:
+            pages_text.append(page_text)
+    return "".join(pages_text), num_failed_pages
+
+
+def timed_extract_text_from_pdf(pdf_data: bytes):
+    """extract the text of a pdf file, also returning the time taken, so that it can be recorded by the parent process
+    when run in a worker process
+
+    Returns:
+        tuple: the extracted text, the number of pages that could not be parsed and the parse time in seconds
+    """
+    start_time = time.perf_counter()
+    text, num_failed_pages = extract_text_from_pdf(pdf_data)
+    return text, num_failed_pages, time.perf_counter() - start_time
+
+
+def _parse_worker(conn):
+    """loop of a parse process: extract the text of each pdf received on the connection and send back the result"""
+    while True:
+        try:
+            pdf_data = conn.recv()
+        except EOFError:
+            return
+        try:
+            result = timed_extract_text_from_pdf(pdf_data), None
+        except Exception as e:
+            result = None, str(e) or type(e).__name__
+        conn.send(result)
+
+
+class ParsePool(object):
+    """pool of processes extracting the text of pdfs, with a timeout on each pdf
+
+    The tasks of a ProcessPoolExecutor cannot be interrupted once started, so a pdf hanging the parser would keep its
+    process busy and block the shutdown of the pool. Here each process parses one pdf at a time, received on its own
+    connection, and a process exceeding the timeout is terminated and replaced. parse() blocks the calling thread until
+    a process is available, so the number of calling threads bounds the number of pdfs waiting to be parsed.
+
+    Args:
+        num_workers (int): optional, the number of processes. Default is the number of cores
+        timeout (float): optional, the maximum time to parse a pdf, in seconds. No limit if not provided
+    """
+
+    def __init__(self, num_workers: int = None, timeout: float = None):
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self._context = multiprocessing.get_context()
+        self._lock = threading.Lock()
+        self._workers = set()
+        self._closed = False
+        # idle (process, connection) tuples. None is put back by each caller that gets it once the pool is closed
+        self._idle = queue.Queue()
+        for _ in range(self.num_workers):
+            self._idle.put(self._start_worker())
+
+    def _start_worker(self):
+        conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_parse_worker, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        worker = (process, conn)
+        with self._lock:
+            self._workers.add(worker)
+        return worker
+
+    def _replace_worker(self, worker):
+        process, conn = worker
+        with self._lock:
+            self._workers.discard(worker)
+        process.terminate()
+        process.join(1)
+        conn.close()
+        self._idle.put(None if self._closed else self._start_worker())
+
+    def parse(self, pdf_data: bytes):
+        """extract the text of a pdf on one of the processes of the pool
+
+        Args:
+            pdf_data (bytes): the content of the pdf file
+        Returns:
+            tuple: the extracted text, the number of pages that could not be parsed and the parse time in seconds
+        Raises:
+            TimeoutError: if the parse takes longer than the timeout
+            ValueError: if the pdf could not be parsed
+            RuntimeError: if the pool is closed or the process exited
+        """
+        worker = self._idle.get()
+        if worker is None:
+            self._idle.put(None)
+            raise RuntimeError("the parse pool is closed")
+        process, conn = worker
+        try:
+            conn.send(pdf_data)
+            if not conn.poll(self.timeout):
+                raise TimeoutError("no result after " + str(self.timeout) + "s")
+            result, error = conn.recv()
+        except TimeoutError:
+            self._replace_worker(worker)
+            raise
+        except (EOFError, OSError) as e:
+            self._replace_worker(worker)
+            raise RuntimeError("the parse process exited: " + (str(e) or type(e).__name__))
+        self._idle.put(worker)
+        if error is not None:
+            raise ValueError(error)
+        return result
+
+    def close(self):
+        """terminate the processes without waiting for the parses in progress, which fail with RuntimeError"""
+        self._closed = True
+        with self._lock:
+            workers = list(self._workers)
+        for process, conn in workers:
+            process.terminate()
+        for process, conn in workers:
+            process.join(1)
+        self._idle.put(None)
+
+
+ExtractionResult = namedtuple("ExtractionResult", ["paper_id", "text", "error"])
+
+
 class NttExtractor(object):
 
-    def __init__(self, tazendra_user, tazendra_passwd):
+    def __init__(self, tazendra_user, tazendra_passwd, download_workers: int = 8, parse_workers: int = None,
+                 download_timeout: float = 120, parse_timeout: float = 300, pdf_cache: PDFCache = None):
         self.tazendra_user = tazendra_user
         self.tazendra_passwd = tazendra_passwd
+        self.download_workers = download_workers
+        self.parse_workers = parse_workers
+        self.download_timeout = download_timeout
+        self.parse_timeout = parse_timeout
+        self.pdf_cache = pdf_cache
 
-    def get_fulltext_from_paper_id(self, paper_id, db_manager: DBManager):
-        def customExtractText(self):
-            text = u_("")
-            content = self["/Contents"].getObject()
-            if not isinstance(content, ContentStream):
-                content = ContentStream(content, self.pdf)
-            # Note: we check all strings are TextStringObjects.  ByteStringObjects
-            # are strings where the byte->string encoding was unknown, so adding
-            # them to the text here would be gibberish.
-            for operands, operator in content.operations:
-                if operator == b_("Tj"):
-                    _text = operands[0]
-                    if isinstance(_text, TextStringObject):
-                        text += _text
-                elif operator == b_("T*"):
-                    text += "\n"
-                elif operator == b_("'"):
-                    text += "\n"
-                    _text = operands[0]
-                    if isinstance(_text, TextStringObject):
-                        text += operands[0]
-                elif operator == b_('"'):
-                    _text = operands[2]
-                    if isinstance(_text, TextStringObject):
-                        text += "\n"
-                        text += _text
-                elif operator == b_("TJ"):
-                    for i in operands[0]:
-                        if isinstance(i, TextStringObject):
-                            text += i
-                        elif isinstance(i, FloatObject) or isinstance(i, NumberObject):
-                            if i < -100:
-                                text += " "
-                elif operator == b_("TD") or operator == b_("Tm"):
-                    if len(text) > 0 and text[-1] != " " and text[-1] != "\n":
-                        text += " "
-            text = text.replace(" - ", "-")
-            text = re.sub("\\s+", " ", text)
-            return text
+    def get_auth_header(self):
+        base64string = base64.b64encode(bytes('%s:%s' % (self.tazendra_user, self.tazendra_passwd), 'ascii'))
+        return "Basic %s" % base64string.decode('utf-8')
+
+    def _download(self, pdf_url, headers=None):
+        request = urllib.request.Request(pdf_url, headers=headers or {})
+        request.add_header("Authorization", self.get_auth_header())
+        try:
+            with PDF_DOWNLOAD_SECONDS.time():
+                with urllib.request.urlopen(request, timeout=self.download_timeout) as response:
+                    data = response.read()
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                PDF_DOWNLOAD_ERRORS.inc()
+            raise
+        except Exception:
+            PDF_DOWNLOAD_ERRORS.inc()
+            raise
+        PDF_DOWNLOAD_BYTES.inc(len(data))
+        return data, response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+    def fetch_pdf(self, paper_id, pdf_url):
+        """get the content of a pdf, from the local cache if it is still valid or from the server otherwise
 
+        Args:
+            paper_id (str): the id of the paper
+            pdf_url (str): the url of the pdf
+        Returns:
+            tuple: the pdf content, its SHA-256 (None if no cache is configured) and the cached text extracted from
+                it (None if not available)
+        """
+        if self.pdf_cache is None:
+            return self._download(pdf_url)[0], None, None
+        entry = self.pdf_cache.get_entry(paper_id, pdf_url)
+        if entry is not None:
+            headers = {}
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+            if headers:
+                try:
+                    data, etag, last_modified = self._download(pdf_url, headers)
+                except urllib.error.HTTPError as e:
+                    if e.code != 304:
+                        raise
+                    data = self.pdf_cache.get_pdf(entry["sha256"])
+                    if data is not None:
+                        logger.debug("Cached pdf still valid: " + pdf_url)
+                        PDF_CACHE_REQUESTS.inc(result="hit")
+                        return data, entry["sha256"], self.pdf_cache.get_text(entry["sha256"])
+                    data, etag, last_modified = self._download(pdf_url)
+            else:
+                data, etag, last_modified = self._download(pdf_url)
+        else:
+            data, etag, last_modified = self._download(pdf_url)
+        PDF_CACHE_REQUESTS.inc(result="miss")
+        content_hash = self.pdf_cache.put_pdf(paper_id, pdf_url, data, etag, last_modified)
+        return data, content_hash, self.pdf_cache.get_text(content_hash)
+
+    def get_fulltext_from_paper_id(self, paper_id, db_manager: DBManager):
         def convert_pdf2text(pdf_url):
-            pdf_fulltext = ""
-            request = urllib.request.Request(pdf_url)
-            base64string = base64.b64encode(bytes('%s:%s' % (self.tazendra_user, self.tazendra_passwd), 'ascii'))
-            request.add_header("Authorization", "Basic %s" % base64string.decode('utf-8'))
-            with urllib.request.urlopen(request) as response:
-                with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-                    shutil.copyfileobj(response, tmp_file)
             try:
-                pdf_reader = PyPDF2.PdfFileReader(open(tmp_file.name, 'rb'))
-                for i in range(pdf_reader.numPages):
-                    page_obj = pdf_reader.getPage(i)
-                    page_obj.extractText = customExtractText
-                    pdf_fulltext += page_obj.extractText(page_obj)
-            except:
-                pass
-            return pdf_fulltext
+                pdf_data, content_hash, pdf_fulltext = self.fetch_pdf(paper_id, pdf_url)
+                if pdf_fulltext is None:
+                    with PDF_PARSE_SECONDS.time():
+                        pdf_fulltext, num_failed_pages = extract_text_from_pdf(pdf_data)
+                    if num_failed_pages:
+                        PDF_PARSE_FAILED_PAGES.inc(num_failed_pages)
+                        logger.warning("Could not parse " + str(num_failed_pages) + " pages of " + pdf_url)
+                    if content_hash is not None:
+                        self.pdf_cache.put_text(content_hash, pdf_fulltext)
+                return pdf_fulltext
+            except Exception as e:
+                logger.error("Could not extract text from " + pdf_url + ": " + str(e))
+                return ""
         pdf_urls = db_manager.get_paper_pdf_path(paper_id)
         return "\n".join([convert_pdf2text(pdf_url) for pdf_url in pdf_urls])
+
+    def get_fulltexts_from_paper_ids(self, paper_ids: list, db_manager: DBManager):
+        """extract the fulltext of a list of papers, downloading the pdfs on a thread pool and parsing them on a
+           process pool
+
+        Each pdf is downloaded and then handed to a parse process by the same thread, which waits for a process to be
+        available. At most download_workers + parse_workers pdfs are processed at the same time, so that the memory
+        used by the downloaded pdfs stays bounded. A parse exceeding parse_timeout is reported as an error and its
+        process replaced. Results are yielded as soon as all the pdfs of a paper have been processed, so they are not
+        in input order.
+
+        Args:
+            paper_ids (list): the ids of the papers
+            db_manager (DBManager): the db manager used to resolve the pdf locations
+        Returns:
+            generator: an ExtractionResult for each paper. text is None if no text could be extracted and error
+                describes the failures, if any
+        """
+        unique_ids = list(dict.fromkeys(paper_ids))
+        paper_pdf_urls = db_manager.get_paper_pdf_paths(unique_ids)
+        pending_pdfs = {}
+        pdf_texts = {}
+        errors = {}
+        pdfs_to_process = []
+        for paper_id in unique_ids:
+            pdf_urls = paper_pdf_urls.get(paper_id, [])
+            if not pdf_urls:
+                yield ExtractionResult(paper_id, None, "no pdf available")
+                continue
+            pending_pdfs[paper_id] = len(pdf_urls)
+            pdf_texts[paper_id] = [None] * len(pdf_urls)
+            pdfs_to_process.extend((paper_id, pdf_idx, pdf_url) for pdf_idx, pdf_url in enumerate(pdf_urls))
+        if not pdfs_to_process:
+            return
+
+        def process_pdf(paper_id, pdf_idx, pdf_url):
+            try:
+                pdf_data, content_hash, cached_text = self.fetch_pdf(paper_id, pdf_url)
+            except Exception as e:
+                return paper_id, pdf_idx, None, "download of " + pdf_url + " failed: " + str(e)
+            if cached_text is not None:
+                return paper_id, pdf_idx, cached_text, None
+            try:
+                text, num_failed_pages, parse_time = parse_pool.parse(pdf_data)
+            except TimeoutError:
+                return paper_id, pdf_idx, None, "parsing of " + pdf_url + " timed out"
+            except Exception as e:
+                return paper_id, pdf_idx, None, "parsing of " + pdf_url + " failed: " + str(e)
+            PDF_PARSE_SECONDS.observe(parse_time)
+            if content_hash is not None:
+                self.pdf_cache.put_text(content_hash, text)
+            if num_failed_pages:
+                PDF_PARSE_FAILED_PAGES.inc(num_failed_pages)
+                return paper_id, pdf_idx, text, str(num_failed_pages) + " pages of " + pdf_url + " could not be parsed"
+            return paper_id, pdf_idx, text, None
+
+        parse_pool = ParsePool(self.parse_workers, self.parse_timeout)
+        max_in_progress = self.download_workers + parse_pool.num_workers
+        executor = ThreadPoolExecutor(max_workers=max_in_progress)
+        in_progress = set()
+        try:
+            pdfs_iter = iter(pdfs_to_process)
+            while True:
+                for paper_id, pdf_idx, pdf_url in pdfs_iter:
+                    in_progress.add(executor.submit(process_pdf, paper_id, pdf_idx, pdf_url))
+                    if len(in_progress) >= max_in_progress:
+                        break
+                if not in_progress:
+                    break
+                done, in_progress = wait(in_progress, return_when=FIRST_COMPLETED)
+                for future in done:
+                    paper_id, pdf_idx, text, error = future.result()
+                    pdf_texts[paper_id][pdf_idx] = text
+                    if error:
+                        errors.setdefault(paper_id, []).append(error)
+                    pending_pdfs[paper_id] -= 1
+                    if pending_pdfs[paper_id] == 0:
+                        del pending_pdfs[paper_id]
+                        texts = [text for text in pdf_texts.pop(paper_id) if text is not None]
+                        paper_errors = errors.pop(paper_id, [])
+                        result = ExtractionResult(paper_id, "\n".join(texts) if texts else None,
+                                                  "; ".join(paper_errors) if paper_errors else None)
+                        if result.error:
+                            logger.warning("Errors extracting text for paper " + paper_id + ": " + result.error)
+                        yield result
+        finally:
+            # neither the downloads in progress nor a stuck parse are waited for. The pdfs not started yet are
+            # cancelled one by one, shutdown() only cancels them itself from python 3.9
+            for future in in_progress:
+                future.cancel()
+            executor.shutdown(wait=False)
+            parse_pool.close()
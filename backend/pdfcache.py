@@ -0,0 +1,130 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_SIZE = 10 * 1024 ** 3
+
+
+class PDFCache(object):
+    """local cache of downloaded pdf files and of the text extracted from them
+
+    Pdfs and texts are stored as content-addressed blobs named after the SHA-256 of the pdf, so that identical
+    files are stored and parsed once. Each (paper id, url) pair has an entry pointing to its current blob along
+    with the ETag and Last-Modified headers of the response, used to revalidate it with a conditional request.
+    The least recently used blobs are evicted when the total size exceeds `max_size` bytes.
+
+    Args:
+        cache_dir (str): the directory where the cache is stored
+        max_size (int): optional, the maximum size of the cache, in bytes
+    """
+
+    def __init__(self, cache_dir, max_size: int = DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.entries_dir = os.path.join(cache_dir, "entries")
+        self.blobs_dir = os.path.join(cache_dir, "blobs")
+        os.makedirs(self.entries_dir, exist_ok=True)
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._size = sum(entry.stat().st_size for entry in os.scandir(self.blobs_dir) if entry.is_file())
+
+    @staticmethod
+    def _entry_key(paper_id, url):
+        return hashlib.sha256((str(paper_id) + "\n" + url).encode('utf-8')).hexdigest()
+
+    def _blob_path(self, content_hash, ext):
+        return os.path.join(self.blobs_dir, content_hash + "." + ext)
+
+    def _write_atomic(self, path, data: bytes):
+        tmp_path = path + ".tmp" + str(threading.get_ident())
+        with open(tmp_path, "wb") as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, path)
+
+    def get_entry(self, paper_id, url):
+        """get the cached entry for a pdf url
+
+        Returns:
+            dict: the entry, with etag, last_modified and sha256 fields, or None if the pdf is not cached
+        """
+        try:
+            with open(os.path.join(self.entries_dir, self._entry_key(paper_id, url) + ".json")) as entry_file:
+                entry = json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+        if not os.path.exists(self._blob_path(entry["sha256"], "pdf")):
+            return None
+        return entry
+
+    def get_pdf(self, content_hash):
+        path = self._blob_path(content_hash, "pdf")
+        try:
+            with open(path, "rb") as pdf_file:
+                data = pdf_file.read()
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def put_pdf(self, paper_id, url, data: bytes, etag=None, last_modified=None):
+        """store a downloaded pdf and point the entry of its url to it
+
+        Returns:
+            str: the SHA-256 of the pdf content
+        """
+        content_hash = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(content_hash, "pdf")
+        if not os.path.exists(path):
+            self._write_atomic(path, data)
+            self._add_size(len(data))
+        self._write_atomic(os.path.join(self.entries_dir, self._entry_key(paper_id, url) + ".json"), json.dumps({
+            "paper_id": paper_id, "url": url, "etag": etag, "last_modified": last_modified,
+            "sha256": content_hash}).encode('utf-8'))
+        return content_hash
+
+    def get_text(self, content_hash):
+        path = self._blob_path(content_hash, "txt")
+        try:
+            with open(path, "rb") as text_file:
+                text = text_file.read().decode('utf-8')
+            os.utime(path)
+            return text
+        except OSError:
+            return None
+
+    def put_text(self, content_hash, text: str):
+        path = self._blob_path(content_hash, "txt")
+        if not os.path.exists(path):
+            data = text.encode('utf-8')
+            self._write_atomic(path, data)
+            self._add_size(len(data))
+
+    def _add_size(self, num_bytes):
+        with self._lock:
+            self._size += num_bytes
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        blobs = sorted((entry for entry in os.scandir(self.blobs_dir) if entry.is_file()),
+                       key=lambda entry: entry.stat().st_mtime)
+        self._size = sum(blob.stat().st_size for blob in blobs)
+        # free a margin below the limit so that the next writes do not trigger an eviction each
+        target_size = self.max_size * 0.9
+        num_evicted = 0
+        for blob in blobs:
+            if self._size <= target_size:
+                break
+            try:
+                size = blob.stat().st_size
+                os.remove(blob.path)
+                self._size -= size
+                num_evicted += 1
+            except OSError:
+                pass
+        logger.info("Evicted " + str(num_evicted) + " files from pdf cache")
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from backend.metrics import TPC_CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 200000
+
+
+class QueryCache(object):
+    """persistent SQLite cache of Textpresso Central query results
+
+    Entries are keyed by the normalized keyword list, the query type and the case sensitivity of the query. They
+    expire after `ttl` seconds, the least recently used ones are evicted when the cache grows beyond `max_entries`,
+    and the whole cache is dropped when the corpus version changes.
+
+    Args:
+        path (str): the path of the SQLite database file
+        ttl (float): optional, the time to live of the entries, in seconds
+        max_entries (int): optional, the maximum number of entries to keep
+        corpus_version (str): optional, the version of the corpus. If it differs from the stored one, the cache is
+            invalidated
+    """
+
+    def __init__(self, path, ttl: float = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 corpus_version: str = None):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS query_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                           "created REAL NOT NULL, accessed REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS query_cache_accessed ON query_cache (accessed)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache_meta (name TEXT PRIMARY KEY, value TEXT)")
+        if corpus_version is not None and corpus_version != self.get_corpus_version():
+            self.invalidate(corpus_version)
+
+    @staticmethod
+    def make_key(keywords: list, query_type: str, case_sensitive: bool = True):
+        normalized = " ".join(sorted({keyword.strip() for keyword in keywords if keyword.strip()}))
+        if not case_sensitive:
+            normalized = normalized.lower()
+        return query_type + "|" + ("cs" if case_sensitive else "ci") + "|" + normalized
+
+    def get(self, keywords: list, query_type: str, case_sensitive: bool = True):
+        """get a cached result
+
+        Args:
+            keywords (list): the keywords of the query
+            query_type (str): the type of query, e.g. count or docid
+            case_sensitive (bool): optional, whether the query is case sensitive
+        Returns:
+            the cached result or None if the entry is missing or expired
+        """
+        key = self.make_key(keywords, query_type, case_sensitive)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created FROM query_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                TPC_CACHE_REQUESTS.inc(result="miss")
+                if row is not None:
+                    self._conn.execute("DELETE FROM query_cache WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE query_cache SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            TPC_CACHE_REQUESTS.inc(result="hit")
+        return json.loads(row[0])
+
+    def set(self, keywords: list, query_type: str, value, case_sensitive: bool = True):
+        """store a result in the cache, evicting the least recently used entries if the cache is full
+
+        Args:
+            keywords (list): the keywords of the query
+            query_type (str): the type of query, e.g. count or docid
+            value: the result to store. Must be JSON serializable
+            case_sensitive (bool): optional, whether the query is case sensitive
+        """
+        key = self.make_key(keywords, query_type, case_sensitive)
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO query_cache (key, value, created, accessed) "
+                               "VALUES (?, ?, ?, ?)", (key, json.dumps(value), now, now))
+            num_entries = self._conn.execute("SELECT COUNT(*) FROM query_cache").fetchone()[0]
+            if num_entries > self.max_entries:
+                # evict a bit more than needed so that the next inserts do not trigger an eviction each
+                num_to_evict = num_entries - self.max_entries + max(1, self.max_entries // 20)
+                self._conn.execute("DELETE FROM query_cache WHERE key IN (SELECT key FROM query_cache "
+                                   "ORDER BY accessed LIMIT ?)", (num_to_evict,))
+                logger.debug("Evicted " + str(num_to_evict) + " entries from query cache")
+
+    def get_corpus_version(self):
+        row = self._conn.execute("SELECT value FROM cache_meta WHERE name = 'corpus_version'").fetchone()
+        return row[0] if row else None
+
+    def invalidate(self, corpus_version: str = None):
+        """drop all the cached results, e.g. after the corpus has been re-indexed
+
+        Args:
+            corpus_version (str): optional, the new version of the corpus to record
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM query_cache")
+            self._conn.execute("INSERT OR REPLACE INTO cache_meta (name, value) VALUES ('corpus_version', ?)",
+                               (corpus_version,))
+        logger.info("Query cache invalidated. Corpus version: " + str(corpus_version))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM query_cache").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the Textpresso query cache")
+    parser.add_argument("cache_path", metavar="cache_path", type=str, help="path to the cache file")
+    parser.add_argument("-i", "--invalidate", dest="invalidate", action="store_true",
+                        help="drop all the cached results")
+    parser.add_argument("-v", "--corpus-version", metavar="corpus_version", dest="corpus_version", type=str,
+                        default=None, help="version of the corpus to record when invalidating the cache")
+    args = parser.parse_args()
+    logging.basicConfig(level="INFO", format='%(asctime)s - %(name)s - %(levelname)s:%(message)s')
+
+    cache = QueryCache(args.cache_path)
+    if args.invalidate:
+        cache.invalidate(args.corpus_version)
+    print("Entries: " + str(len(cache)), "Corpus version: " + str(cache.get_corpus_version()), sep="\t")
+    cache.close()
+
+
+if __name__ == '__main__':
+    main()
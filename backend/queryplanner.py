@@ -0,0 +1,116 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_BATCH_SIZE = 500
+MIN_BATCH_SIZE = 10
+MAX_BATCH_SIZE = 5000
+MAX_KEYWORDS_CHARS = 30000
+TARGET_LATENCY = 10.0
+MAX_RESULTS_PER_BATCH = 10000
+
+
+class TokenBucket(object):
+    """thread-safe token bucket limiting the rate of the requests sent to an API
+
+    Args:
+        rate (float): the number of tokens added each second
+        capacity (float): optional, the maximum number of tokens, i.e. the size of the allowed bursts
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, tokens: float = 1):
+        """consume the requested number of tokens if they are available, without waiting
+
+        Returns:
+            float: 0 if the tokens were consumed, the time to wait before they are available otherwise, in seconds
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens: float = 1):
+        """wait until the requested number of tokens is available and consume them"""
+        wait_time = self.try_acquire(tokens)
+        while wait_time > 0:
+            time.sleep(wait_time)
+            wait_time = self.try_acquire(tokens)
+
+
+class QueryPlanner(object):
+    """split a list of keywords into batches for Textpresso queries, adapting their size to the observed requests
+
+    Every keyword is included in exactly one batch. Batches are bounded by a number of keywords, which shrinks when
+    requests are slow or return too many results and grows when they are fast, and by the length of the joined
+    keyword string sent to the API.
+
+    Args:
+        batch_size (int): optional, the initial number of keywords in each batch
+        min_batch_size (int): optional, the minimum number of keywords in each batch
+        max_batch_size (int): optional, the maximum number of keywords in each batch
+        max_keywords_chars (int): optional, the maximum length of the joined keywords of a batch
+        target_latency (float): optional, the desired time to process a batch, in seconds
+        max_results (int): optional, the desired maximum number of results for a batch
+    """
+
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE, min_batch_size: int = MIN_BATCH_SIZE,
+                 max_batch_size: int = MAX_BATCH_SIZE, max_keywords_chars: int = MAX_KEYWORDS_CHARS,
+                 target_latency: float = TARGET_LATENCY, max_results: int = MAX_RESULTS_PER_BATCH):
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.max_keywords_chars = max_keywords_chars
+        self.target_latency = target_latency
+        self.max_results = max_results
+
+    def iter_batches(self, keywords: list):
+        """split the keywords into batches, sized according to the observations recorded so far
+
+        Returns:
+            generator: the batches, as lists of keywords
+        """
+        start = 0
+        while start < len(keywords):
+            end = start
+            num_chars = 0
+            while end < len(keywords) and end - start < self.batch_size:
+                num_chars += len(keywords[end]) + 1
+                if num_chars > self.max_keywords_chars and end > start:
+                    break
+                end += 1
+            yield keywords[start:end]
+            start = end
+
+    def record(self, batch: list, latency: float, num_results: int):
+        """update the batch size with the latency and the number of results observed for a batch
+
+        Args:
+            batch (list): the batch that was processed
+            latency (float): the time taken to process it, in seconds
+            num_results (int): the number of results returned for it
+        """
+        new_size = self.batch_size
+        if num_results > self.max_results:
+            new_size = int(len(batch) * self.max_results / num_results)
+        elif latency > self.target_latency:
+            new_size = int(len(batch) * self.target_latency / latency)
+        elif latency < self.target_latency / 2 and len(batch) >= self.batch_size:
+            new_size = int(self.batch_size * 1.5)
+        new_size = max(self.min_batch_size, min(self.max_batch_size, new_size))
+        if new_size != self.batch_size:
+            logger.debug("Batch size changed from " + str(self.batch_size) + " to " + str(new_size))
+            self.batch_size = new_size
@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ResultWriter(object):
+    """incremental writer of the tsv result of a job. The file becomes visible only when the writer is closed"""
+
+    def __init__(self, path, columns: list):
+        self.path = path
+        self.num_rows = 0
+        self._tmp_path = path + ".part"
+        self._file = open(self._tmp_path, "w", encoding="utf-8")
+        self._file.write("\t".join(columns) + "\n")
+
+    def write_row(self, *values):
+        self._file.write("\t".join(str(value).replace("\t", " ").replace("\n", " ") for value in values) + "\n")
+        self.num_rows += 1
+
+    def close(self):
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ResultStore(object):
+    """directory of job results stored as tsv files and served in chunks without loading them in memory
+
+    Args:
+        results_dir (str): the directory where the results are stored
+    """
+
+    def __init__(self, results_dir):
+        self.results_dir = results_dir
+        os.makedirs(results_dir, exist_ok=True)
+
+    def get_path(self, job_id: str):
+        return os.path.join(self.results_dir, os.path.basename(job_id) + ".tsv")
+
+    def open_writer(self, job_id: str, columns: list):
+        return ResultWriter(self.get_path(job_id), columns)
+
+    def exists(self, job_id: str):
+        return os.path.exists(self.get_path(job_id))
+
+    def get_size(self, job_id: str):
+        return os.path.getsize(self.get_path(job_id))
+
+    def iter_tsv(self, job_id: str, chunk_size: int = CHUNK_SIZE):
+        with open(self.get_path(job_id), "rb") as result_file:
+            while True:
+                chunk = result_file.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def iter_json(self, job_id: str, chunk_size: int = CHUNK_SIZE):
+        """stream the result as a json object with a `columns` list and a `rows` list of lists"""
+        with open(self.get_path(job_id), encoding="utf-8") as result_file:
+            columns = result_file.readline().rstrip("\n").split("\t")
+            buffer = ['{"columns": ' + json.dumps(columns) + ', "rows": [']
+            buffer_len = 0
+            separator = ""
+            for line in result_file:
+                row = json.dumps(line.rstrip("\n").split("\t"))
+                buffer.append(separator + row)
+                buffer_len += len(row)
+                separator = ", "
+                if buffer_len >= chunk_size:
+                    yield "".join(buffer).encode("utf-8")
+                    buffer = []
+                    buffer_len = 0
+            buffer.append("]}")
+            yield "".join(buffer).encode("utf-8")
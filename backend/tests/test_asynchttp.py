@@ -0,0 +1,188 @@
+import asyncio
+
+import pytest
+
+from backend.asynchttp import AsyncHTTPClient
+from backend.httpclient import HTTPError
+
+
+def ok(body: bytes, extra_headers: bytes = b""):
+    return b"HTTP/1.1 200 OK\r\nContent-Length: " + str(len(body)).encode() + b"\r\n" + extra_headers + b"\r\n" + body
+
+
+class ScriptedServer(object):
+    """in-process server answering each request with the next (raw response, close connection) tuple of a script"""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        # (connection number, method, path, headers, body) of each request received
+        self.requests = []
+        self.num_connections = 0
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.base_url = "http://127.0.0.1:" + str(self.server.sockets[0].getsockname()[1])
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        conn_num = self.num_connections
+        self.num_connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                self.requests.append((conn_num, method, path, headers, body))
+                response, close = self.responses.pop(0)
+                writer.write(response)
+                await writer.drain()
+                if close:
+                    break
+        finally:
+            writer.close()
+
+
+def run_script(responses, requests, **client_args):
+    """send requests, (method, path, body) tuples, one after the other to a server answering with a script
+
+    Returns:
+        tuple: the responses or the exceptions raised for each request, and the server
+    """
+    # a response framed wrongly by the client makes it wait for bytes that never come
+    client_args.setdefault("timeout", 2)
+
+    async def run():
+        async with ScriptedServer(responses) as server:
+            client = AsyncHTTPClient(server.base_url + "/api", **client_args)
+            results = []
+            try:
+                for method, path, body in requests:
+                    try:
+                        results.append(await client.request(method, path, body=body))
+                    except HTTPError as e:
+                        results.append(e)
+            finally:
+                client.close()
+            return results, server
+    return asyncio.run(run())
+
+
+def test_content_length_responses_reuse_the_connection():
+    results, server = run_script([(ok(b"first"), False), (ok(b"second"), False)],
+                                 [("POST", "/search?x=1", b"{\"q\": 1}"), ("GET", "/count", None)])
+    assert [(response.status, response.body) for response in results] == [(200, b"first"), (200, b"second")]
+    assert [(conn_num, method, path, body) for conn_num, method, path, headers, body in server.requests] == \
+        [(0, "POST", "/api/search?x=1", b"{\"q\": 1}"), (0, "GET", "/api/count", b"")]
+    assert server.requests[0][3]["host"] == server.base_url[len("http://"):]
+    assert server.num_connections == 1
+
+
+def test_chunked_response_with_extensions_and_trailers():
+    chunked = (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+               b"5;name=value\r\nhello\r\n6\r\n world\r\n0\r\nX-Checksum: 1\r\n\r\n")
+    results, server = run_script([(chunked, False), (ok(b"next"), False)],
+                                 [("GET", "/a", None), ("GET", "/b", None)])
+    assert results[0].body == b"hello world"
+    assert results[1].body == b"next"
+    assert server.num_connections == 1
+
+
+def test_body_delimited_by_end_of_connection():
+    results, server = run_script([(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n\r\nuntil eof", True),
+                                  (ok(b"next"), False)],
+                                 [("GET", "/a", None), ("GET", "/b", None)])
+    assert results[0].body == b"until eof"
+    assert results[1].body == b"next"
+    assert server.num_connections == 2
+
+
+def test_connection_close_header_is_honored():
+    # the server leaves the connection open, the client must not reuse it
+    results, server = run_script([(ok(b"closing", b"Connection: close\r\n"), False), (ok(b"next"), False)],
+                                 [("GET", "/a", None), ("GET", "/b", None)])
+    assert [response.body for response in results] == [b"closing", b"next"]
+    assert [conn_num for conn_num, method, path, headers, body in server.requests] == [0, 1]
+
+
+def test_5xx_responses_and_closed_connections_are_retried():
+    unavailable = b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 4\r\n\r\nbusy"
+    results, server = run_script([(b"", True), (unavailable, False), (ok(b"done"), False)],
+                                 [("GET", "/a", None)], max_retries=2, backoff_factor=0)
+    assert results[0].status == 200 and results[0].body == b"done"
+    assert len(server.requests) == 3
+
+
+def test_retries_are_bounded_and_client_errors_are_not_retried():
+    error = b"HTTP/1.1 500 Internal Server Error\r\nContent-Length: 4\r\n\r\noops"
+    not_found = b"HTTP/1.1 404 Not Found\r\nContent-Length: 7\r\n\r\nmissing"
+    results, server = run_script([(error, False), (error, False), (not_found, False)],
+                                 [("GET", "/a", None), ("GET", "/b", None)], max_retries=1, backoff_factor=0)
+    assert isinstance(results[0], HTTPError) and results[0].status == 500 and results[0].body == b"oops"
+    assert isinstance(results[1], HTTPError) and results[1].status == 404
+    assert len(server.requests) == 3
+
+
+def test_not_modified_and_head_responses_have_no_body():
+    # Content-Length describes the representation, not a body following these responses
+    not_modified = b"HTTP/1.1 304 Not Modified\r\nETag: \"v1\"\r\nContent-Length: 100\r\n\r\n"
+    head = b"HTTP/1.1 200 OK\r\nContent-Length: 1000\r\n\r\n"
+    results, server = run_script([(not_modified, False), (head, False), (ok(b"body"), False)],
+                                 [("GET", "/a.pdf", None), ("HEAD", "/a.pdf", None), ("GET", "/b.pdf", None)])
+    assert (results[0].status, results[0].headers["etag"], results[0].body) == (304, "\"v1\"", b"")
+    assert (results[1].status, results[1].body) == (200, b"")
+    assert results[2].body == b"body"
+    assert server.num_connections == 1
+
+
+@pytest.mark.parametrize("max_connections", [1, 3])
+def test_requests_in_flight_are_bounded_by_the_connections(max_connections):
+    async def run():
+        async with ScriptedServer([(ok(b"x"), False)] * 6) as server:
+            client = AsyncHTTPClient(server.base_url, max_connections=max_connections)
+            try:
+                results = await asyncio.gather(*(client.request("GET", "/" + str(i)) for i in range(6)))
+            finally:
+                client.close()
+            return results, server
+    results, server = asyncio.run(run())
+    assert [response.body for response in results] == [b"x"] * 6
+    assert server.num_connections == max_connections
+
+
+def redirect(status: int, location: str):
+    return b"HTTP/1.1 " + str(status).encode() + b" Moved\r\nLocation: " + location.encode() + \
+        b"\r\nContent-Length: 5\r\n\r\nmoved"
+
+
+def test_redirects_on_the_same_host_are_followed():
+    results, server = run_script([(redirect(302, "b.pdf"), False), (redirect(303, "/other?x=1"), False),
+                                  (ok(b"pdf"), False)],
+                                 [("POST", "/files/a.pdf", b"{}")])
+    assert (results[0].status, results[0].body) == (200, b"pdf")
+    assert [(method, path, body) for conn_num, method, path, headers, body in server.requests] == \
+        [("POST", "/api/files/a.pdf", b"{}"), ("GET", "/api/files/b.pdf", b""), ("GET", "/other?x=1", b"")]
+    assert server.num_connections == 1
+
+
+def test_redirects_that_cannot_be_followed_raise():
+    results, server = run_script([(redirect(301, "https://elsewhere.org/a.pdf"), False),
+                                  (b"HTTP/1.1 302 Found\r\nContent-Length: 0\r\n\r\n", False)] +
+                                 [(redirect(307, "/api/loop"), False)] * 6,
+                                 [("GET", "/a.pdf", None), ("GET", "/b.pdf", None), ("GET", "/loop", None)])
+    assert [(result.status, result.reason) for result in results] == \
+        [(301, "Moved"), (302, "Found"), (307, "too many redirects")]
+    assert all(isinstance(result, HTTPError) for result in results)
+    assert len(server.requests) == 8
@@ -0,0 +1,111 @@
+import pytest
+
+from backend.benchmarks.stubs import FakeCorpus, TextpressoStubServer
+from backend.checkpoint import Checkpoint, load_completed_run
+from backend.queryplanner import QueryPlanner
+from backend.tpcmanager import TPCManager
+from backend.varindex import VariationIndex
+
+VARIATIONS = ["WBVar" + str(num).zfill(8) for num in range(200)]
+
+
+@pytest.fixture
+def checkpoint_path(tmp_path):
+    return str(tmp_path / "run.sqlite")
+
+
+@pytest.fixture
+def textpresso():
+    with TextpressoStubServer(FakeCorpus(num_docs=2000, hit_ratio=0.3)) as server:
+        yield server, TPCManager("", api_base_url=server.base_url)
+
+
+class InterruptedTPCManager(TPCManager):
+    """Textpresso manager failing once a number of queries for documents have been sent"""
+
+    def __init__(self, max_queries: int, **kwargs):
+        super().__init__("", **kwargs)
+        self.max_queries = max_queries
+
+    def get_all_pages(self, page_func, keywords: list, num_docs: int = None, page_size: int = 200):
+        if self.max_queries == 0:
+            raise ConnectionError("interrupted")
+        self.max_queries -= 1
+        return super().get_all_pages(page_func, keywords, num_docs, page_size)
+
+
+def test_progress_is_resumed_for_the_same_variations(checkpoint_path):
+    checkpoint = Checkpoint(checkpoint_path, ["ok1", "ok2", "ok3"])
+    checkpoint.save_postings([("ok1", [("doc1", "WBPaper00000001")]), ("ok2", [])])
+    checkpoint.save_batch_docs(["ok3"], [("doc2", "WBPaper00000002")])
+    checkpoint.save_paper_count("00000001", 4)
+    checkpoint.close()
+    # the order and the duplicates of the list do not matter
+    checkpoint = Checkpoint(checkpoint_path, ["ok3", "ok1", "ok2", "ok1"])
+    assert checkpoint.get_postings() == {"ok1": [("doc1", "WBPaper00000001")], "ok2": []}
+    assert checkpoint.get_batch_docs() == [(["ok3"], [("doc2", "WBPaper00000002")])]
+    assert checkpoint.get_paper_counts() == [("00000001", 4)]
+    checkpoint.close()
+
+
+def test_a_different_list_of_variations_needs_a_restart(checkpoint_path):
+    checkpoint = Checkpoint(checkpoint_path, ["ok1", "ok2"])
+    checkpoint.save_paper_count("00000001", 4)
+    checkpoint.close()
+    with pytest.raises(ValueError):
+        Checkpoint(checkpoint_path, ["ok1", "ok2", "ok3"])
+    checkpoint = Checkpoint(checkpoint_path, ["ok1", "ok2", "ok3"], restart=True)
+    assert checkpoint.get_num_paper_counts() == 0
+    checkpoint.close()
+    Checkpoint(checkpoint_path, ["ok1", "ok2", "ok3"]).close()
+
+
+def test_only_completed_runs_are_loaded(checkpoint_path):
+    checkpoint = Checkpoint(checkpoint_path, ["ok2", "ok1"])
+    checkpoint.save_batch_docs(["ok1", "ok2"], [("doc1", "WBPaper00000001")])
+    checkpoint.save_paper_count("00000001", 2)
+    with pytest.raises(ValueError):
+        load_completed_run(checkpoint_path)
+    checkpoint.mark_complete()
+    checkpoint.close()
+    previous_run = load_completed_run(checkpoint_path)
+    assert previous_run.variations == ["ok1", "ok2"]
+    assert previous_run.docs == {"doc1": "WBPaper00000001"}
+    assert previous_run.paper_counts == {"00000001": 2}
+
+
+# interrupted a few batches in, knowing that each batch of the split build queries the documents of several variations
+@pytest.mark.parametrize("split, max_queries", [(False, 3), (True, 20)])
+def test_interrupted_runs_resume_where_they_stopped(checkpoint_path, textpresso, split, max_queries):
+    server, tpc_manager = textpresso
+
+    def resolve(manager, checkpoint):
+        if split:
+            index = VariationIndex.build(manager, VARIATIONS, planner=QueryPlanner(batch_size=20),
+                                         checkpoint=checkpoint)
+            return {variation: {index.docs.get_doc(doc_num) for doc_num in posting} for variation, posting in
+                    index.postings.items()}
+        return set(VariationIndex.resolve_docs(manager, VARIATIONS, planner=QueryPlanner(batch_size=20),
+                                               checkpoint=checkpoint).identifiers)
+
+    expected = resolve(tpc_manager, None)
+    num_requests = server.num_requests
+    resolve(tpc_manager, None)
+    full_run_requests = server.num_requests - num_requests
+
+    checkpoint = Checkpoint(checkpoint_path, VARIATIONS)
+    with pytest.raises(ConnectionError):
+        resolve(InterruptedTPCManager(max_queries, api_base_url=server.base_url), checkpoint)
+    checkpoint.close()
+    num_requests = server.num_requests
+    checkpoint = Checkpoint(checkpoint_path, VARIATIONS)
+    assert resolve(tpc_manager, checkpoint) == expected
+    assert server.num_requests - num_requests < full_run_requests
+    checkpoint.close()
+
+    # nothing is left to resolve
+    num_requests = server.num_requests
+    checkpoint = Checkpoint(checkpoint_path, VARIATIONS)
+    assert resolve(tpc_manager, checkpoint) == expected
+    assert server.num_requests == num_requests
+    checkpoint.close()
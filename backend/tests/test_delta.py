@@ -0,0 +1,73 @@
+import io
+import logging
+
+import pytest
+
+from backend.asyncengine import AsyncEngine
+from backend.benchmarks.stubs import FakeCorpus, TextpressoStubServer
+from backend.checkpoint import Checkpoint, load_completed_run
+from backend.docregistry import get_paper_id
+from backend.fulltext import FulltextResolver, TextCache, SOURCE_CACHE
+from backend.main import calculate_counts
+from backend.tpcmanager import TPCManager
+
+NAMES = ["WBVar" + str(num).zfill(8) for num in range(220)]
+# 20 variations removed from the list and 20 added
+PREVIOUS_VARIATIONS = NAMES[:200]
+VARIATIONS = NAMES[20:]
+NUM_DOCS = 1000
+
+
+@pytest.fixture(scope="module")
+def textpresso():
+    with TextpressoStubServer() as server:
+        yield server
+
+
+@pytest.fixture
+def text_cache(tmp_path):
+    # the texts do not change between the runs, the corpus gains documents for some variations
+    corpus = FakeCorpus(num_docs=NUM_DOCS, hit_ratio=0.25)
+    for name in NAMES:
+        corpus.docs_for_keyword(name)
+    text_cache = TextCache(str(tmp_path / "texts"))
+    for doc_num in range(NUM_DOCS):
+        text_cache.put(get_paper_id(corpus.accession(doc_num)),
+                       " ".join(["Paper " + str(doc_num) + "."] + corpus.fulltext_sentences(doc_num)))
+    return text_cache
+
+
+@pytest.mark.parametrize("engine_type", ["threads", "asyncio"])
+@pytest.mark.parametrize("output_type", ["TOTAL_COUNT", "VAR_COUNT_IN_PAPERS", "PAPER_COUNT_FOR_VAR"])
+def test_delta_run_prints_the_counts_of_a_full_run(tmp_path, caplog, textpresso, text_cache, output_type,
+                                                   engine_type):
+    tpc_manager = TPCManager("", api_base_url=textpresso.base_url)
+    engine = AsyncEngine(TPCManager("", api_base_url=textpresso.base_url)) if engine_type == "asyncio" else None
+    fulltext_resolver = FulltextResolver(tpc_manager, None, None, text_cache=text_cache, sources=[SOURCE_CACHE])
+
+    def run(variations, checkpoint_name=None, previous_run=None):
+        output = io.StringIO()
+        checkpoint = Checkpoint(str(tmp_path / checkpoint_name), variations) if checkpoint_name else None
+        calculate_counts(output_type, variations, tpc_manager, fulltext_resolver, output, checkpoint=checkpoint,
+                         previous_run=previous_run, engine=engine)
+        if checkpoint is not None:
+            checkpoint.mark_complete()
+            checkpoint.close()
+        return sorted(output.getvalue().splitlines())
+
+    try:
+        textpresso.httpd.corpus = FakeCorpus(num_docs=NUM_DOCS, hit_ratio=0.2)
+        run(PREVIOUS_VARIATIONS, "previous.sqlite")
+        textpresso.httpd.corpus = FakeCorpus(num_docs=NUM_DOCS, hit_ratio=0.25)
+        full_run = run(VARIATIONS)
+        with caplog.at_level(logging.INFO, logger="backend.main"):
+            delta_run = run(VARIATIONS, "delta.sqlite", load_completed_run(str(tmp_path / "previous.sqlite")))
+    finally:
+        if engine is not None:
+            engine.close()
+    assert delta_run == full_run
+    assert full_run and not any(line.endswith("\tNA") for line in full_run)
+    if output_type == "VAR_COUNT_IN_PAPERS":
+        # the papers not mapped to an added or removed variation keep the count of the previous run
+        assert any(record.getMessage().startswith("Reusing the counts of") and not
+                   record.getMessage().startswith("Reusing the counts of 0 ") for record in caplog.records)
@@ -0,0 +1,12 @@
+from backend.docregistry import DocRegistry
+
+
+def test_paper_accession_comes_from_last_registered_document():
+    docs = DocRegistry()
+    first = docs.intern("doc1", "C. elegans:WBPaper00001234")
+    second = docs.intern("doc2", "Other:WBPaper00001234")
+    assert docs.intern("doc1", "ignored:WBPaper00001234") == first
+    assert docs.get_num_papers() == 1
+    assert docs.doc_papers[first] == docs.doc_papers[second] == docs.get_paper_num("00001234")
+    assert docs.get_paper_accession(0) == "WBPaper00001234"
+    assert docs.accessions[docs.paper_last_docs[0]] == "Other:WBPaper00001234"
@@ -0,0 +1,182 @@
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from backend.jobqueue import JobQueue, JobWorkerPool, JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / "jobs.sqlite")
+
+
+def run_concurrently(funcs):
+    results = [None] * len(funcs)
+
+    def run(idx):
+        results[idx] = funcs[idx]()
+    threads = [threading.Thread(target=run, args=(idx,)) for idx in range(len(funcs))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("condition not met after " + str(timeout) + "s")
+        time.sleep(0.01)
+
+
+def test_submit_deduplicates_pending_jobs(queue_path):
+    job_queue = JobQueue(queue_path)
+    job_id, created = job_queue.submit("VAR_COUNT", ["ok1", "ok2"], "a@b.org")
+    assert created
+    assert job_queue.submit("VAR_COUNT", ["ok1", "ok2"], "a@b.org") == (job_id, False)
+    assert job_queue.submit("VAR_COUNT", ["ok1", "ok2"], "c@d.org")[1]
+    assert job_queue.submit("PAPER_COUNT", ["ok1", "ok2"], "a@b.org")[1]
+    job_queue.claim()
+    assert job_queue.submit("VAR_COUNT", ["ok1", "ok2"], "a@b.org") == (job_id, False)
+    job_queue.complete(job_id)
+    new_job_id, created = job_queue.submit("VAR_COUNT", ["ok1", "ok2"], "a@b.org")
+    assert created and new_job_id != job_id
+
+
+def test_submit_deduplicates_across_queue_instances(queue_path):
+    job_queues = [JobQueue(queue_path) for _ in range(4)]
+    results = run_concurrently([lambda job_queue=job_queue: [job_queue.submit("VAR_COUNT", ["ok1"], "a@b.org")
+                                                             for _ in range(20)] for job_queue in job_queues])
+    job_ids = {job_id for submissions in results for job_id, created in submissions}
+    assert len(job_ids) == 1
+    assert sum(created for submissions in results for job_id, created in submissions) == 1
+    assert job_queues[0].get_num_jobs(JOB_QUEUED) == 1
+
+
+def test_claim_is_exclusive_across_queue_instances(queue_path):
+    job_queue = JobQueue(queue_path)
+    submitted = {job_queue.submit("VAR_COUNT", ["ok" + str(i)], "a@b.org")[0] for i in range(50)}
+
+    def claim_all(claiming_queue):
+        claimed = []
+        job = claiming_queue.claim()
+        while job is not None:
+            assert job["state"] == JOB_RUNNING and job["attempts"] == 1
+            claimed.append(job["id"])
+            job = claiming_queue.claim()
+        return claimed
+    claimed_lists = run_concurrently([lambda: claim_all(JobQueue(queue_path)) for _ in range(2)])
+    assert sorted(claimed_lists[0] + claimed_lists[1]) == sorted(submitted)
+    assert job_queue.get_num_jobs(JOB_RUNNING) == 50
+
+
+def test_claim_returns_oldest_job_first(queue_path):
+    job_queue = JobQueue(queue_path)
+    first_id = job_queue.submit("VAR_COUNT", ["ok1"], "a@b.org")[0]
+    second_id = job_queue.submit("VAR_COUNT", ["ok2"], "a@b.org")[0]
+    assert job_queue.claim()["id"] == first_id
+    assert job_queue.claim()["id"] == second_id
+    assert job_queue.claim() is None
+
+
+def test_resume_requeues_then_fails_after_max_attempts(queue_path):
+    job_queue = JobQueue(queue_path, max_attempts=2)
+    job_id = job_queue.submit("VAR_COUNT", ["ok1"], "a@b.org")[0]
+    job_queue.claim()
+    assert job_queue.resume() == 1
+    assert job_queue.get(job_id)["state"] == JOB_QUEUED
+    assert job_queue.claim()["attempts"] == 2
+    # a new process opening the same file finds the job left running
+    restarted_queue = JobQueue(queue_path, max_attempts=2)
+    assert restarted_queue.resume() == 0
+    job = restarted_queue.get(job_id)
+    assert job["state"] == JOB_FAILED
+    assert job["error"] == "interrupted too many times"
+    assert restarted_queue.claim() is None
+
+
+def test_worker_pool_records_done_and_failed_jobs(queue_path):
+    job_queue = JobQueue(queue_path)
+    processed = []
+
+    def count(job):
+        processed.append(job["variations"])
+
+    def fail(job):
+        raise ValueError("no documents for " + job["variations"][0])
+    pool = JobWorkerPool(job_queue, {"VAR_COUNT": count, "PAPER_COUNT": fail}, num_workers=2, poll_interval=0.05)
+    pool.start()
+    try:
+        assert pool.is_running()
+        done_id = job_queue.submit("VAR_COUNT", ["ok1"], "a@b.org")[0]
+        failed_id = job_queue.submit("PAPER_COUNT", ["ok2"], "a@b.org")[0]
+        unknown_id = job_queue.submit("UNKNOWN", ["ok3"], "a@b.org")[0]
+        wait_for(lambda: job_queue.get_num_jobs(JOB_QUEUED) + job_queue.get_num_jobs(JOB_RUNNING) == 0)
+    finally:
+        pool.stop()
+    assert not pool.is_running()
+    assert processed == [["ok1"]]
+    assert job_queue.get(done_id)["state"] == JOB_DONE
+    assert job_queue.get(failed_id)["state"] == JOB_FAILED
+    assert job_queue.get(failed_id)["error"] == "no documents for ok2"
+    assert job_queue.get(unknown_id)["state"] == JOB_FAILED
+
+
+def test_worker_pool_bounds_running_jobs(queue_path):
+    job_queue = JobQueue(queue_path)
+    lock = threading.Lock()
+    running = [0]
+    max_running = [0]
+
+    def slow(job):
+        with lock:
+            running[0] += 1
+            max_running[0] = max(max_running[0], running[0])
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+    pool = JobWorkerPool(job_queue, {"VAR_COUNT": slow}, num_workers=3, poll_interval=0.05)
+    pool.start()
+    try:
+        for i in range(12):
+            job_queue.submit("VAR_COUNT", ["ok" + str(i)], "a@b.org")
+        wait_for(lambda: job_queue.get_num_jobs(JOB_DONE) == 12)
+    finally:
+        pool.stop()
+    assert max_running[0] == 3
+
+
+def _claim_in_child(queue_path):
+    JobQueue(queue_path).claim()
+
+
+def test_resume_only_requeues_jobs_of_given_process(queue_path):
+    job_queue = JobQueue(queue_path)
+    child_job_id = job_queue.submit("VAR_COUNT", ["ok1"], "a@b.org")[0]
+    own_job_id = job_queue.submit("VAR_COUNT", ["ok2"], "a@b.org")[0]
+    child = multiprocessing.Process(target=_claim_in_child, args=(queue_path,))
+    child.start()
+    child.join()
+    assert job_queue.get(child_job_id)["worker_pid"] == child.pid
+    assert job_queue.claim()["worker_pid"] == os.getpid()
+    assert job_queue.resume(worker_pid=child.pid) == 1
+    assert job_queue.get(child_job_id)["state"] == JOB_QUEUED
+    assert job_queue.get(child_job_id)["worker_pid"] is None
+    assert job_queue.get(own_job_id)["state"] == JOB_RUNNING
+
+
+def test_open_adds_worker_pid_column_to_existing_database(queue_path):
+    conn = sqlite3.connect(queue_path)
+    conn.execute("CREATE TABLE jobs (id TEXT PRIMARY KEY, type TEXT NOT NULL, variations TEXT NOT NULL, "
+                 "reply_to TEXT NOT NULL, dedup_key TEXT NOT NULL, state TEXT NOT NULL, attempts INTEGER NOT NULL "
+                 "DEFAULT 0, error TEXT, created REAL NOT NULL, started REAL, finished REAL)")
+    conn.close()
+    job_queue = JobQueue(queue_path)
+    job_queue.submit("VAR_COUNT", ["ok1"], "a@b.org")
+    assert job_queue.claim()["worker_pid"] == os.getpid()
@@ -0,0 +1,58 @@
+import random
+
+from backend.matcher import MentionMatcher
+
+
+def count_by_scanning(patterns, text):
+    """count the mentions of each pattern by checking every position of the text"""
+    counts = {}
+    for pattern in dict.fromkeys(patterns):
+        for start in range(len(text) - len(pattern) + 1):
+            end = start + len(pattern)
+            if text[start:end] != pattern:
+                continue
+            if pattern[0].isalnum() and start > 0 and text[start - 1].isalnum():
+                continue
+            if pattern[-1].isalnum() and end < len(text) and text[end].isalnum():
+                continue
+            counts[pattern] = counts.get(pattern, 0) + 1
+    return counts
+
+
+def test_names_are_not_counted_inside_longer_names():
+    matcher = MentionMatcher(["ok100", "ok1001"])
+    counts = matcher.count("ok100 and ok1001 differ, xok100 and ok100a are other names")
+    assert counts == {"ok100": 1, "ok1001": 1}
+
+
+def test_punctuation_delimits_names():
+    matcher = MentionMatcher(["ok100"])
+    assert matcher.count_total("(ok100), [ok100]; ok100-ok100. ok100") == 5
+    assert matcher.count_total("ok100_ok100") == 2
+
+
+def test_overlapping_names_are_each_counted():
+    matcher = MentionMatcher(["unc-13", "unc-13(e1091)", "e1091"])
+    assert matcher.count("the unc-13(e1091) allele") == {"unc-13": 1, "unc-13(e1091)": 1, "e1091": 1}
+    assert matcher.count("unc-130 and unc-13") == {"unc-13": 1}
+
+
+def test_matching_is_case_sensitive():
+    assert MentionMatcher(["ok100"]).count_total("OK100 Ok100 ok100") == 1
+
+
+def test_duplicate_and_empty_patterns_are_ignored():
+    matcher = MentionMatcher(["ok1", "", "ok1", "ok2"])
+    assert matcher.patterns == ["ok1", "ok2"]
+    assert matcher.count_total("ok1 ok2 ok1") == 3
+
+
+def test_counts_match_a_scan_of_every_position():
+    rng = random.Random(42)
+    alphabet = "ok12 -()."
+    patterns = ["".join(rng.choice(alphabet) for _ in range(rng.randint(1, 5))) for _ in range(30)]
+    patterns = [pattern for pattern in patterns if pattern.strip()]
+    matcher = MentionMatcher(patterns)
+    for _ in range(50):
+        text = "".join(rng.choice(alphabet) for _ in range(200))
+        assert dict(matcher.count(text)) == count_by_scanning(patterns, text)
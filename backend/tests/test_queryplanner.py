@@ -0,0 +1,41 @@
+import random
+
+from backend.queryplanner import QueryPlanner
+
+
+def test_each_keyword_lands_in_exactly_one_batch_in_order():
+    rng = random.Random(7)
+    keywords = ["WBVar" + str(rng.randint(0, 10 ** 8)).zfill(8) + "x" * rng.randint(0, 40) for _ in range(5000)]
+    planner = QueryPlanner(batch_size=100, min_batch_size=5, max_batch_size=400, max_keywords_chars=2000)
+    batches = []
+    for batch in planner.iter_batches(keywords):
+        batches.append(batch)
+        # the batch size changes between batches, while the generator is running
+        planner.record(batch, rng.choice([0.1, 30.0]), rng.randint(0, 20000))
+    assert [keyword for batch in batches for keyword in batch] == keywords
+    assert all(batch for batch in batches)
+
+
+def test_batches_are_bounded_by_size_and_joined_length():
+    planner = QueryPlanner(batch_size=10, max_keywords_chars=50)
+    batches = list(planner.iter_batches(["k" + str(num).zfill(3) for num in range(25)] + ["x" * 80, "y"]))
+    assert [len(batch) for batch in batches] == [10, 10, 5, 1, 1]
+    assert all(len(" ".join(batch)) <= 50 for batch in batches[:3])
+    # a keyword longer than the bound still gets a batch of its own
+    assert batches[3] == ["x" * 80]
+
+
+def test_record_adapts_the_batch_size():
+    planner = QueryPlanner(batch_size=100, min_batch_size=10, max_batch_size=200, target_latency=10,
+                           max_results=1000)
+    planner.record(["k"] * 100, 1.0, 10)
+    assert planner.batch_size == 150
+    planner.record(["k"] * 150, 1.0, 10)
+    assert planner.batch_size == 200
+    planner.record(["k"] * 200, 40.0, 10)
+    assert planner.batch_size == 50
+    planner.record(["k"] * 50, 1.0, 5000)
+    assert planner.batch_size == 10
+    # a fast batch smaller than the current size, e.g. the last one of a list, does not grow it
+    planner.record(["k"] * 3, 1.0, 0)
+    assert planner.batch_size == 10
@@ -0,0 +1,74 @@
+import pytest
+
+from backend.asyncengine import AsyncEngine
+from backend.benchmarks.stubs import FakeCorpus, TextpressoStubServer
+from backend.queryplanner import QueryPlanner
+from backend.tpcmanager import TPCManager, PAGE_SIZE
+from backend.varindex import VariationIndex
+
+VARIATIONS = ["WBVar" + str(num).zfill(8) for num in range(300)]
+
+
+class RecordingPlanner(QueryPlanner):
+    """planner keeping the batches it was told about"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.batches = []
+
+    def record(self, batch: list, latency: float, num_results: int):
+        self.batches.append((list(batch), num_results))
+        super().record(batch, latency, num_results)
+
+
+@pytest.fixture(params=[0.05, 0.3])
+def textpresso(request):
+    with TextpressoStubServer(FakeCorpus(num_docs=2000, hit_ratio=request.param)) as server:
+        yield server, TPCManager("", api_base_url=server.base_url)
+
+
+def test_split_postings_match_the_variations_resolved_one_by_one(textpresso):
+    server, tpc_manager = textpresso
+    index = VariationIndex.build(tpc_manager, VARIATIONS, planner=QueryPlanner(batch_size=50))
+    assert list(index.postings) == VARIATIONS
+    for variation in VARIATIONS:
+        docs = tpc_manager.get_all_pages(tpc_manager.get_doc_matching, [variation])
+        assert len(index.postings[variation]) == tpc_manager.get_doc_count([variation]) == len(docs)
+        assert {index.docs.get_doc(doc_num) for doc_num in index.postings[variation]} == set(docs)
+
+
+def test_resolved_documents_are_the_union_of_the_variation_documents(textpresso):
+    server, tpc_manager = textpresso
+    corpus = server.httpd.corpus
+    docs = VariationIndex.resolve_docs(tpc_manager, VARIATIONS, planner=QueryPlanner(batch_size=50))
+    expected = {corpus.identifier(doc_num) for variation in VARIATIONS for doc_num in
+                corpus.docs_for_keyword(variation)}
+    assert set(docs.identifiers) == expected and len(docs) == len(expected)
+    index = VariationIndex.build(tpc_manager, VARIATIONS)
+    assert set(docs.identifiers) == set(index.docs.identifiers)
+
+
+def test_batches_are_resolved_with_a_count_and_their_pages(textpresso):
+    server, tpc_manager = textpresso
+    planner = RecordingPlanner(batch_size=50)
+    num_requests = server.num_requests
+    VariationIndex.resolve_docs(tpc_manager, VARIATIONS + [" ", VARIATIONS[0]], planner=planner)
+    assert [variation for batch, num_docs in planner.batches for variation in batch] == VARIATIONS
+    assert server.num_requests - num_requests == sum(1 + -(-num_docs // PAGE_SIZE) for batch, num_docs in
+                                                     planner.batches)
+
+
+def test_asyncio_engine_resolves_the_same_documents(textpresso):
+    server, tpc_manager = textpresso
+    engine = AsyncEngine(TPCManager("", api_base_url=server.base_url))
+    try:
+        docs = engine.resolve_docs(VARIATIONS, planner=QueryPlanner(batch_size=50))
+        index = engine.build_index(VARIATIONS, planner=QueryPlanner(batch_size=50))
+    finally:
+        engine.close()
+    # the batches in flight are planned before the previous ones are recorded, so the documents come in another order
+    assert set(docs.identifiers) == set(VariationIndex.resolve_docs(tpc_manager, VARIATIONS).identifiers)
+    expected = VariationIndex.build(tpc_manager, VARIATIONS)
+    assert {variation: {index.docs.get_doc(doc_num) for doc_num in posting} for variation, posting in
+            index.postings.items()} == {variation: {expected.docs.get_doc(doc_num) for doc_num in posting} for
+                                        variation, posting in expected.postings.items()}
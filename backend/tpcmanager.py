@@ -1,20 +1,103 @@
-import gzip
 import json
 import logging
 import os
-import ssl
-import urllib.request
+
+from backend.koalleles import iter_variation_ids, KO_ALLELES_URL, DEFAULT_RELEASE
+from backend.httpclient import PooledHTTPClient, HTTPError, imap_concurrently
+from backend.metrics import TPC_REQUEST_SECONDS, TPC_REQUEST_ERRORS, TPC_RESPONSE_BYTES
+from backend.querycache import QueryCache
+from backend.queryplanner import TokenBucket
 
 logger = logging.getLogger(__name__)
 
 
+TPC_API_BASE_URL = "https://www.alliancegenome.org/textpresso/wb/v1/textpresso/api"
+PAGE_SIZE = 200
+
+
+def check_fulltext_error(accession: str, error: Exception):
+    """decide whether a failed fulltext request only means that the text is not available from Textpresso
+
+    A missing document is a plain miss. Other client errors, e.g. an invalid token, are raised, since all the other
+    documents would fail the same way. Server and connection errors are logged and treated as a miss, so that the paper
+    falls back to the next fulltext source.
+
+    Raises:
+        HTTPError: if the error is a client error other than 404
+    """
+    if isinstance(error, HTTPError) and error.status == 404:
+        logger.debug("Fulltext of " + accession + " not found in Textpresso")
+    elif isinstance(error, HTTPError) and 400 <= error.status < 500:
+        raise error
+    else:
+        logger.warning("Fulltext of " + accession + " not available from Textpresso: " + str(error))
+
+
 class TPCManager(object):
-    def __init__(self, textpresso_api_token):
+    def __init__(self, textpresso_api_token, api_base_url: str = TPC_API_BASE_URL, max_concurrency: int = 8,
+                 timeout: float = 60, max_retries: int = 3, cache: QueryCache = None,
+                 rate_limiter: TokenBucket = None, verify_tls: bool = None):
         self.textpresso_api_token = textpresso_api_token
-        self.tpc_api_endpoint = "https://www.alliancegenome.org/textpresso/wb/v1/textpresso/api/search_documents"
-        self.tpc_api_endpoint_count = "https://www.alliancegenome.org/textpresso/wb/v1/textpresso/api/get_documents_count"
-        if not os.environ.get('PYTHONHTTPSVERIFY', '') and getattr(ssl, '_create_unverified_context', None):
-            ssl._create_default_https_context = ssl._create_unverified_context
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.tpc_api_endpoint = "/search_documents"
+        self.tpc_api_endpoint_count = "/get_documents_count"
+        self.max_concurrency = max_concurrency
+        self.api_base_url = api_base_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        # certificates are only verified when PYTHONHTTPSVERIFY is set, unless stated otherwise. This only applies to
+        # the connections to Textpresso, the default context of the process is left untouched
+        if verify_tls is None:
+            verify_tls = bool(os.environ.get('PYTHONHTTPSVERIFY', ''))
+        self.http_client = PooledHTTPClient(api_base_url, max_connections=max_concurrency, timeout=timeout,
+                                            max_retries=max_retries, verify_tls=verify_tls)
+
+    # queries and parsing shared with the asyncio engine
+    def count_query(self, keywords: list):
+        return {"token": self.textpresso_api_token, "query": {
+            "keywords": " ".join(keywords), "type": "document", "corpora": ["C. elegans"], "case_sensitive": True}}
+
+    def doc_matching_query(self, keywords: list, start: int, count: int):
+        return {"token": self.textpresso_api_token, "query": {
+            "keywords": " ".join(keywords), "type": "document", "corpora": ["C. elegans"], "since_num": start,
+            "count": count, "case_sensitive": True}}
+
+    @staticmethod
+    def parse_doc_matching(result):
+        return [(doc["identifier"], doc["accession"]) for doc in result]
+
+    def doc_sentences_query(self, keywords: list, start: int, count: int):
+        return {"token": self.textpresso_api_token, "query": {
+            "keywords": " ".join(keywords), "type": "sentence", "corpora": ["C. elegans"], "since_num": start,
+            "count": count, "case_sensitive": True}, "include_match_sentences": True}
+
+    @staticmethod
+    def parse_doc_sentences(result):
+        return [(doc["identifier"], doc["accession"], doc["title"] + " ".join(doc["matched_sentences"])) for doc in
+                result]
+
+    def fulltext_query(self, accession: str):
+        return {"token": self.textpresso_api_token, "query": {
+            "accession": accession[-15:], "type": "document", "corpora": ["C. elegans"]},
+            "include_all_sentences": True}
+
+    @staticmethod
+    def parse_fulltext(result):
+        return " ".join(result[0]["all_sentences"]) if result else None
+
+    def _send_request(self, endpoint, query):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        data = json.dumps(query).encode('utf-8')
+        try:
+            with TPC_REQUEST_SECONDS.time(endpoint=endpoint):
+                response = self.http_client.post_json(endpoint, data)
+        except Exception:
+            TPC_REQUEST_ERRORS.inc(endpoint=endpoint)
+            raise
+        TPC_RESPONSE_BYTES.inc(len(response), endpoint=endpoint)
+        return json.loads(response.decode('utf-8'))
 
     def get_doc_count(self, keywords: list):
         """get count of papers in the C. elegans literature that mention any of the specified keywords
@@ -25,16 +108,17 @@ class TPCManager(object):
         Returns:
             int: the number of documents matching the query
         """
-        data = json.dumps({"token": self.textpresso_api_token, "query": {
-            "keywords": " ".join(keywords), "type": "document", "corpora": ["C. elegans"], "case_sensitive": True}})
-        data = data.encode('utf-8')
-        req = urllib.request.Request(self.tpc_api_endpoint_count, data, headers={'Content-type': 'application/json',
-                                                                                 'Accept': 'application/json'})
-        res = urllib.request.urlopen(req)
+        if self.cache is not None:
+            num_docs = self.cache.get(keywords, "count")
+            if num_docs is not None:
+                return num_docs
         logger.debug("Sending a document count request to Textpresso Central API")
-        return int(json.loads(res.read().decode('utf-8')))
+        num_docs = int(self._send_request(self.tpc_api_endpoint_count, self.count_query(keywords)))
+        if self.cache is not None:
+            self.cache.set(keywords, "count", num_docs)
+        return num_docs
 
-    def get_doc_matching_with_fulltext(self, keywords: list, start: int = 0, count: int = 200):
+    def get_doc_matching_with_fulltext(self, keywords: list, start: int = 0, count: int = PAGE_SIZE):
         """get list of papers in the C. elegans literature that mention any of the specified keywords
            from Textpresso Central API
 
@@ -45,18 +129,11 @@ class TPCManager(object):
         Returns:
             list: the documents matching the query
         """
-        data = json.dumps({"token": self.textpresso_api_token, "query": {
-            "keywords": " ".join(keywords), "type": "sentence", "corpora": ["C. elegans"], "since_num": start,
-            "count": count, "case_sensitive": True}, "include_match_sentences": True})
-        data = data.encode('utf-8')
-        req = urllib.request.Request(self.tpc_api_endpoint, data, headers={'Content-type': 'application/json',
-                                                                           'Accept': 'application/json'})
-        res = urllib.request.urlopen(req)
         logger.debug("Sending a request to retrieve documents to Textpresso Central API")
-        return [(doc["identifier"], doc["accession"], doc["title"] +
-                 " ".join(doc["matched_sentences"])) for doc in json.loads(res.read().decode('utf-8'))]
+        return self.parse_doc_sentences(self._send_request(self.tpc_api_endpoint,
+                                                           self.doc_sentences_query(keywords, start, count)))
 
-    def get_doc_matching(self, keywords: list, start: int = 0, count: int = 200):
+    def get_doc_matching(self, keywords: list, start: int = 0, count: int = PAGE_SIZE):
         """get list of papers in the C. elegans literature that mention any of the specified keywords
            from Textpresso Central API
 
@@ -67,17 +144,11 @@ class TPCManager(object):
         Returns:
             list: the documents matching the query
         """
-        data = json.dumps({"token": self.textpresso_api_token, "query": {
-            "keywords": " ".join(keywords), "type": "document", "corpora": ["C. elegans"], "since_num": start,
-            "count": count, "case_sensitive": True}})
-        data = data.encode('utf-8')
-        req = urllib.request.Request(self.tpc_api_endpoint, data, headers={'Content-type': 'application/json',
-                                                                           'Accept': 'application/json'})
-        res = urllib.request.urlopen(req)
         logger.debug("Sending a request to retrieve documents to Textpresso Central API")
-        return [(doc["identifier"], doc["accession"]) for doc in json.loads(res.read().decode('utf-8'))]
+        return self.parse_doc_matching(self._send_request(self.tpc_api_endpoint,
+                                                           self.doc_matching_query(keywords, start, count)))
 
-    def get_docid_matching(self, keywords: list, start: int = 0, count: int = 200):
+    def get_docid_matching(self, keywords: list, start: int = 0, count: int = PAGE_SIZE):
         """get list of papers in the C. elegans literature that mention any of the specified keywords
            from Textpresso Central API
 
@@ -88,43 +159,88 @@ class TPCManager(object):
         Returns:
             list: the documents matching the query
         """
-        data = json.dumps({"token": self.textpresso_api_token, "query": {
-            "keywords": " ".join(keywords), "type": "document", "corpora": ["C. elegans"], "case_sensitive": True},
-            "count": count, "since_num": start})
-        data = data.encode('utf-8')
-        req = urllib.request.Request(self.tpc_api_endpoint, data, headers={'Content-type': 'application/json',
-                                                                           'Accept': 'application/json'})
-        res = urllib.request.urlopen(req)
         logger.debug("Sending a request to retrieve documents to Textpresso Central API")
-        return [doc["identifier"] for doc in json.loads(res.read().decode('utf-8'))]
+        return [doc["identifier"] for doc in self._send_request(self.tpc_api_endpoint, {
+            "token": self.textpresso_api_token, "query": {
+                "keywords": " ".join(keywords), "type": "document", "corpora": ["C. elegans"], "case_sensitive": True},
+            "count": count, "since_num": start})]
+
+    def iter_pages(self, page_func, keywords: list, num_docs: int = None, page_size: int = PAGE_SIZE):
+        """fetch the result pages of a query as a stream, prefetching up to max_concurrency pages ahead of the consumer
+
+        Args:
+            page_func: one of the paginated methods of this class, e.g. get_doc_matching
+            keywords (list): the keywords to search
+            num_docs (int): optional, the number of documents matching the query. Requested if not provided
+            page_size (int): optional, the number of documents in each page
+        Returns:
+            generator: the pages, in result order
+        """
+        if num_docs is None:
+            num_docs = self.get_doc_count(keywords)
+        return imap_concurrently(lambda start: page_func(keywords, start=start, count=page_size),
+                                 range(0, num_docs, page_size), self.max_concurrency)
+
+    def get_all_pages(self, page_func, keywords: list, num_docs: int = None, page_size: int = PAGE_SIZE):
+        """fetch all the result pages of a query in parallel, with at most max_concurrency requests in flight
+
+        Args:
+            page_func: one of the paginated methods of this class, e.g. get_doc_matching
+            keywords (list): the keywords to search
+            num_docs (int): optional, the number of documents matching the query. Requested if not provided
+            page_size (int): optional, the number of documents in each page
+        Returns:
+            list: the concatenation of all the pages, in result order
+        """
+        # full text results are too large to be worth caching
+        cacheable = self.cache is not None and page_func.__name__ in ("get_docid_matching", "get_doc_matching")
+        if cacheable:
+            docs = self.cache.get(keywords, page_func.__name__)
+            if docs is not None:
+                return [tuple(doc) if isinstance(doc, list) else doc for doc in docs]
+        docs = [doc for page in self.iter_pages(page_func, keywords, num_docs, page_size) for doc in page]
+        if cacheable:
+            self.cache.set(keywords, page_func.__name__, docs)
+        return docs
 
     def get_doc_fulltext(self, accession):
-        """get list of papers in the C. elegans literature that mention any of the specified keywords
-           from Textpresso Central API
+        """get the sentences indexed by Textpresso for a document
 
         Args:
-            accession:
+            accession (str): the accession of the document
         Returns:
-            list: the documents matching the query
+            str: the sentences of the document, None if Textpresso has no such document
         """
-        data = json.dumps({"token": self.textpresso_api_token, "query": {
-            "accession": accession[-15:], "type": "document", "corpora": ["C. elegans"]}, "include_all_sentences": True})
-        data = data.encode('utf-8')
-        req = urllib.request.Request(self.tpc_api_endpoint, data, headers={'Content-type': 'application/json',
-                                                                           'Accept': 'application/json'})
-        res = urllib.request.urlopen(req)
         logger.debug("Sending a fulltext request for " + accession[-15:])
-        return [" ".join(doc["all_sentences"]) for doc in json.loads(res.read().decode('utf-8'))][0]
+        return self.parse_fulltext(self._send_request(self.tpc_api_endpoint, self.fulltext_query(accession)))
+
+    def iter_doc_fulltexts(self, accessions: list):
+        """fetch the indexed sentences of a list of documents, with at most max_concurrency requests in flight
+
+        Args:
+            accessions (list): the accessions of the documents
+        Returns:
+            generator: (accession, fulltext) tuples, in input order. fulltext is None if the document could not be
+                fetched
+        Raises:
+            HTTPError: if a request fails with a client error other than 404, see check_fulltext_error
+        """
+        def fetch(accession):
+            try:
+                return accession, self.get_doc_fulltext(accession)
+            except Exception as e:
+                check_fulltext_error(accession, e)
+                return accession, None
+        return imap_concurrently(fetch, accessions, self.max_concurrency)
 
     @staticmethod
-    def get_ids_from_wb_ftp():
-        ret = []
-        urllib.request.urlretrieve("ftp://ftp.ebi.ac.uk/pub/databases/wormbase/releases/WS277/species/c_elegans/PRJNA13758/annotation/c_elegans.PRJNA13758.WS277.knockout_consortium_alleles.xml.gz",
-                                   "../ko_allelex.xml.gz")
-        with gzip.open("../ko_allelex.xml.gz", 'rb') as f_in:
-            for line in f_in:
-                line = line.decode('utf-8')
-                if "WBVar" in line:
-                    ret.append(line.lstrip('<name>').rstrip('</name>\n'))
-        return ret
+    def get_ids_from_wb_ftp(source: str = None):
+        """get the ids of the knockout consortium alleles
 
+        Args:
+            source (str): optional, path or url of the alleles report. The WormBase ftp file of the default release
+                is streamed if not provided
+        Returns:
+            list: the WBVar ids
+        """
+        return list(iter_variation_ids(source or KO_ALLELES_URL.format(release=DEFAULT_RELEASE)))
@@ -0,0 +1,389 @@
+import asyncio
+import logging
+import time
+from array import array
+from collections import deque
+
+from backend.checkpoint import Checkpoint
+from backend.docregistry import DocRegistry
+from backend.httpclient import map_concurrently
+from backend.matcher import MentionMatcher
+from backend.queryplanner import QueryPlanner
+from backend.tpcmanager import TPCManager
+
+logger = logging.getLogger(__name__)
+
+
+MAX_LEAF_SIZE = 4
+
+
+def get_unique_variations(variations: list):
+    """get the distinct non-empty variations of a list, stripped and in their order of first appearance"""
+    return list(dict.fromkeys(var.strip() for var in variations if var.strip()))
+
+
+def get_previous_mentions(batch: list, previous_postings: dict):
+    """get the variations of a batch mentioned in each document according to the postings of a previous run
+
+    Returns:
+        dict: the set of variations of the batch mentioned in each document identifier
+    """
+    mentions = {}
+    for variation in batch:
+        for identifier, accession in previous_postings[variation]:
+            mentions.setdefault(identifier, set()).add(variation)
+    return mentions
+
+
+def get_batch_mentions(batch: list, docs: list):
+    """get the variations of a batch mentioned in each document matching it, from the sentences matched by Textpresso
+
+    Args:
+        batch (list): the variations of the batch
+        docs (list): the (identifier, accession, matched sentences) tuples of the documents matching the batch
+    Returns:
+        dict: the set of variations of the batch mentioned in each document identifier
+    """
+    matcher = MentionMatcher(batch)
+    mentions = {}
+    for identifier, accession, text in docs:
+        mentions.setdefault(identifier, set()).update(matcher.count(text))
+    return mentions
+
+
+class VariationIndex(object):
+    """inverted index from variation names to the integer-encoded documents mentioning them
+
+    Documents are interned to dense integers by a DocRegistry and each posting list is stored as a sorted array of
+    unsigned ints. The index is only needed by the per-variation reports: the reports on the documents mentioning any
+    of the variations are computed on the documents of whole batches, see resolve_docs.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.docs = DocRegistry()
+
+    def add_posting(self, variation, docs: list):
+        """add the documents matching a variation to the index
+
+        Args:
+            variation (str): the variation name
+            docs (list): the (identifier, accession) tuples of the documents mentioning the variation
+        """
+        self.postings[variation] = array('I', sorted({self.docs.intern(identifier, accession) for
+                                                      identifier, accession in docs}))
+
+    @staticmethod
+    def build(tpc_manager: TPCManager, variations: list, planner: QueryPlanner = None, checkpoint: Checkpoint = None,
+              previous_postings: dict = None):
+        """resolve each variation to the documents mentioning it
+
+        Variations are first counted in batches sized by the query planner. Batches with no matching documents are
+        resolved with a single request, while the others are split in halves until the matching variations are
+        isolated, so that the number of requests grows with the number of mentioned variations rather than with the
+        size of the list.
+
+        The postings of a previous run are verified the same way. A batch whose document count differs from the number
+        of distinct documents in its previous postings has changed. An equal count is confirmed on the sentences
+        matched in each document, since a document can replace another one or mention one more variation of the
+        batch without changing the count: the batch is reused as is only if each document still mentions the same
+        variations of the batch. The other batches are split until the changed variations are isolated and resolved
+        again. Only the changed variations and the variations new to the list cost more than a share of the requests
+        of their batch.
+
+        Args:
+            tpc_manager (TPCManager): the Textpresso manager used to send the requests
+            variations (list): the variation names
+            planner (QueryPlanner): optional, the planner used to split the variations into batches
+            checkpoint (Checkpoint): optional, the checkpoint where the postings of each completed batch are saved.
+                The variations it already resolved are not queried again
+            previous_postings (dict): optional, the (identifier, accession) tuples of the documents mentioning each
+                variation in a previous run
+        Returns:
+            VariationIndex: the index
+        """
+        index, unique_vars, known_vars, new_vars = VariationIndex._start_build(variations, checkpoint,
+                                                                              previous_postings)
+        previous_postings = previous_postings or {}
+
+        # each function resolves a batch one level down: the postings of the variations it resolved and the
+        # (function, sub-batch) tuples of the next level
+        def resolve(batch):
+            num_docs = tpc_manager.get_doc_count(batch)
+            if num_docs == 0:
+                return [(var, []) for var in batch], []
+            if len(batch) == 1:
+                return [(batch[0], tpc_manager.get_all_pages(tpc_manager.get_doc_matching, batch, num_docs))], []
+            if len(batch) <= MAX_LEAF_SIZE:
+                return [], [(resolve, [var]) for var in batch]
+            return [], [(resolve, batch[:len(batch) // 2]), (resolve, batch[len(batch) // 2:])]
+
+        def verify(batch):
+            previous_mentions = get_previous_mentions(batch, previous_postings)
+            num_docs = tpc_manager.get_doc_count(batch)
+            # a different count is enough to know that the batch changed, an equal count has to be confirmed
+            if num_docs == len(previous_mentions) and (num_docs == 0 or get_batch_mentions(
+                    batch, tpc_manager.get_all_pages(tpc_manager.get_doc_matching_with_fulltext, batch, num_docs)) ==
+                    previous_mentions):
+                return [(var, previous_postings[var]) for var in batch], []
+            if len(batch) == 1:
+                return resolve(batch)
+            return [], [(verify, batch[:len(batch) // 2]), (verify, batch[len(batch) // 2:])]
+
+        def resolve_levels(resolve_func, batch):
+            # the splits are resolved one level at a time on a single pool, so that the number of threads is bounded
+            # by max_concurrency whatever the depth of the splits
+            resolved = {}
+            level = [(resolve_func, batch)]
+            while level:
+                results = map_concurrently(lambda task: task[0](task[1]), level, tpc_manager.max_concurrency)
+                level = []
+                for postings, next_tasks in results:
+                    resolved.update(postings)
+                    level.extend(next_tasks)
+            return [(var, resolved[var]) for var in batch]
+
+        planner = planner or QueryPlanner()
+        for resolve_func, batch_vars in ((verify, known_vars), (resolve, new_vars)):
+            for batch in planner.iter_batches(batch_vars):
+                start_time = time.monotonic()
+                postings = resolve_levels(resolve_func, batch)
+                index._add_batch(batch, postings, time.monotonic() - start_time, planner, checkpoint)
+        index._finish_build(unique_vars, previous_postings)
+        return index
+
+    @staticmethod
+    async def build_async(tpc_manager, variations: list, planner: QueryPlanner = None, checkpoint: Checkpoint = None,
+                          previous_postings: dict = None, batches_in_flight: int = 4):
+        """resolve each variation to the documents mentioning it, with the same strategy as `build` on an asyncio
+        Textpresso client
+
+        The splits of a batch are resolved concurrently and up to batches_in_flight batches are resolved at the same
+        time. The postings of the batches are added to the index and saved in the checkpoint in batch order.
+
+        Args:
+            tpc_manager (AsyncTPCManager): the asyncio Textpresso manager used to send the requests
+            variations (list): the variation names
+            planner (QueryPlanner): optional, the planner used to split the variations into batches
+            checkpoint (Checkpoint): optional, the checkpoint where the postings of each completed batch are saved.
+                The variations it already resolved are not queried again
+            previous_postings (dict): optional, the (identifier, accession) tuples of the documents mentioning each
+                variation in a previous run
+            batches_in_flight (int): optional, the maximum number of batches resolved at the same time
+        Returns:
+            VariationIndex: the index
+        """
+        index, unique_vars, known_vars, new_vars = VariationIndex._start_build(variations, checkpoint,
+                                                                              previous_postings)
+        previous_postings = previous_postings or {}
+
+        async def resolve(batch):
+            num_docs = await tpc_manager.get_doc_count(batch)
+            if num_docs == 0:
+                return [(var, []) for var in batch]
+            if len(batch) == 1:
+                return [(batch[0], await tpc_manager.get_all_docs(batch, num_docs))]
+            if len(batch) <= MAX_LEAF_SIZE:
+                sub_batches = [[var] for var in batch]
+            else:
+                sub_batches = [batch[:len(batch) // 2], batch[len(batch) // 2:]]
+            return [posting for sub_result in await asyncio.gather(*(resolve(sub_batch) for sub_batch in sub_batches))
+                    for posting in sub_result]
+
+        async def verify(batch):
+            previous_mentions = get_previous_mentions(batch, previous_postings)
+            num_docs = await tpc_manager.get_doc_count(batch)
+            # a different count is enough to know that the batch changed, an equal count has to be confirmed
+            if num_docs == len(previous_mentions) and (num_docs == 0 or get_batch_mentions(
+                    batch, await tpc_manager.get_all_doc_sentences(batch, num_docs)) == previous_mentions):
+                return [(var, previous_postings[var]) for var in batch]
+            if len(batch) == 1:
+                return await resolve(batch)
+            sub_batches = [batch[:len(batch) // 2], batch[len(batch) // 2:]]
+            return [posting for sub_result in await asyncio.gather(*(verify(sub_batch) for sub_batch in sub_batches))
+                    for posting in sub_result]
+
+        async def timed(resolve_func, batch):
+            start_time = time.monotonic()
+            postings = await resolve_func(batch)
+            return batch, postings, time.monotonic() - start_time
+
+        planner = planner or QueryPlanner()
+        pending = deque()
+        try:
+            for resolve_func, batch_vars in ((verify, known_vars), (resolve, new_vars)):
+                for batch in planner.iter_batches(batch_vars):
+                    pending.append(asyncio.ensure_future(timed(resolve_func, batch)))
+                    if len(pending) >= batches_in_flight:
+                        index._add_batch(*await pending.popleft(), planner=planner, checkpoint=checkpoint)
+            while pending:
+                index._add_batch(*await pending.popleft(), planner=planner, checkpoint=checkpoint)
+        finally:
+            for task in pending:
+                task.cancel()
+        index._finish_build(unique_vars, previous_postings)
+        return index
+
+    @staticmethod
+    def resolve_docs(tpc_manager: TPCManager, variations: list, planner: QueryPlanner = None,
+                     checkpoint: Checkpoint = None):
+        """get the documents mentioning any of the variations, without resolving each variation
+
+        Each batch of variations costs a count request and one request per page of its documents, as many requests as
+        the reports need: the total number of documents and the documents whose text is counted do not depend on
+        which variation of a batch each document mentions.
+
+        Args:
+            tpc_manager (TPCManager): the Textpresso manager used to send the requests
+            variations (list): the variation names
+            planner (QueryPlanner): optional, the planner used to split the variations into batches
+            checkpoint (Checkpoint): optional, the checkpoint where the documents of each completed batch are saved.
+                The variations of the batches it already resolved are not queried again
+        Returns:
+            DocRegistry: the documents, numbered in the order they are returned
+        """
+        docs, vars_to_resolve = VariationIndex._start_resolve_docs(variations, checkpoint)
+        planner = planner or QueryPlanner()
+        for batch in planner.iter_batches(vars_to_resolve):
+            start_time = time.monotonic()
+            batch_docs = tpc_manager.get_all_pages(tpc_manager.get_doc_matching, batch)
+            VariationIndex._add_batch_docs(docs, batch, batch_docs, time.monotonic() - start_time, planner, checkpoint)
+        logger.info("Resolved " + str(len(docs)) + " documents for " + str(len(vars_to_resolve)) + " variations")
+        return docs
+
+    @staticmethod
+    async def resolve_docs_async(tpc_manager, variations: list, planner: QueryPlanner = None,
+                                 checkpoint: Checkpoint = None, batches_in_flight: int = 4):
+        """get the documents mentioning any of the variations, with the same requests as `resolve_docs` on an asyncio
+        Textpresso client
+
+        Up to batches_in_flight batches are resolved at the same time. Their documents are added to the registry and
+        saved in the checkpoint in batch order.
+
+        Args:
+            tpc_manager (AsyncTPCManager): the asyncio Textpresso manager used to send the requests
+            variations (list): the variation names
+            planner (QueryPlanner): optional, the planner used to split the variations into batches
+            checkpoint (Checkpoint): optional, the checkpoint where the documents of each completed batch are saved.
+                The variations of the batches it already resolved are not queried again
+            batches_in_flight (int): optional, the maximum number of batches resolved at the same time
+        Returns:
+            DocRegistry: the documents, numbered in the order they are returned
+        """
+        docs, vars_to_resolve = VariationIndex._start_resolve_docs(variations, checkpoint)
+
+        async def timed(batch):
+            start_time = time.monotonic()
+            batch_docs = await tpc_manager.get_all_docs(batch)
+            return batch, batch_docs, time.monotonic() - start_time
+
+        planner = planner or QueryPlanner()
+        pending = deque()
+        try:
+            for batch in planner.iter_batches(vars_to_resolve):
+                pending.append(asyncio.ensure_future(timed(batch)))
+                if len(pending) >= batches_in_flight:
+                    VariationIndex._add_batch_docs(docs, *await pending.popleft(), planner=planner,
+                                                   checkpoint=checkpoint)
+            while pending:
+                VariationIndex._add_batch_docs(docs, *await pending.popleft(), planner=planner, checkpoint=checkpoint)
+        finally:
+            for task in pending:
+                task.cancel()
+        logger.info("Resolved " + str(len(docs)) + " documents for " + str(len(vars_to_resolve)) + " variations")
+        return docs
+
+    @staticmethod
+    def _start_resolve_docs(variations: list, checkpoint: Checkpoint):
+        """create a registry with the documents saved in the checkpoint
+
+        Returns:
+            tuple: the registry and the variations still to resolve
+        """
+        docs = DocRegistry()
+        vars_to_resolve = get_unique_variations(variations)
+        if checkpoint is not None:
+            resolved_vars = set()
+            for batch, batch_docs in checkpoint.get_batch_docs():
+                resolved_vars.update(batch)
+                for identifier, accession in batch_docs:
+                    docs.intern(identifier, accession)
+            for variation, posting in checkpoint.get_postings().items():
+                resolved_vars.add(variation)
+                for identifier, accession in posting:
+                    docs.intern(identifier, accession)
+            vars_to_resolve = [variation for variation in vars_to_resolve if variation not in resolved_vars]
+        return docs, vars_to_resolve
+
+    @staticmethod
+    def _add_batch_docs(docs: DocRegistry, batch: list, batch_docs: list, latency: float, planner: QueryPlanner,
+                        checkpoint: Checkpoint):
+        planner.record(batch, latency, len(batch_docs))
+        if checkpoint is not None:
+            checkpoint.save_batch_docs(batch, batch_docs)
+        for identifier, accession in batch_docs:
+            docs.intern(identifier, accession)
+
+    @staticmethod
+    def _start_build(variations: list, checkpoint: Checkpoint, previous_postings: dict):
+        """create an index with the postings saved in the checkpoint
+
+        Returns:
+            tuple: the index, the unique variations, and the variations to resolve that are and are not in the
+                previous postings
+        """
+        index = VariationIndex()
+        unique_vars = get_unique_variations(variations)
+        if checkpoint is not None:
+            saved_postings = checkpoint.get_postings()
+            for variation in unique_vars:
+                if variation in saved_postings:
+                    index.add_posting(variation, saved_postings[variation])
+            vars_to_resolve = [variation for variation in unique_vars if variation not in saved_postings]
+        else:
+            vars_to_resolve = unique_vars
+        previous_postings = previous_postings or {}
+        known_vars = [variation for variation in vars_to_resolve if variation in previous_postings]
+        new_vars = [variation for variation in vars_to_resolve if variation not in previous_postings]
+        return index, unique_vars, known_vars, new_vars
+
+    def _add_batch(self, batch: list, postings: list, latency: float, planner: QueryPlanner, checkpoint: Checkpoint):
+        planner.record(batch, latency, sum(len(docs) for variation, docs in postings))
+        if checkpoint is not None:
+            checkpoint.save_postings(postings)
+        for variation, docs in postings:
+            self.add_posting(variation, docs)
+
+    def _finish_build(self, unique_vars: list, previous_postings: dict):
+        logger.info("Built index for " + str(len(unique_vars)) + " variations, " + str(len(self.docs)) + " documents")
+        if previous_postings:
+            logger.info(str(len(self.get_changed_variations(previous_postings))) + " variations added, removed or "
+                        "mentioned in new documents since the previous run")
+
+    def get_papers_per_variation(self, variations: list = None):
+        """get the number of papers mentioning each variation
+
+        Args:
+            variations (list): optional, the variations to report, in order. All the indexed variations if not
+                provided
+        Returns:
+            list: (variation, number of papers) tuples
+        """
+        if variations is None:
+            variations = self.postings.keys()
+        return [(var, len(self.postings.get(var.strip(), ()))) for var in variations]
+
+    def get_changed_variations(self, previous_postings: dict):
+        """get the variations whose documents differ from the ones of a previous run, including the variations added
+        to or removed from the list
+
+        Args:
+            previous_postings (dict): the (identifier, accession) tuples of the documents mentioning each variation in
+                the previous run
+        Returns:
+            list: the changed variations
+        """
+        return [var for var in dict.fromkeys(list(previous_postings) + list(self.postings)) if
+                var not in self.postings or var not in previous_postings or
+                set(self.postings[var]) != {self.docs.get_doc_num(identifier) for identifier, accession in
+                                            previous_postings[var]}]